@@ -0,0 +1,190 @@
+# benchmarks/bench_concurrent_turns.py
+#
+# Пропускная способность параллельных ходов чата через диспетчер PTB: N пользователей пишут
+# одновременно, обновления проходят очередь Application (update_queue -> process_update) и
+# настоящие обработчики handlers/message_handlers.py. Сравниваются последовательная обработка
+# обновлений (как PTB делает по умолчанию, было) и PerChatUpdateProcessor (стало).
+#
+# Bot API и OpenAI заменены заглушками с фиксированной задержкой, хранилище - SQLite в памяти,
+# сеть и ключи не нужны. Лимиты Telegram (telegram_gateway.py) не подключены - измеряется
+# только обработка обновлений.
+#
+# Запуск из корня репозитория (нужные config.py переменные окружения скрипт задает сам):
+#     python benchmarks/bench_concurrent_turns.py [--turns 20] [--chunks 30]
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# config.py проверяет обязательные переменные при импорте
+for name, value in {
+    "TELEGRAM_TOKEN": "123456:bench",
+    "OPENAI_API_KEY": "bench",
+    "BOT_USERNAME": "bench_bot",
+    "STORAGE_BACKEND": "sqlite",
+}.items():
+    os.environ.setdefault(name, value)
+
+from telegram import Update  # noqa: E402
+from telegram.ext import Application  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import config  # noqa: E402
+from database import db  # noqa: E402
+from database.instrumentation import InstrumentedClient  # noqa: E402
+from database.sqlite_backend import SQLiteClient  # noqa: E402
+from handlers import message_handlers  # noqa: E402
+from update_processor import PerChatUpdateProcessor  # noqa: E402
+
+
+class FakeTelegramRequest(BaseRequest):
+    """Bot API с задержкой telegram_delay на запрос: отвечает так, как ответил бы Telegram."""
+
+    def __init__(self, telegram_delay: float):
+        self.telegram_delay = telegram_delay
+        self.message_id = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        parameters = request_data.parameters if request_data else {}
+        if endpoint == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": config.BOT_USERNAME}
+        elif endpoint in ("sendMessage", "editMessageText"):
+            await asyncio.sleep(self.telegram_delay)
+            self.message_id += 1
+            result = {
+                "message_id": parameters.get("message_id", self.message_id),
+                "date": int(time.time()),
+                "chat": {"id": parameters["chat_id"], "type": "private"},
+                "text": parameters.get("text", ""),
+            }
+        else:
+            await asyncio.sleep(self.telegram_delay)
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def make_chunk(text):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])
+
+
+class FakeAsyncStream:
+    def __init__(self, chunks, chunk_delay):
+        self.chunks = chunks
+        self.chunk_delay = chunk_delay
+
+    def __aiter__(self):
+        return self.iterate()
+
+    async def iterate(self):
+        for text in self.chunks:
+            await asyncio.sleep(self.chunk_delay)
+            yield make_chunk(text)
+
+
+class FakeAsyncOpenAI:
+    """AsyncOpenAI: первый токен через first_token_delay, дальше кусок каждые chunk_delay."""
+
+    def __init__(self, chunks, first_token_delay, chunk_delay):
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+        self.chunks, self.first_token_delay, self.chunk_delay = chunks, first_token_delay, chunk_delay
+
+    async def create(self, **kwargs):
+        await asyncio.sleep(self.first_token_delay)
+        if kwargs.get("stream"):
+            return FakeAsyncStream(self.chunks, self.chunk_delay)
+        await asyncio.sleep(self.chunk_delay * len(self.chunks))
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="".join(self.chunks)))])
+
+
+def make_update(update_id, user_id, bot):
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "User", "language_code": "ru"},
+            "text": "Расскажи что-нибудь интересное про звезды",
+        },
+    }, bot)
+
+
+async def run_turns(concurrent: bool, args) -> float:
+    """Прогоняет --turns обновлений от разных пользователей; возвращает время до ответа на все."""
+    openai_client = FakeAsyncOpenAI(["слово "] * args.chunks, args.first_token_delay, args.chunk_delay)
+
+    builder = (
+        Application.builder()
+        .token(config.TELEGRAM_TOKEN)
+        .request(FakeTelegramRequest(args.telegram_delay))
+        .get_updates_request(FakeTelegramRequest(args.telegram_delay))
+        .updater(None)
+    )
+    if concurrent:
+        builder = builder.concurrent_updates(PerChatUpdateProcessor(config.CONCURRENT_UPDATES))
+    application = builder.build()
+
+    # Каждый прогон - с пустой БД, поэтому и кэш профилей начинается с нуля
+    db.profile_cache.clear()
+    supabase = InstrumentedClient(await SQLiteClient.connect(":memory:"))
+    try:
+        message_handlers.register_handlers(application, openai_client, supabase)
+        with contextlib.redirect_stdout(io.StringIO()):
+            await application.initialize()
+            await application.start()
+            started = time.perf_counter()
+            for index in range(args.turns):
+                await application.update_queue.put(make_update(index + 1, 1000 + index, application.bot))
+            await application.update_queue.join()
+            elapsed = time.perf_counter() - started
+            await application.stop()
+            await application.shutdown()
+    finally:
+        await supabase.close()
+    return elapsed
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--turns", type=int, default=20, help="пользователей, написавших одновременно")
+    parser.add_argument("--chunks", type=int, default=30, help="кусков в ответе")
+    parser.add_argument("--first-token-delay", type=float, default=0.3, help="задержка до первого токена, с")
+    parser.add_argument("--chunk-delay", type=float, default=0.01, help="задержка между кусками, с")
+    parser.add_argument("--telegram-delay", type=float, default=0.05, help="задержка запроса к Bot API, с")
+    args = parser.parse_args()
+
+    serial_elapsed = await run_turns(False, args)
+    concurrent_elapsed = await run_turns(True, args)
+
+    print(
+        f"{args.turns} пользователей одновременно, {args.chunks} кусков, первый токен {args.first_token_delay}s, "
+        f"Bot API {args.telegram_delay}s"
+    )
+    print(f"  обновления по одному (до):       {serial_elapsed:6.2f}s  {args.turns / serial_elapsed:6.2f} ходов/с")
+    print(f"  PerChatUpdateProcessor (после):  {concurrent_elapsed:6.2f}s  {args.turns / concurrent_elapsed:6.2f} ходов/с")
+    print(f"  ускорение: x{serial_elapsed / concurrent_elapsed:.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,146 @@
+# benchmarks/bench_stream_accumulator.py
+#
+# Процессорное время на токен в горячем цикле потокового ответа: прежняя склейка строк
+# (full_response += ..., word_buffer += ..., StreamingResponse.buffer += ... и split() на каждом
+# куске) против TextAccumulator. Склейка в атрибут копирует весь текст, поэтому время на токен
+# у нее растет с длиной ответа (сравните --tokens 4000 и 16000). Поток синтетический, сеть не нужна.
+#
+# Оба цикла раз в --edit-every токенов (около секунды потока OpenAI, как правки StreamingResponse)
+# собирают текст для правки: прежний - обрезкой буфера до 4000 символов, TextAccumulator - как
+# фоновая задача правок: text() и, когда хвост длиннее STREAM_MESSAGE_LIMIT, split_point().
+#
+# Запуск из корня репозитория:
+#     python benchmarks/bench_stream_accumulator.py [--tokens 4000] [--runs 50] [--edit-every 50]
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from text_accumulator import TextAccumulator  # noqa: E402
+
+# Как streaming.STREAM_MESSAGE_LIMIT (streaming.py не импортируем - ему нужен config)
+STREAM_MESSAGE_LIMIT = 4000
+
+# Токенов между правками: поток OpenAI дает порядка 50 токенов в секунду, правка - раз в секунду
+EDIT_EVERY_TOKENS = 50
+
+WORDS = ["слово", "ответ", "модель", "token", "stream", "и", "в", "на", "Telegram", "сообщение"]
+
+
+def make_stream(tokens: int, seed: int = 1):
+    """Куски, похожие на поток OpenAI: слово или часть слова, иногда с точкой и абзацем."""
+    rng = random.Random(seed)
+    chunks = []
+    while len(chunks) < tokens:
+        word = rng.choice(WORDS)
+        if len(word) > 6 and rng.random() < 0.5:
+            chunks.extend([" " + word[:4], word[4:]])
+        else:
+            chunks.append(" " + word)
+        if rng.random() < 0.08:
+            chunks.append(".")
+        if rng.random() < 0.02:
+            chunks.append("\n\n")
+    return chunks[:tokens]
+
+
+class LegacyStreamingHandler:
+    """Прежний StreamingResponse: буфер - атрибут, += копирует весь текст."""
+
+    def __init__(self):
+        self.buffer = ""
+
+    def update_message(self, new_chunk):
+        self.buffer += new_chunk
+
+    def edit_text(self):
+        """Текст правки, как в прежнем _safe_update_message."""
+        text = self.buffer
+        if len(text) > 4000:
+            text = text[:4000] + "..."
+        return text
+
+
+def legacy_loop(chunks, edit_every=EDIT_EVERY_TOKENS):
+    """Цикл _relay_stream и StreamingResponse.update_message до перехода на TextAccumulator."""
+    streaming_handler = LegacyStreamingHandler()
+    full_response = ""
+    word_buffer = ""
+    for index, chunk_text in enumerate(chunks, 1):
+        full_response += chunk_text
+        word_buffer += chunk_text
+        if len(word_buffer.split()) >= 3 or chunk_text in ['.', '!', '?', '\n']:
+            streaming_handler.update_message(word_buffer)
+            word_buffer = ""
+        if index % edit_every == 0:
+            streaming_handler.edit_text()
+    streaming_handler.update_message(word_buffer)
+    streaming_handler.edit_text()
+    return full_response
+
+
+def accumulator_edit_text(buffer, offset):
+    """
+    Текст правки, как в StreamingResponse._flush_loop: длинный хвост переносится в следующее
+    сообщение по split_point. Возвращает (текст, новый offset).
+    """
+    while len(buffer) - offset > STREAM_MESSAGE_LIMIT:
+        split = buffer.split_point(offset, STREAM_MESSAGE_LIMIT)
+        buffer.text(offset, split)
+        offset = split
+    return buffer.text(offset, max(buffer.word_end, offset)), offset
+
+
+def accumulator_loop(chunks, edit_every=EDIT_EVERY_TOKENS):
+    """Текущий цикл: кусок дописывается в список частей и в TextAccumulator, правки - по расписанию."""
+    parts = []
+    buffer = TextAccumulator()
+    offset = 0
+    for index, chunk_text in enumerate(chunks, 1):
+        parts.append(chunk_text)
+        buffer.append(chunk_text)
+        if index % edit_every == 0:
+            _, offset = accumulator_edit_text(buffer, offset)
+    accumulator_edit_text(buffer, offset)
+    return "".join(parts)
+
+
+def cpu_per_token(loop, chunks, runs: int, edit_every: int) -> float:
+    """Лучшее процессорное время одного прогона, в микросекундах на токен."""
+    best = None
+    for _ in range(runs):
+        started = time.process_time()
+        loop(chunks, edit_every)
+        elapsed = time.process_time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(chunks) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tokens", type=int, default=4000, help="токенов в ответе")
+    parser.add_argument("--runs", type=int, default=50, help="прогонов (берется лучший)")
+    parser.add_argument("--edit-every", type=int, default=EDIT_EVERY_TOKENS, help="токенов между правками сообщения")
+    args = parser.parse_args()
+
+    chunks = make_stream(args.tokens)
+    assert legacy_loop(chunks, args.edit_every) == accumulator_loop(chunks, args.edit_every)
+
+    legacy = cpu_per_token(legacy_loop, chunks, args.runs, args.edit_every)
+    accumulator = cpu_per_token(accumulator_loop, chunks, args.runs, args.edit_every)
+
+    print(
+        f"{args.tokens} токенов, {sum(map(len, chunks))} символов, правка каждые {args.edit_every} токенов, "
+        f"лучший из {args.runs} прогонов"
+    )
+    print(f"  склейка строк (до):      {legacy:6.2f} мкс/токен")
+    print(f"  TextAccumulator (после): {accumulator:6.2f} мкс/токен")
+    print(f"  ускорение: x{legacy / accumulator:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -10,6 +10,11 @@ load_dotenv()
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
+# --- Хранилище данных ---
+# "supabase" - основной режим, "sqlite" - локальная база (нагрузочные тесты, небольшие установки)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "supabase").lower()
+SQLITE_PATH = os.getenv("SQLITE_PATH", "bot.sqlite3")
+
 # --- Ключи для Supabase ---
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
@@ -71,8 +76,19 @@ AVAILABLE_LANGUAGES = {
 AVAILABLE_MODELS = {
     "GPT-3.5 Turbo": "gpt-3.5-turbo",
     "GPT-4o (NEW)": "gpt-4o",
+    "🧭 Auto": "auto",  # НОВОЕ: модель выбирается на каждый ход (router.py)
 }
 
+# --- НОВОЕ: Автовыбор модели для «Auto» (router.py) ---
+ROUTER_MODEL_ID = "auto"
+ROUTER_SMALL_MODEL = "gpt-3.5-turbo"
+ROUTER_LARGE_MODEL = "gpt-4o"
+ROUTER_MODE_MODELS = {"Шутник": "gpt-3.5-turbo"}  # Режимы, которым хватает маленькой модели
+ROUTER_SHORT_MESSAGE_TOKENS = 15    # Сообщение короче - маленькая модель («спасибо!», «ок»)
+ROUTER_LONG_PROMPT_TOKENS = 2000    # Промпт (с историей) длиннее - большая модель
+ROUTER_LATENCY_LIMIT_MS = 8000      # Средняя задержка большой модели выше - переходим на маленькую
+ROUTER_LATENCY_ALPHA = 0.2          # Вес нового замера в EWMA задержки
+
 # --- Настройки реферальной программы ---
 REFERRAL_BONUS_INVITER = 5  # Бонус тому, кто пригласил
 REFERRAL_BONUS_NEW_USER = 2 # Бонус новому пользователю, который пришел по ссылке
@@ -80,6 +96,109 @@ REFERRAL_BONUS_NEW_USER = 2 # Бонус новому пользователю,
 # --- Настройки для реферальных кодов ---
 REFERRAL_CODE_LENGTH = 8    # Длина уникальной части реферального кода
 
+# --- Кэш профилей пользователей ---
+PROFILE_CACHE_SIZE = 10000  # Максимум профилей в памяти (LRU)
+PROFILE_CACHE_TTL = 300     # Время жизни записи в кэше (секунды)
+
+# --- Окно истории диалога, которое отправляется модели ---
+# Берем самые новые сообщения, пока их сумма укладывается в бюджет токенов модели
+HISTORY_TOKEN_BUDGETS = {
+    "gpt-3.5-turbo": 3000,
+    "gpt-4o": 8000,
+    "auto": 3000,  # Бюджет маленькой модели: ее роутер тоже может выбрать
+}
+DEFAULT_HISTORY_TOKEN_BUDGET = 3000  # Для моделей, которых нет в HISTORY_TOKEN_BUDGETS
+HISTORY_MAX_MESSAGES = 50            # Не больше стольких сообщений, даже если бюджет позволяет
+
+# --- Сжатие длинной истории в краткое содержание (summarizer.py, по желанию) ---
+# Перед включением примените database/migrations/007_conversation_summaries.sql
+SUMMARY_ENABLED = os.getenv("SUMMARY_ENABLED", "0").lower() in ("1", "true", "yes")
+SUMMARY_THRESHOLD_MESSAGES = 40  # Сворачиваем, когда сообщений в истории больше...
+SUMMARY_KEEP_RECENT = 20         # ...оставляя дословно столько последних
+SUMMARY_BATCH_MESSAGES = 40      # Не больше стольких сообщений за одно сворачивание
+SUMMARY_MODEL = "gpt-3.5-turbo"
+SUMMARY_MAX_TOKENS = 500         # Предел длины краткого содержания
+SUMMARY_CHECK_INTERVAL = 60      # Проверяем одного пользователя не чаще (секунды)
+
+# --- Кэш ответов (режимы, где ответ зависит только от текста, языка и модели) ---
+RESPONSE_CACHE_MODES = ("Переводчик",)
+RESPONSE_CACHE_SIZE = 5000              # Максимум ответов в памяти (LRU)
+RESPONSE_CACHE_TTL = 7 * 24 * 3600      # Время жизни ответа (секунды), в памяти и в БД
+# Постоянный уровень в таблице response_cache (database/migrations/005_response_cache.sql)
+RESPONSE_CACHE_PERSISTENT = os.getenv("RESPONSE_CACHE_PERSISTENT", "0").lower() in ("1", "true", "yes")
+
+# --- Очередь отложенных записей в БД (история, состояние, статистика голосовых) ---
+WRITE_BEHIND_QUEUE_SIZE = 1000     # Максимум записей в очереди (при переполнении пишем сразу)
+WRITE_BEHIND_BATCH_SIZE = 100      # Записываем пачку, как только набралось столько записей...
+WRITE_BEHIND_FLUSH_INTERVAL = 1.0  # ...или прошло столько секунд с первой записи в пачке
+
+# --- Метрики ---
+METRICS_LOG_INTERVAL = 300  # Как часто писать сводку метрик в лог (секунды)
+
+# --- Дедлайны, повторы и автоматы защиты для запросов к OpenAI (upstream.py) ---
+UPSTREAM_TIMEOUTS = {          # Дедлайн одной попытки (секунды)
+    "chat": 60.0,              # Для потокового ответа - до начала потока
+    "whisper": 60.0,
+    "tts": 60.0,
+    "image": 120.0,
+    "summary": 90.0,
+}
+STREAM_IDLE_TIMEOUT = 30.0        # Максимальная пауза между кусками потокового ответа
+UPSTREAM_MAX_RETRIES = 2          # Повторов после первой попытки (таймаут, сеть, 429, 5xx)
+UPSTREAM_RETRY_BASE_DELAY = 0.5   # Базовая задержка повтора, удваивается с каждой попыткой...
+UPSTREAM_RETRY_MAX_DELAY = 8.0    # ...но не больше (фактическая задержка - случайная от 0)
+BREAKER_FAILURE_THRESHOLD = 5     # Ошибок подряд, после которых модель временно отключается
+BREAKER_RESET_TIMEOUT = 30.0      # Через сколько секунд пробовать снова
+
+# --- Хеджирование потоковых ответов (по желанию) ---
+# Если первый токен не пришел за HEDGE_PERCENTILE наблюдаемого времени до первого токена,
+# отправляем второй такой же запрос; ответ дает тот поток, который начнет первым
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "0").lower() in ("1", "true", "yes")
+HEDGE_PERCENTILE = 0.95
+HEDGE_MIN_SAMPLES = 20      # Пока замеров меньше, не хеджируем
+HEDGE_MIN_DELAY = 0.5       # Не раньше чем через столько секунд (даже если p95 меньше)
+HEDGE_MAX_RATE = 0.1        # Не больше этой доли запросов среди последних HEDGE_RATE_WINDOW
+HEDGE_RATE_WINDOW = 200
+
+# --- Частота правок потокового ответа в Telegram (streaming.py) ---
+# Правки одного чата идут через общее ведро токенов: в среднем одна правка за interval секунд.
+# RetryAfter удваивает interval (до максимума), каждая успешная правка уменьшает его на 10%;
+# длинное сообщение правится реже: interval * (1 + длина / STREAM_EDIT_LENGTH_STEP)
+STREAM_EDIT_MIN_INTERVAL = 1.0
+STREAM_EDIT_MAX_INTERVAL = 10.0
+STREAM_EDIT_LENGTH_STEP = 2000   # Символов, на которые интервал вырастает на один базовый
+
+# --- Исходящие запросы к Telegram (telegram_gateway.py) ---
+GATEWAY_GLOBAL_RATE = 30.0        # Сообщений в секунду на всего бота (лимит Telegram ~30/с)
+GATEWAY_RESERVED_TOKENS = 10      # Запас общего лимита только для ответов и правок (не для рассылки и уведомлений)
+GATEWAY_CHAT_RATE = 1.0           # Сообщений в секунду в личный чат...
+GATEWAY_CHAT_BURST = 3            # ...с коротким всплеском
+GATEWAY_GROUP_RATE = 20 / 60      # В группу - 20 сообщений в минуту
+GATEWAY_GROUP_BURST = 3
+GATEWAY_MAX_RETRIES = 3           # Повторов после RetryAfter (кроме правок потоковых ответов)
+
+# --- Параллельная обработка обновлений (update_processor.py) ---
+# Разные чаты обрабатываются одновременно (не больше стольких обновлений), один чат - по порядку.
+# Обновление, ждущее своей очереди в чате, тоже занимает место, поэтому запас берется с избытком
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "256"))
+
+# --- Объединение сообщений, отправленных подряд ---
+# Сообщения одного чата, пришедшие с паузой меньше этой (секунды), получают один общий ответ;
+# ответ, который еще генерируется, при этом отменяется. 0 - выключено (каждое сообщение отдельно)
+MESSAGE_DEBOUNCE_SECONDS = float(os.getenv("MESSAGE_DEBOUNCE_SECONDS", "0"))
+
+# --- Ограничения параллельных запросов к OpenAI (отдельно для каждого сервиса) ---
+# max_concurrent - одновременных вызовов, max_waiting - ожидающих в очереди,
+# max_wait - сколько секунд ждать места, прежде чем ответить «сервис занят»
+UPSTREAM_LIMITS = {
+    "chat":    {"max_concurrent": 20, "max_waiting": 50, "max_wait": 15.0},
+    "whisper": {"max_concurrent": 5,  "max_waiting": 20, "max_wait": 15.0},
+    "tts":     {"max_concurrent": 5,  "max_waiting": 20, "max_wait": 15.0},
+    "image":   {"max_concurrent": 2,  "max_waiting": 5,  "max_wait": 30.0},
+    # Фоновое сжатие истории: отдельная очередь, чтобы не занимать места интерактивного чата
+    "summary": {"max_concurrent": 2,  "max_waiting": 100, "max_wait": 60.0},
+}
+
 # НОВОЕ: Функция для получения системного промпта на нужном языке
 def get_system_prompt(mode_name: str, language: str) -> str:
     """
@@ -106,11 +225,17 @@ def get_system_prompt(mode_name: str, language: str) -> str:
 required_vars = {
     "TELEGRAM_TOKEN": TELEGRAM_TOKEN,
     "OPENAI_API_KEY": OPENAI_API_KEY,
-    "SUPABASE_URL": SUPABASE_URL,
-    "SUPABASE_KEY": SUPABASE_KEY,
     "BOT_USERNAME": BOT_USERNAME,
 }
 
+if STORAGE_BACKEND not in ("supabase", "sqlite"):
+    raise ValueError(f"Неизвестный STORAGE_BACKEND: {STORAGE_BACKEND} (допустимо: supabase, sqlite)")
+
+# Ключи Supabase нужны только при работе через Supabase
+if STORAGE_BACKEND == "supabase":
+    required_vars["SUPABASE_URL"] = SUPABASE_URL
+    required_vars["SUPABASE_KEY"] = SUPABASE_KEY
+
 missing_vars = [var_name for var_name, var_value in required_vars.items() if not var_value]
 
 if missing_vars:
@@ -119,7 +244,10 @@ if missing_vars:
 print("✅ Конфигурация загружена успешно!")
 print(f"🤖 Бот: @{BOT_USERNAME}")
 print(f"👑 Админы: {ADMIN_USER_IDS}")
-print(f"🔗 Supabase: {SUPABASE_URL[:30]}...")
+if STORAGE_BACKEND == "sqlite":
+    print(f"🗄️ Хранилище: SQLite ({SQLITE_PATH})")
+else:
+    print(f"🔗 Supabase: {SUPABASE_URL[:30]}...")
 print(f"🎙️ Голосовые сообщения: включены ({len(AVAILABLE_VOICES)} голосов)")
 print(f"🌍 Многоязычность: {len(CHAT_MODES)} режимов на {len(list(CHAT_MODES.values())[0])} языках")
 print(f"🗣️ Голосовое распознавание: {len(AVAILABLE_LANGUAGES)} языка")
\ No newline at end of file
@@ -0,0 +1,80 @@
+# database/cache.py
+
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Простой in-process кэш с ограничением по времени жизни (TTL) и вытеснением LRU."""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Возвращает значение из кэша или None, если его нет или оно устарело."""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return None
+
+        # Помечаем запись как недавно использованную
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """Кладет значение в кэш, при переполнении вытесняет самую старую запись."""
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def peek(self, key):
+        """Возвращает значение без обновления счетчиков и порядка LRU."""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def invalidate(self, key):
+        """Удаляет запись из кэша."""
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        """Возвращает счетчики попаданий/промахов для подбора размера кэша."""
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / total, 3) if total else 0.0,
+        }
+
+
+class ProfileCache(TTLCache):
+    """Кэш профилей пользователей (строка таблицы users) по user_id."""
+
+    def update(self, user_id, **fields):
+        """Write-through: обновляет поля закэшированного профиля, если он есть."""
+        profile = self.peek(user_id)
+        if profile is not None:
+            profile.update(fields)
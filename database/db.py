@@ -1,19 +1,89 @@
 # database/db.py
 
+import asyncio
+import hashlib
 import secrets
 import string
-from config import INITIAL_CREDITS, AVAILABLE_MODELS, REFERRAL_CODE_LENGTH, AVAILABLE_VOICES
+from datetime import datetime, timedelta, timezone
+from config import (
+    INITIAL_CREDITS, AVAILABLE_MODELS, REFERRAL_CODE_LENGTH, AVAILABLE_VOICES,
+    PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL,
+    RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_PERSISTENT,
+    HISTORY_TOKEN_BUDGETS, DEFAULT_HISTORY_TOKEN_BUDGET, HISTORY_MAX_MESSAGES
+)
+from database.cache import ProfileCache, TTLCache
+from database.instrumentation import instrumented
+from tokens import count_tokens, fit_history
 
 # --- Функции для работы с БД. Каждая принимает 'supabase' клиент как первый аргумент ---
 
 DEFAULT_MODEL = list(AVAILABLE_MODELS.values())[0]
 DEFAULT_VOICE = list(AVAILABLE_VOICES.values())[0]
 
+USER_PROFILE_COLUMNS = (
+    "state, mode, credits, model, referral_code, invited_by, created_at, "
+    "voice_enabled, selected_voice, voice_language, voice_messages_sent, voice_messages_received, "
+    "interface_language, streaming_enabled"
+)
+
+# НОВОЕ: Кэш профилей. Все set_* и функции кредитов обновляют его (write-through),
+# поэтому за один ход чата профиль читается из Supabase не более одного раза.
+profile_cache = ProfileCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+
+def get_profile_cache_stats():
+    """Возвращает счетчики попаданий/промахов кэша профилей."""
+    return profile_cache.stats()
+
+# НОВОЕ: Кэш ответов для режима «Переводчик»: в памяти и (по желанию) в таблице response_cache
+response_cache = TTLCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+response_cache_persistent_hits = 0
+
+def get_response_cache_stats():
+    """Возвращает счетчики кэша ответов; hit_ratio учитывает оба уровня."""
+    stats = response_cache.stats()
+    lookups = stats["hits"] + stats["misses"]
+    hits = stats["hits"] + response_cache_persistent_hits
+    stats["persistent"] = RESPONSE_CACHE_PERSISTENT
+    stats["persistent_hits"] = response_cache_persistent_hits
+    stats["hit_ratio"] = round(hits / lookups, 3) if lookups else 0.0
+    return stats
+
+def make_response_cache_key(text, mode, language, model):
+    """Ключ кэша ответа: текст без лишних пробелов + режим + язык + модель."""
+    normalized_text = " ".join(text.split())
+    return hashlib.sha256("\x1f".join([mode, language, model, normalized_text]).encode("utf-8")).hexdigest()
+
+# НОВОЕ: Очередь отложенных записей (database/write_behind.py). Запускается из main.main();
+# пока она не подключена, все записи выполняются сразу, как раньше.
+write_behind = None
+
+def set_write_behind(queue):
+    """Подключает очередь отложенных записей для истории, состояния и статистики голосовых."""
+    global write_behind
+    write_behind = queue
+
+def get_write_behind_stats():
+    """Возвращает метрики очереди отложенных записей (глубина, задержка записи)."""
+    return write_behind.stats() if write_behind else None
+
+# НОВОЕ: Фоновое сжатие длинной истории (summarizer.py). Подключается из main.main()
+summarizer = None
+
+def set_summarizer(conversation_summarizer):
+    """Подключает фоновое сжатие истории: append_turn будет сообщать ему о новых сообщениях."""
+    global summarizer
+    summarizer = conversation_summarizer
+
+def get_summarizer_stats():
+    """Возвращает метрики фонового сжатия истории."""
+    return summarizer.stats() if summarizer else None
+
 def generate_referral_code(user_id):
     """Генерирует уникальный реферальный код для пользователя."""
     random_part = ''.join(secrets.choice(string.ascii_letters + string.digits) for _ in range(REFERRAL_CODE_LENGTH))
     return f"ref{user_id}_{random_part}"
 
+@instrumented
 async def add_or_update_user(supabase, user_id, invited_by=None, language_code=None):
     """Добавляет нового пользователя с реферальным кодом и настройками голоса, если его нет."""
     try:
@@ -65,16 +135,19 @@ async def add_or_update_user(supabase, user_id, invited_by=None, language_code=N
         print(f"Ошибка при добавлении пользователя {user_id}: {e}")
         return None
 
+@instrumented
 async def get_user_data(supabase, user_id):
     """Получает все данные пользователя включая голосовые настройки, язык интерфейса и streaming."""
+    cached = profile_cache.get(user_id)
+    if cached is not None:
+        return dict(cached)
+
     try:
-        response = await supabase.table("users").select(
-            "state, mode, credits, model, referral_code, invited_by, created_at, "
-            "voice_enabled, selected_voice, voice_language, voice_messages_sent, voice_messages_received, "
-            "interface_language, streaming_enabled"
-        ).eq("user_id", user_id).execute()
+        response = await supabase.table("users").select(USER_PROFILE_COLUMNS).eq("user_id", user_id).execute()
         if response.data:
-            return response.data[0]
+            profile = with_pending_profile(user_id, response.data[0])
+            profile_cache.set(user_id, profile)
+            return dict(profile)
     except Exception as e:
         print(f"Ошибка при получении данных пользователя {user_id}: {e}")
     return None
@@ -83,27 +156,28 @@ async def get_user_data(supabase, user_id):
 
 # --- НОВЫЕ ФУНКЦИИ ДЛЯ ЯЗЫКА ИНТЕРФЕЙСА ---
 
+@instrumented
 async def get_user_language(supabase, user_id):
     """Получает язык интерфейса пользователя."""
-    try:
-        response = await supabase.table("users").select("interface_language").eq("user_id", user_id).execute()
-        if response.data:
-            return response.data[0].get('interface_language', 'en')
-    except Exception as e:
-        print(f"Ошибка при получении языка пользователя {user_id}: {e}")
+    data = await get_user_data(supabase, user_id)
+    if data:
+        return data.get('interface_language', 'en')
     return 'en'
 
+@instrumented
 async def set_user_language(supabase, user_id, language_code):
     """Устанавливает язык интерфейса для пользователя."""
     allowed_languages = ['ru', 'en', 'pl']
     if language_code in allowed_languages:
         try:
             await supabase.table("users").update({"interface_language": language_code}).eq("user_id", user_id).execute()
+            profile_cache.update(user_id, interface_language=language_code)
             return True
         except Exception as e:
             print(f"Ошибка при установке языка интерфейса для {user_id}: {e}")
     return False
 
+@instrumented
 async def set_user_language_with_voice_sync(supabase, user_id, language_code):
     """
     Устанавливает язык интерфейса и автоматически синхронизирует язык голосового общения.
@@ -119,6 +193,7 @@ async def set_user_language_with_voice_sync(supabase, user_id, language_code):
                 "interface_language": language_code,
                 "voice_language": voice_language
             }).eq("user_id", user_id).execute()
+            profile_cache.update(user_id, interface_language=language_code, voice_language=voice_language)
             
             print(f"🔄 Пользователь {user_id}: интерфейс={language_code}, голосовой={voice_language} (синхронизированы)")
             return True
@@ -126,6 +201,7 @@ async def set_user_language_with_voice_sync(supabase, user_id, language_code):
             print(f"Ошибка при синхронизации языков для {user_id}: {e}")
     return False
 
+@instrumented
 async def sync_voice_language_with_interface(supabase, user_id):
     """
     Синхронизирует язык голосового общения с текущим языком интерфейса.
@@ -142,6 +218,7 @@ async def sync_voice_language_with_interface(supabase, user_id):
         await supabase.table("users").update({
             "voice_language": voice_language
         }).eq("user_id", user_id).execute()
+        profile_cache.update(user_id, voice_language=voice_language)
         
         print(f"🔄 Синхронизация {user_id}: {interface_language} -> {voice_language}")
         return True
@@ -149,110 +226,150 @@ async def sync_voice_language_with_interface(supabase, user_id):
         print(f"Ошибка при синхронизации голосового языка для {user_id}: {e}")
         return False
 
+@instrumented
 async def set_user_referral(supabase, user_id, inviter_id):
     """Устанавливает, кто пригласил пользователя."""
     try:
         await supabase.table("users").update({"invited_by": inviter_id}).eq("user_id", user_id).execute()
+        profile_cache.update(user_id, invited_by=inviter_id)
         return True
     except Exception as e:
         print(f"Ошибка при установке пригласившего для {user_id}: {e}")
         return False
 
+@instrumented
 async def get_user_voice_settings(supabase, user_id):
     """Получает голосовые настройки пользователя."""
-    try:
-        response = await supabase.table("users").select(
-            "voice_enabled, selected_voice, voice_language"
-        ).eq("user_id", user_id).execute()
-        if response.data:
-            return response.data[0]
-    except Exception as e:
-        print(f"Ошибка при получении голосовых настроек {user_id}: {e}")
+    data = await get_user_data(supabase, user_id)
+    if data:
+        return {
+            "voice_enabled": data.get("voice_enabled"),
+            "selected_voice": data.get("selected_voice"),
+            "voice_language": data.get("voice_language")
+        }
     return {"voice_enabled": False, "selected_voice": DEFAULT_VOICE, "voice_language": "ru"}
 
+@instrumented
 async def set_voice_enabled(supabase, user_id, enabled):
     """Включает или выключает голосовые ответы для пользователя."""
     try:
         await supabase.table("users").update({"voice_enabled": enabled}).eq("user_id", user_id).execute()
+        profile_cache.update(user_id, voice_enabled=enabled)
         return True
     except Exception as e:
         print(f"Ошибка при изменении voice_enabled для {user_id}: {e}")
         return False
 
+@instrumented
 async def set_user_voice(supabase, user_id, voice_id):
     """Устанавливает выбранный голос для пользователя."""
     if voice_id in AVAILABLE_VOICES.values():
         try:
             await supabase.table("users").update({"selected_voice": voice_id}).eq("user_id", user_id).execute()
+            profile_cache.update(user_id, selected_voice=voice_id)
             return True
         except Exception as e:
             print(f"Ошибка при установке голоса для {user_id}: {e}")
     return False
 
+@instrumented
 async def set_user_voice_language(supabase, user_id, language):
     """Устанавливает язык распознавания речи для пользователя (только 3 основных языка)."""
     allowed_languages = ['ru', 'en', 'pl']  # Только 3 языка
     if language in allowed_languages:
         try:
             await supabase.table("users").update({"voice_language": language}).eq("user_id", user_id).execute()
+            profile_cache.update(user_id, voice_language=language)
             return True
         except Exception as e:
             print(f"Ошибка при установке языка голоса для {user_id}: {e}")
     return False
 
-async def increment_voice_stats(supabase, user_id, message_type):
-    """Увеличивает счетчик отправленных или полученных голосовых сообщений."""
+def add_cached_voice_stats(user_id, sent, received):
+    """Увеличивает счетчики голосовых в закэшированном профиле."""
+    cached = profile_cache.peek(user_id)
+    if cached is not None:
+        profile_cache.update(
+            user_id,
+            voice_messages_sent=(cached.get("voice_messages_sent") or 0) + sent,
+            voice_messages_received=(cached.get("voice_messages_received") or 0) + received
+        )
+
+@instrumented
+async def increment_voice_stats(supabase, user_id, sent=0, received=0):
+    """Увеличивает счетчики отправленных и/или полученных голосовых сообщений."""
+    # Сразу обновляем кэш, запись в БД может уйти в фоновую очередь
+    add_cached_voice_stats(user_id, sent, received)
+    
+    if write_behind and write_behind.submit("voice_stats", user_id, (sent, received)):
+        return
+    await write_voice_stats(supabase, user_id, sent, received)
+
+@instrumented
+async def write_voice_stats(supabase, user_id, sent=0, received=0):
+    """Атомарно увеличивает счетчики голосовых в БД (одним UPDATE на стороне Postgres)."""
     try:
-        # Получаем текущие значения
-        current_data = await get_user_data(supabase, user_id)
-        if not current_data:
-            return
-            
-        if message_type == "sent":
-            current_count = current_data.get("voice_messages_sent", 0)
-            await supabase.table("users").update({
-                "voice_messages_sent": current_count + 1
-            }).eq("user_id", user_id).execute()
-        elif message_type == "received":
-            current_count = current_data.get("voice_messages_received", 0)
-            await supabase.table("users").update({
-                "voice_messages_received": current_count + 1
-            }).eq("user_id", user_id).execute()
+        await supabase.rpc("increment_voice_stats", {
+            "p_user_id": user_id,
+            "p_sent": sent,
+            "p_received": received
+        }).execute()
     except Exception as e:
         print(f"Ошибка при обновлении статистики голосовых для {user_id}: {e}")
 
-async def get_voice_stats(supabase, user_id):
-    """Получает статистику использования голосовых сообщений."""
+@instrumented
+async def charge_voice_turn(supabase, user_id, amount, sent=0, received=0):
+    """
+    Списывает кредиты за голосовой ход и обновляет счетчики голосовых одним запросом.
+    
+    Returns:
+        int: новый баланс пользователя
+    """
     try:
-        response = await supabase.table("users").select(
-            "voice_messages_sent, voice_messages_received"
-        ).eq("user_id", user_id).execute()
-        if response.data:
-            data = response.data[0]
-            return {
-                "sent": data.get("voice_messages_sent", 0),
-                "received": data.get("voice_messages_received", 0)
-            }
+        response = await supabase.rpc("charge_voice_turn", {
+            "p_user_id": user_id,
+            "p_amount": amount,
+            "p_sent": sent,
+            "p_received": received
+        }).execute()
+        if not response.data:
+            return 0
+        
+        new_balance = response.data[0]["new_balance"]
+        profile_cache.update(user_id, credits=new_balance)
+        add_cached_voice_stats(user_id, sent, received)
+        return new_balance
     except Exception as e:
-        print(f"Ошибка при получении статистики голосовых для {user_id}: {e}")
+        print(f"Ошибка при списании за голосовое сообщение у {user_id}: {e}")
+    return await get_user_credits(supabase, user_id)
+
+@instrumented
+async def get_voice_stats(supabase, user_id):
+    """Получает статистику использования голосовых сообщений."""
+    data = await get_user_data(supabase, user_id)
+    if data:
+        return {
+            "sent": data.get("voice_messages_sent", 0),
+            "received": data.get("voice_messages_received", 0)
+        }
     return {"sent": 0, "received": 0}
 
 # --- НОВЫЕ ФУНКЦИИ ДЛЯ STREAMING RESPONSE ---
 
+@instrumented
 async def get_user_streaming_setting(supabase, user_id):
     """Получает настройку streaming для пользователя."""
-    try:
-        response = await supabase.table("users").select("streaming_enabled").eq("user_id", user_id).execute()
-        if response.data:
-            return response.data[0].get('streaming_enabled', True)
-    except Exception as e:
-        print(f"Ошибка при получении настройки streaming для {user_id}: {e}")
+    data = await get_user_data(supabase, user_id)
+    if data:
+        return data.get('streaming_enabled', True)
     return True  # По умолчанию включен
 
+@instrumented
 async def set_user_streaming(supabase, user_id, enabled):
     """Включает или выключает streaming response для пользователя."""
     try:
         await supabase.table("users").update({"streaming_enabled": enabled}).eq("user_id", user_id).execute()
+        profile_cache.update(user_id, streaming_enabled=enabled)
         return True
     except Exception as e:
         print(f"Ошибка при изменении streaming для {user_id}: {e}")
@@ -260,6 +377,7 @@ async def set_user_streaming(supabase, user_id, enabled):
 
 # --- СУЩЕСТВУЮЩИЕ ФУНКЦИИ (без изменений) ---
 
+@instrumented
 async def get_user_by_referral_code(supabase, referral_code):
     """Находит пользователя по реферальному коду."""
     try:
@@ -272,43 +390,64 @@ async def get_user_by_referral_code(supabase, referral_code):
         print(f"Ошибка при поиске пользователя по коду {referral_code}: {e}")
     return None
 
+@instrumented
 async def award_referral_bonuses(supabase, inviter_id, new_user_id, inviter_bonus, new_user_bonus):
-    """Начисляет бонусы за реферальную программу."""
+    """Начисляет бонусы за реферальную программу (обоим пользователям в одной транзакции)."""
     try:
-        await add_user_credits(supabase, inviter_id, inviter_bonus)
-        await add_user_credits(supabase, new_user_id, new_user_bonus)
+        response = await supabase.rpc("award_referral_bonuses", {
+            "p_inviter_id": inviter_id,
+            "p_new_user_id": new_user_id,
+            "p_inviter_bonus": inviter_bonus,
+            "p_new_user_bonus": new_user_bonus
+        }).execute()
+        if response.data:
+            balances = response.data[0]
+            if balances.get("inviter_credits") is not None:
+                profile_cache.update(inviter_id, credits=balances["inviter_credits"])
+            if balances.get("new_user_credits") is not None:
+                profile_cache.update(new_user_id, credits=balances["new_user_credits"])
         return True
     except Exception as e:
         print(f"Ошибка при начислении реферальных бонусов: {e}")
         return False
 
+@instrumented
 async def get_user_credits(supabase, user_id):
     """Получает баланс кредитов пользователя."""
     data = await get_user_data(supabase, user_id)
     return data['credits'] if data else 0
 
+# ОБНОВЛЕНО: Все изменения баланса выполняются атомарно на стороне Postgres
+# (см. database/migrations/001_atomic_credits.sql) - один запрос вместо чтения и записи,
+# и параллельные голосовые/текстовые ходы больше не теряют списания.
+
+@instrumented
 async def deduct_user_credits(supabase, user_id, amount):
     """Списывает кредиты с баланса пользователя."""
-    current_credits = await get_user_credits(supabase, user_id)
-    new_credits = max(0, current_credits - amount)
     try:
-        await supabase.table("users").update({"credits": new_credits}).eq("user_id", user_id).execute()
-        return new_credits
+        response = await supabase.rpc("deduct_user_credits", {"p_user_id": user_id, "p_amount": amount}).execute()
+        if response.data is None:
+            return 0
+        profile_cache.update(user_id, credits=response.data)
+        return response.data
     except Exception as e:
         print(f"Ошибка при списании кредитов у {user_id}: {e}")
-    return current_credits
+    return await get_user_credits(supabase, user_id)
 
+@instrumented
 async def add_user_credits(supabase, user_id, amount):
     """Начисляет кредиты пользователю."""
-    current_credits = await get_user_credits(supabase, user_id)
-    new_credits = current_credits + amount
     try:
-        await supabase.table("users").update({"credits": new_credits}).eq("user_id", user_id).execute()
-        return new_credits
+        response = await supabase.rpc("add_user_credits", {"p_user_id": user_id, "p_amount": amount}).execute()
+        if response.data is None:
+            return 0
+        profile_cache.update(user_id, credits=response.data)
+        return response.data
     except Exception as e:
         print(f"Ошибка при начислении кредитов {user_id}: {e}")
-    return current_credits
+    return await get_user_credits(supabase, user_id)
 
+@instrumented
 async def remove_user_credits(supabase, user_id, amount, allow_negative=False):
     """Снимает кредиты у пользователя.
     
@@ -321,30 +460,69 @@ async def remove_user_credits(supabase, user_id, amount, allow_negative=False):
     Returns:
         tuple: (новый_баланс, успешно_ли_операция)
     """
-    current_credits = await get_user_credits(supabase, user_id)
-    
-    if not allow_negative and current_credits < amount:
-        # Не можем снять больше, чем есть
-        return current_credits, False
-    
-    new_credits = current_credits - amount
-    
     try:
-        await supabase.table("users").update({"credits": new_credits}).eq("user_id", user_id).execute()
-        return new_credits, True
+        response = await supabase.rpc("remove_user_credits", {
+            "p_user_id": user_id,
+            "p_amount": amount,
+            "p_allow_negative": allow_negative
+        }).execute()
+        if not response.data:
+            # Пользователь не найден
+            return 0, False
+        
+        result = response.data[0]
+        profile_cache.update(user_id, credits=result["new_balance"])
+        return result["new_balance"], result["success"]
     except Exception as e:
         print(f"Ошибка при снятии кредитов у {user_id}: {e}")
-        return current_credits, False
+        return await get_user_credits(supabase, user_id), False
 
-async def get_all_user_ids(supabase):
-    """Возвращает список ID всех пользователей."""
-    try:
-        response = await supabase.table("users").select("user_id").execute()
-        return [item['user_id'] for item in response.data]
-    except Exception as e:
-        print(f"Ошибка при получении всех ID пользователей: {e}")
-    return []
+# Попыток получить страницу пользователей в iter_users, прежде чем сдаться
+ITER_USERS_PAGE_ATTEMPTS = 3
+
+async def iter_users(supabase, columns="user_id", page_size=1000):
+    """
+    Асинхронно перебирает пользователей постранично (keyset-пагинация по user_id).
+    В памяти одновременно держится не больше одной страницы.
+    
+    Args:
+        columns: колонки для выборки (user_id добавляется автоматически)
+        page_size: размер страницы
+    
+    Yields:
+        dict: строка таблицы users
+    
+    Raises:
+        Exception: если страницу не удалось получить и после повторов (перебор не обрывается молча)
+    """
+    column_names = [column.strip() for column in columns.split(",")]
+    if "user_id" not in column_names:
+        columns = "user_id, " + columns
+    
+    last_user_id = None
+    while True:
+        for attempt in range(ITER_USERS_PAGE_ATTEMPTS):
+            query = supabase.table("users").select(columns).order("user_id").limit(page_size)
+            if last_user_id is not None:
+                query = query.gt("user_id", last_user_id)
+            try:
+                response = await query.execute()
+                break
+            except Exception as e:
+                print(f"Ошибка при получении страницы пользователей после {last_user_id} (попытка {attempt + 1}): {e}")
+                if attempt + 1 == ITER_USERS_PAGE_ATTEMPTS:
+                    raise
+                await asyncio.sleep(2 ** attempt)
+        
+        rows = response.data
+        for row in rows:
+            yield row
+        
+        if len(rows) < page_size:
+            return
+        last_user_id = rows[-1]["user_id"]
 
+@instrumented
 async def count_users(supabase):
     """Считает общее количество пользователей."""
     try:
@@ -354,6 +532,22 @@ async def count_users(supabase):
         print(f"Ошибка при подсчете пользователей: {e}")
     return 0
 
+@instrumented
+async def get_bot_stats(supabase):
+    """
+    Получает агрегированную статистику бота для /stats одним SQL-запросом.
+    Возвращает None при ошибке (а не нули, которые выглядят как настоящая статистика).
+    """
+    try:
+        response = await supabase.rpc("get_bot_stats", {}).execute()
+        if response.data:
+            return response.data
+        print("Ошибка при получении статистики бота: пустой ответ get_bot_stats")
+    except Exception as e:
+        print(f"Ошибка при получении статистики бота: {e}")
+    return None
+
+@instrumented
 async def get_referral_stats(supabase, user_id):
     """Получает статистику реферальной программы для пользователя."""
     try:
@@ -364,48 +558,285 @@ async def get_referral_stats(supabase, user_id):
         print(f"Ошибка при получении реферальной статистики для {user_id}: {e}")
     return {"invited_count": 0}
 
+@instrumented
 async def set_user_state(supabase, user_id, state):
     """Устанавливает состояние пользователя."""
+    # Кэш обновляется сразу, поэтому следующее сообщение увидит новое состояние
+    # даже если запись в БД еще в очереди
+    profile_cache.update(user_id, state=state)
+    if write_behind:
+        if write_behind.submit("state", user_id, state):
+            return
+        # Очередь переполнена - пишем сами, а старое состояние из очереди не должно затереть новое
+        write_behind.discard_state(user_id)
+    await write_user_state(supabase, user_id, state)
+
+@instrumented
+async def write_user_state(supabase, user_id, state):
+    """Записывает состояние пользователя в БД."""
     try:
         await supabase.table("users").update({"state": state}).eq("user_id", user_id).execute()
     except Exception as e:
         print(f"Ошибка при установке состояния для {user_id}: {e}")
 
+@instrumented
 async def set_user_mode(supabase, user_id, mode):
     """Устанавливает режим и сбрасывает историю."""
+    # Состояние пишется здесь напрямую - состояние, ожидающее в очереди, больше не актуально
+    if write_behind:
+        write_behind.discard_state(user_id)
     try:
         await supabase.table("users").update({"mode": mode, "state": 'chat'}).eq("user_id", user_id).execute()
+        profile_cache.update(user_id, mode=mode, state='chat')
         await clear_user_history(supabase, user_id)
     except Exception as e:
         print(f"Ошибка при установке режима для {user_id}: {e}")
 
+@instrumented
 async def set_user_model(supabase, user_id, model_id):
     """Устанавливает выбранную модель для пользователя."""
     if model_id in AVAILABLE_MODELS.values():
         try:
             await supabase.table("users").update({"model": model_id}).eq("user_id", user_id).execute()
+            profile_cache.update(user_id, model=model_id)
         except Exception as e:
             print(f"Ошибка при установке модели для {user_id}: {e}")
 
+@instrumented
 async def get_user_history(supabase, user_id, limit=10):
     """Получает историю сообщений пользователя."""
     try:
-        response = await supabase.table("messages").select("role, content").eq("user_id", user_id).order("created_at", desc=True).limit(limit).execute()
-        return list(reversed(response.data))
+        response = await supabase.table("messages").select("role, content, created_at").eq("user_id", user_id).order("created_at", desc=True).limit(limit).execute()
+        history = with_pending_history(user_id, list(reversed(response.data)))[-limit:]
+        return [{"role": message["role"], "content": message["content"]} for message in history]
     except Exception as e:
         print(f"Ошибка при получении истории для {user_id}: {e}")
     return []
 
+def with_pending_profile(user_id, profile):
+    """Дополняет профиль из БД состоянием и счетчиками голосовых, которые еще ждут записи в очереди."""
+    # ИСПРАВЛЕНО: Иначе кэш, заполненный из БД, вернул бы старое состояние (например, 'chat'
+    # вместо 'awaiting_image_prompt') до записи очереди
+    if not write_behind:
+        return profile
+    return write_behind.pending_profile(user_id, profile)
+
+def with_pending_history(user_id, history):
+    """Дополняет историю из БД сообщениями, которые еще ждут записи в очереди."""
+    if not write_behind:
+        return history
+    pending = write_behind.pending_history(user_id)
+    if not pending:
+        return history
+    
+    # ИСПРАВЛЕНО: Пачка, которая записывается прямо сейчас, может уже быть в БД, но еще числиться
+    # в очереди - такие сообщения не добавляем второй раз
+    stored = {history_row_key(message) for message in history if message.get("created_at")}
+    return history + [message for message in pending if history_row_key(message) not in stored]
+
+def history_row_key(message):
+    """Ключ сообщения истории для сверки записанного в БД с ожидающим в очереди."""
+    created_at = message.get("created_at")
+    if isinstance(created_at, str):
+        # Postgres и Python пишут одно и то же время по-разному (Z или +00:00, дробная часть)
+        created_at = datetime.fromisoformat(created_at.replace("Z", "+00:00"))
+    return (message["role"], message["content"], created_at)
+
+# Заголовок системного сообщения с кратким содержанием старой части диалога
+SUMMARY_MESSAGE_PREFIX = "Summary of the earlier part of this conversation:\n"
+
+def get_history_token_budget(model):
+    """Бюджет токенов истории для модели."""
+    return HISTORY_TOKEN_BUDGETS.get(model, DEFAULT_HISTORY_TOKEN_BUDGET)
+
+@instrumented
+async def get_turn_context(supabase, user_id):
+    """
+    Получает за один запрос всё, что нужно для генерации ответа: профиль пользователя
+    (режим, модель, язык, streaming, кредиты, голос) и самые новые сообщения истории,
+    укладывающиеся в бюджет токенов модели (HISTORY_TOKEN_BUDGETS).
+    
+    Returns:
+        dict: поля профиля + ключ 'history', или None если пользователь не найден
+    """
+    try:
+        response = await supabase.rpc("get_turn_context", {
+            "p_user_id": user_id,
+            "p_max_messages": HISTORY_MAX_MESSAGES,
+            "p_budgets": HISTORY_TOKEN_BUDGETS,
+            "p_default_budget": DEFAULT_HISTORY_TOKEN_BUDGET
+        }).execute()
+        if response.data:
+            profile = with_pending_profile(user_id, response.data["profile"])
+            profile_cache.set(user_id, profile)
+            
+            # БД уже отрезала историю по бюджету; повторяем отбор вместе с сообщениями из очереди
+            history = with_pending_history(user_id, response.data["history"])[-HISTORY_MAX_MESSAGES:]
+            budget = get_history_token_budget(profile.get("model"))
+            summary = response.data.get("summary")
+            if summary:
+                budget -= summary["token_count"]
+            history = fit_history(history, budget)
+            
+            # НОВОЕ: Свернутая старая часть диалога идет системным сообщением перед историей
+            if summary:
+                history.insert(0, {"role": "system", "content": SUMMARY_MESSAGE_PREFIX + summary["summary"]})
+            
+            turn_context = dict(profile)
+            turn_context["history"] = history
+            return turn_context
+    except Exception as e:
+        print(f"Ошибка при получении контекста хода для {user_id}: {e}")
+    return None
+
+@instrumented
 async def add_message_to_history(supabase, user_id, role, content):
     """Добавляет сообщение в историю."""
     try:
-        await supabase.table("messages").insert({"user_id": user_id, "role": role, "content": content}).execute()
+        await supabase.table("messages").insert({
+            "user_id": user_id, "role": role, "content": content, "token_count": count_tokens(content)
+        }).execute()
     except Exception as e:
         print(f"Ошибка при добавлении сообщения в историю для {user_id}: {e}")
 
+@instrumented
+async def append_turn(supabase, user_id, messages):
+    """
+    Сохраняет сообщения одного хода (обычно пара user/assistant) одной пакетной вставкой.
+    
+    Args:
+        messages: список словарей {"role": ..., "content": ...} в порядке диалога
+    """
+    # Явно задаем created_at с шагом в 1 мкс, чтобы порядок сообщений в истории сохранялся
+    base_time = datetime.now(timezone.utc)
+    rows = [
+        {
+            "user_id": user_id,
+            "role": message["role"],
+            "content": message["content"],
+            # Токены считаем один раз при записи - окно истории выбирается по ним
+            "token_count": count_tokens(message["content"]),
+            "created_at": (base_time + timedelta(microseconds=index)).isoformat()
+        }
+        for index, message in enumerate(messages)
+    ]
+    if summarizer:
+        summarizer.schedule(user_id)
+    if write_behind and write_behind.submit("history", user_id, rows):
+        return
+    await insert_history_rows(supabase, rows)
+
+@instrumented
+async def insert_history_rows(supabase, rows):
+    """Записывает готовые строки истории (возможно, разных пользователей) одной вставкой."""
+    try:
+        await supabase.table("messages").insert(rows).execute()
+    except Exception as e:
+        user_ids = sorted({row["user_id"] for row in rows})
+        print(f"Ошибка при сохранении истории для {user_ids}: {e}")
+
+@instrumented
 async def clear_user_history(supabase, user_id):
     """Очищает историю сообщений пользователя."""
+    if write_behind:
+        write_behind.discard_history(user_id)
     try:
         await supabase.table("messages").delete().eq("user_id", user_id).execute()
     except Exception as e:
-        print(f"Ошибка при очистке истории для {user_id}: {e}")
\ No newline at end of file
+        print(f"Ошибка при очистке истории для {user_id}: {e}")
+    
+    # ИСПРАВЛЕНО: Краткое содержание удаляем всегда - оно могло остаться с тех пор, когда сжатие
+    # истории было включено. Таблицы conversation_summaries может не быть (миграция 007 не применена),
+    # поэтому ошибка здесь не должна мешать очистке самих сообщений
+    try:
+        await supabase.table("conversation_summaries").delete().eq("user_id", user_id).execute()
+    except Exception as e:
+        print(f"Ошибка при удалении краткого содержания для {user_id}: {e}")
+
+@instrumented
+async def count_user_messages(supabase, user_id):
+    """Считает сообщения пользователя в истории."""
+    try:
+        response = await supabase.table("messages").select("user_id", count='exact').eq("user_id", user_id).limit(1).execute()
+        return response.count or 0
+    except Exception as e:
+        print(f"Ошибка при подсчете сообщений для {user_id}: {e}")
+    return 0
+
+@instrumented
+async def get_oldest_messages(supabase, user_id, limit):
+    """Получает самые старые сообщения пользователя (для сворачивания в краткое содержание)."""
+    try:
+        response = await supabase.table("messages").select("role, content, created_at").eq("user_id", user_id).order("created_at").limit(limit).execute()
+        return response.data
+    except Exception as e:
+        print(f"Ошибка при получении старых сообщений для {user_id}: {e}")
+    return []
+
+@instrumented
+async def get_conversation_summary(supabase, user_id):
+    """Получает краткое содержание старой части диалога или None."""
+    try:
+        response = await supabase.table("conversation_summaries").select("summary").eq("user_id", user_id).limit(1).execute()
+        if response.data:
+            return response.data[0]["summary"]
+    except Exception as e:
+        print(f"Ошибка при получении краткого содержания для {user_id}: {e}")
+    return None
+
+@instrumented
+async def fold_conversation_summary(supabase, user_id, summary, folded_until):
+    """
+    Удаляет сообщения до folded_until включительно и сохраняет новое краткое содержание
+    (одна транзакция в БД). Если удалять нечего (историю очистили, пока готовилось краткое
+    содержание), краткое содержание не сохраняется.
+    
+    Returns:
+        int: сколько сообщений удалено (0 - краткое содержание отброшено), или None при ошибке
+    """
+    try:
+        response = await supabase.rpc("fold_conversation_summary", {
+            "p_user_id": user_id,
+            "p_summary": summary,
+            "p_token_count": count_tokens(SUMMARY_MESSAGE_PREFIX + summary),
+            "p_folded_until": folded_until
+        }).execute()
+        return response.data
+    except Exception as e:
+        print(f"Ошибка при сохранении краткого содержания для {user_id}: {e}")
+    return None
+
+@instrumented
+async def get_cached_response(supabase, cache_key):
+    """Ищет готовый ответ сначала в памяти, затем (если включено) в таблице response_cache."""
+    global response_cache_persistent_hits
+    response = response_cache.get(cache_key)
+    if response is not None or not RESPONSE_CACHE_PERSISTENT:
+        return response
+    
+    try:
+        cutoff = (datetime.now(timezone.utc) - timedelta(seconds=RESPONSE_CACHE_TTL)).isoformat()
+        result = await supabase.table("response_cache").select("response").eq("cache_key", cache_key).gt("created_at", cutoff).limit(1).execute()
+        if result.data:
+            response = result.data[0]["response"]
+            response_cache.set(cache_key, response)
+            response_cache_persistent_hits += 1
+            return response
+    except Exception as e:
+        print(f"Ошибка при чтении кэша ответов: {e}")
+    return None
+
+@instrumented
+async def save_cached_response(supabase, cache_key, response):
+    """Сохраняет ответ в кэш (и в таблицу response_cache, если постоянный уровень включен)."""
+    response_cache.set(cache_key, response)
+    if not RESPONSE_CACHE_PERSISTENT:
+        return
+    try:
+        await supabase.table("response_cache").upsert({
+            "cache_key": cache_key,
+            "response": response,
+            "created_at": datetime.now(timezone.utc).isoformat()
+        }).execute()
+    except Exception as e:
+        print(f"Ошибка при сохранении кэша ответов: {e}")
\ No newline at end of file
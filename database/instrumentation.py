@@ -0,0 +1,95 @@
+# database/instrumentation.py
+
+import contextvars
+import time
+from functools import wraps
+from metrics import registry
+
+# Группы метрик: задержка функций db.py целиком и отдельных запросов к таблицам/rpc
+DB_FUNCTION_METRICS = "db.function"
+DB_QUERY_METRICS = "db.query"
+
+# Функция db.py, внутри которой сейчас выполняется запрос
+current_call = contextvars.ContextVar("current_db_call", default=None)
+
+
+class DBCall:
+    def __init__(self, name: str):
+        self.name = name
+        self.failed = False
+
+
+def instrumented(func):
+    """
+    Декоратор для функций db.py: считает вызовы, ошибки и задержку.
+    Функции db.py сами перехватывают исключения, поэтому ошибкой считается и упавший
+    внутри них запрос (его отмечает InstrumentedQuery).
+    """
+    @wraps(func)
+    async def wrapped(*args, **kwargs):
+        call = DBCall(func.__name__)
+        token = current_call.set(call)
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            call.failed = True
+            raise
+        finally:
+            current_call.reset(token)
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            registry.observe(DB_FUNCTION_METRICS, call.name, elapsed_ms, call.failed)
+    return wrapped
+
+
+class InstrumentedQuery:
+    """Обертка над построителем запроса: замеряет execute() по паре (функция db.py, таблица)."""
+
+    def __init__(self, builder, target: str):
+        self._builder = builder
+        self._target = target
+
+    def __getattr__(self, name):
+        attribute = getattr(self._builder, name)
+        if not callable(attribute):
+            return attribute
+
+        def chained(*args, **kwargs):
+            result = attribute(*args, **kwargs)
+            # Методы построителя возвращают новый построитель - продолжаем его оборачивать
+            if hasattr(result, "execute"):
+                return InstrumentedQuery(result, self._target)
+            return result
+        return chained
+
+    async def execute(self):
+        call = current_call.get()
+        label = f"{call.name if call else '-'} {self._target}"
+        started = time.perf_counter()
+        failed = False
+        try:
+            return await self._builder.execute()
+        except Exception:
+            failed = True
+            if call:
+                call.failed = True
+            raise
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            registry.observe(DB_QUERY_METRICS, label, elapsed_ms, failed)
+
+
+class InstrumentedClient:
+    """Обертка над клиентом хранилища (Supabase или SQLite) для сбора метрик запросов."""
+
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def table(self, name: str):
+        return InstrumentedQuery(self._client.table(name), f"table:{name}")
+
+    def rpc(self, name: str, params: dict = None):
+        return InstrumentedQuery(self._client.rpc(name, params or {}), f"rpc:{name}")
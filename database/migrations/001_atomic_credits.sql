@@ -0,0 +1,73 @@
+-- database/migrations/001_atomic_credits.sql
+-- Атомарные операции с кредитами: баланс меняется одним UPDATE на стороне Postgres,
+-- без чтения в Python и записи абсолютного значения обратно.
+-- Применить: Supabase Dashboard -> SQL Editor (или `supabase db push`).
+
+-- Списание с обрезкой до нуля (поведение прежнего deduct_user_credits)
+create or replace function deduct_user_credits(p_user_id bigint, p_amount integer)
+returns integer
+language sql
+as $$
+    update users
+    set credits = greatest(0, credits - p_amount)
+    where user_id = p_user_id
+    returning credits;
+$$;
+
+-- Начисление кредитов
+create or replace function add_user_credits(p_user_id bigint, p_amount integer)
+returns integer
+language sql
+as $$
+    update users
+    set credits = credits + p_amount
+    where user_id = p_user_id
+    returning credits;
+$$;
+
+-- Снятие кредитов с проверкой баланса; p_allow_negative = флаг "force" из /remove_credits.
+-- Возвращает новый баланс и признак успеха (при отказе - текущий баланс и false).
+create or replace function remove_user_credits(p_user_id bigint, p_amount integer, p_allow_negative boolean default false)
+returns table (new_balance integer, success boolean)
+language plpgsql
+as $$
+declare
+    v_credits integer;
+begin
+    update users
+    set credits = credits - p_amount
+    where user_id = p_user_id
+      and (p_allow_negative or credits >= p_amount)
+    returning credits into v_credits;
+
+    if found then
+        return query select v_credits, true;
+    else
+        return query select u.credits, false from users u where u.user_id = p_user_id;
+    end if;
+end;
+$$;
+
+-- Реферальные бонусы обоим пользователям в одной транзакции
+create or replace function award_referral_bonuses(
+    p_inviter_id bigint, p_new_user_id bigint,
+    p_inviter_bonus integer, p_new_user_bonus integer
+)
+returns table (inviter_credits integer, new_user_credits integer)
+language plpgsql
+as $$
+declare
+    v_inviter_credits integer;
+    v_new_user_credits integer;
+begin
+    update users set credits = credits + p_inviter_bonus
+    where user_id = p_inviter_id
+    returning credits into v_inviter_credits;
+
+    update users set credits = credits + p_new_user_bonus
+    where user_id = p_new_user_id
+    returning credits into v_new_user_credits;
+
+    return query select v_inviter_credits, v_new_user_credits;
+end;
+$$;
@@ -0,0 +1,43 @@
+-- database/migrations/002_turn_context.sql
+-- Контекст хода чата за один запрос: профиль пользователя + последние p_limit сообщений истории.
+-- Используется db.get_turn_context() перед каждым запросом к OpenAI.
+
+create index if not exists messages_user_id_created_at_idx
+    on messages (user_id, created_at desc);
+
+create or replace function get_turn_context(p_user_id bigint, p_limit integer default 10)
+returns jsonb
+language sql
+stable
+as $$
+    select jsonb_build_object(
+        'profile', jsonb_build_object(
+            'state', u.state,
+            'mode', u.mode,
+            'credits', u.credits,
+            'model', u.model,
+            'referral_code', u.referral_code,
+            'invited_by', u.invited_by,
+            'created_at', u.created_at,
+            'voice_enabled', u.voice_enabled,
+            'selected_voice', u.selected_voice,
+            'voice_language', u.voice_language,
+            'voice_messages_sent', u.voice_messages_sent,
+            'voice_messages_received', u.voice_messages_received,
+            'interface_language', u.interface_language,
+            'streaming_enabled', u.streaming_enabled
+        ),
+        'history', coalesce((
+            select jsonb_agg(jsonb_build_object('role', h.role, 'content', h.content) order by h.created_at)
+            from (
+                select m.role, m.content, m.created_at
+                from messages m
+                where m.user_id = p_user_id
+                order by m.created_at desc
+                limit p_limit
+            ) h
+        ), '[]'::jsonb)
+    )
+    from users u
+    where u.user_id = p_user_id;
+$$;
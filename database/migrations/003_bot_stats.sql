@@ -0,0 +1,17 @@
+-- database/migrations/003_bot_stats.sql
+-- Агрегированная статистика для команды /stats одним запросом вместо обхода всех пользователей.
+
+create or replace function get_bot_stats()
+returns jsonb
+language sql
+stable
+as $$
+    select jsonb_build_object(
+        'total_users', count(*),
+        'total_credits', coalesce(sum(credits), 0),
+        'avg_credits', coalesce(round(avg(credits), 2), 0),
+        'negative_balance_count', count(*) filter (where credits < 0),
+        'voice_enabled_count', count(*) filter (where voice_enabled)
+    )
+    from users;
+$$;
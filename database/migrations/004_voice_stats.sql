@@ -0,0 +1,30 @@
+-- database/migrations/004_voice_stats.sql
+-- Атомарные счетчики голосовых сообщений и списание за голосовой ход одним запросом.
+
+create or replace function increment_voice_stats(p_user_id bigint, p_sent integer default 0, p_received integer default 0)
+returns table (sent integer, received integer)
+language sql
+as $$
+    update users
+    set voice_messages_sent = coalesce(voice_messages_sent, 0) + p_sent,
+        voice_messages_received = coalesce(voice_messages_received, 0) + p_received
+    where user_id = p_user_id
+    returning voice_messages_sent, voice_messages_received;
+$$;
+
+-- Списание кредитов (с обрезкой до нуля, как deduct_user_credits) и обновление счетчиков
+-- голосовых в одном UPDATE
+create or replace function charge_voice_turn(
+    p_user_id bigint, p_amount integer,
+    p_sent integer default 0, p_received integer default 0
+)
+returns table (new_balance integer, sent integer, received integer)
+language sql
+as $$
+    update users
+    set credits = greatest(0, credits - p_amount),
+        voice_messages_sent = coalesce(voice_messages_sent, 0) + p_sent,
+        voice_messages_received = coalesce(voice_messages_received, 0) + p_received
+    where user_id = p_user_id
+    returning credits, voice_messages_sent, voice_messages_received;
+$$;
@@ -0,0 +1,11 @@
+-- database/migrations/005_response_cache.sql
+-- Постоянный уровень кэша ответов режима «Переводчик» (db.get_cached_response / db.save_cached_response).
+-- Нужен только при RESPONSE_CACHE_PERSISTENT=1; устаревшие записи отсекаются по created_at при чтении.
+
+create table if not exists response_cache (
+    cache_key text primary key,
+    response text not null,
+    created_at timestamptz not null default now()
+);
+
+create index if not exists response_cache_created_at_idx on response_cache (created_at);
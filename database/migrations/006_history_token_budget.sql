@@ -0,0 +1,69 @@
+-- database/migrations/006_history_token_budget.sql
+-- Окно истории по бюджету токенов вместо фиксированных 10 сообщений.
+-- token_count считается один раз при записи сообщения (db.append_turn); для старых строк
+-- без него используется оценка ceil(length / 4), та же, что tokens.estimate_tokens().
+
+alter table messages add column if not exists token_count integer;
+
+-- Сигнатура меняется, старую версию удаляем, чтобы у rpc не было двух перегрузок
+drop function if exists get_turn_context(bigint, integer);
+
+create or replace function get_turn_context(
+    p_user_id bigint,
+    p_max_messages integer default 50,
+    p_budgets jsonb default '{}'::jsonb,
+    p_default_budget integer default 3000
+)
+returns jsonb
+language sql
+stable
+as $$
+    with budget as (
+        select coalesce((p_budgets ->> u.model)::integer, p_default_budget) as tokens
+        from users u
+        where u.user_id = p_user_id
+    ),
+    recent as (
+        select m.role, m.content, m.created_at,
+               coalesce(m.token_count, ceil(length(m.content) / 4.0)::integer) as token_count
+        from messages m
+        where m.user_id = p_user_id
+        order by m.created_at desc
+        limit p_max_messages
+    ),
+    windowed as (
+        -- Нарастающий итог от самого нового сообщения к старым
+        select r.*, sum(r.token_count) over (
+            order by r.created_at desc rows between unbounded preceding and current row
+        ) as running_tokens
+        from recent r
+    )
+    select jsonb_build_object(
+        'profile', jsonb_build_object(
+            'state', u.state,
+            'mode', u.mode,
+            'credits', u.credits,
+            'model', u.model,
+            'referral_code', u.referral_code,
+            'invited_by', u.invited_by,
+            'created_at', u.created_at,
+            'voice_enabled', u.voice_enabled,
+            'selected_voice', u.selected_voice,
+            'voice_language', u.voice_language,
+            'voice_messages_sent', u.voice_messages_sent,
+            'voice_messages_received', u.voice_messages_received,
+            'interface_language', u.interface_language,
+            'streaming_enabled', u.streaming_enabled
+        ),
+        'history', coalesce((
+            select jsonb_agg(
+                jsonb_build_object('role', w.role, 'content', w.content, 'token_count', w.token_count)
+                order by w.created_at
+            )
+            from windowed w
+            where w.running_tokens <= (select tokens from budget)
+        ), '[]'::jsonb)
+    )
+    from users u
+    where u.user_id = p_user_id;
+$$;
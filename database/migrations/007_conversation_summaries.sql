@@ -0,0 +1,110 @@
+-- database/migrations/007_conversation_summaries.sql
+-- Краткое содержание старой части диалога (summarizer.py). Старые сообщения сворачиваются
+-- в одну строку conversation_summaries и удаляются из messages; get_turn_context отдает
+-- summary вместе с историей, и бот подставляет его системным сообщением перед историей.
+
+create table if not exists conversation_summaries (
+    user_id bigint primary key,
+    summary text not null,
+    token_count integer not null default 0,
+    updated_at timestamptz not null default now()
+);
+
+-- Удаляет свернутые сообщения и сохраняет новое краткое содержание одной транзакцией.
+-- Если удалять нечего, историю успели очистить (clear_user_history), пока готовилось краткое
+-- содержание, - тогда оно не сохраняется, чтобы очищенный диалог не вернулся в контекст
+create or replace function fold_conversation_summary(
+    p_user_id bigint,
+    p_summary text,
+    p_token_count integer,
+    p_folded_until timestamptz
+)
+returns integer
+language plpgsql
+as $$
+declare
+    v_deleted integer;
+begin
+    delete from messages
+    where user_id = p_user_id and created_at <= p_folded_until;
+    get diagnostics v_deleted = row_count;
+
+    if v_deleted > 0 then
+        insert into conversation_summaries (user_id, summary, token_count, updated_at)
+        values (p_user_id, p_summary, p_token_count, now())
+        on conflict (user_id) do update
+            set summary = excluded.summary,
+                token_count = excluded.token_count,
+                updated_at = excluded.updated_at;
+    end if;
+
+    return v_deleted;
+end;
+$$;
+
+-- get_turn_context из 006 + поле summary (null, если старую историю еще не сворачивали)
+create or replace function get_turn_context(
+    p_user_id bigint,
+    p_max_messages integer default 50,
+    p_budgets jsonb default '{}'::jsonb,
+    p_default_budget integer default 3000
+)
+returns jsonb
+language sql
+stable
+as $$
+    with budget as (
+        select coalesce((p_budgets ->> u.model)::integer, p_default_budget)
+               - coalesce((select s.token_count from conversation_summaries s where s.user_id = p_user_id), 0) as tokens
+        from users u
+        where u.user_id = p_user_id
+    ),
+    recent as (
+        select m.role, m.content, m.created_at,
+               coalesce(m.token_count, ceil(length(m.content) / 4.0)::integer) as token_count
+        from messages m
+        where m.user_id = p_user_id
+        order by m.created_at desc
+        limit p_max_messages
+    ),
+    windowed as (
+        -- Нарастающий итог от самого нового сообщения к старым
+        select r.*, sum(r.token_count) over (
+            order by r.created_at desc rows between unbounded preceding and current row
+        ) as running_tokens
+        from recent r
+    )
+    select jsonb_build_object(
+        'profile', jsonb_build_object(
+            'state', u.state,
+            'mode', u.mode,
+            'credits', u.credits,
+            'model', u.model,
+            'referral_code', u.referral_code,
+            'invited_by', u.invited_by,
+            'created_at', u.created_at,
+            'voice_enabled', u.voice_enabled,
+            'selected_voice', u.selected_voice,
+            'voice_language', u.voice_language,
+            'voice_messages_sent', u.voice_messages_sent,
+            'voice_messages_received', u.voice_messages_received,
+            'interface_language', u.interface_language,
+            'streaming_enabled', u.streaming_enabled
+        ),
+        'summary', (
+            select jsonb_build_object('summary', s.summary, 'token_count', s.token_count)
+            from conversation_summaries s
+            where s.user_id = p_user_id
+        ),
+        'history', coalesce((
+            select jsonb_agg(
+                jsonb_build_object('role', w.role, 'content', w.content, 'token_count', w.token_count)
+                order by w.created_at
+            )
+            from windowed w
+            where w.running_tokens <= (select tokens from budget)
+        ), '[]'::jsonb)
+    )
+    from users u
+    where u.user_id = p_user_id;
+$$;
@@ -0,0 +1,73 @@
+-- database/migrations/008_turn_context_created_at.sql
+-- get_turn_context из 007 + created_at у сообщений истории. По нему бот отличает сообщения,
+-- которые очередь отложенных записей (database/write_behind.py) уже записала, от еще ожидающих,
+-- и не показывает в контексте одно сообщение дважды, пока пачка записывается.
+-- Применяется после 007_conversation_summaries.sql.
+
+create or replace function get_turn_context(
+    p_user_id bigint,
+    p_max_messages integer default 50,
+    p_budgets jsonb default '{}'::jsonb,
+    p_default_budget integer default 3000
+)
+returns jsonb
+language sql
+stable
+as $$
+    with budget as (
+        select coalesce((p_budgets ->> u.model)::integer, p_default_budget)
+               - coalesce((select s.token_count from conversation_summaries s where s.user_id = p_user_id), 0) as tokens
+        from users u
+        where u.user_id = p_user_id
+    ),
+    recent as (
+        select m.role, m.content, m.created_at,
+               coalesce(m.token_count, ceil(length(m.content) / 4.0)::integer) as token_count
+        from messages m
+        where m.user_id = p_user_id
+        order by m.created_at desc
+        limit p_max_messages
+    ),
+    windowed as (
+        -- Нарастающий итог от самого нового сообщения к старым
+        select r.*, sum(r.token_count) over (
+            order by r.created_at desc rows between unbounded preceding and current row
+        ) as running_tokens
+        from recent r
+    )
+    select jsonb_build_object(
+        'profile', jsonb_build_object(
+            'state', u.state,
+            'mode', u.mode,
+            'credits', u.credits,
+            'model', u.model,
+            'referral_code', u.referral_code,
+            'invited_by', u.invited_by,
+            'created_at', u.created_at,
+            'voice_enabled', u.voice_enabled,
+            'selected_voice', u.selected_voice,
+            'voice_language', u.voice_language,
+            'voice_messages_sent', u.voice_messages_sent,
+            'voice_messages_received', u.voice_messages_received,
+            'interface_language', u.interface_language,
+            'streaming_enabled', u.streaming_enabled
+        ),
+        'summary', (
+            select jsonb_build_object('summary', s.summary, 'token_count', s.token_count)
+            from conversation_summaries s
+            where s.user_id = p_user_id
+        ),
+        'history', coalesce((
+            select jsonb_agg(
+                jsonb_build_object(
+                    'role', w.role, 'content', w.content, 'token_count', w.token_count, 'created_at', w.created_at
+                )
+                order by w.created_at
+            )
+            from windowed w
+            where w.running_tokens <= (select tokens from budget)
+        ), '[]'::jsonb)
+    )
+    from users u
+    where u.user_id = p_user_id;
+$$;
@@ -0,0 +1,407 @@
+# database/sqlite_backend.py
+
+import asyncio
+import re
+from datetime import datetime, timezone
+
+# Схема повторяет таблицы Supabase, с которыми работает database/db.py
+SCHEMA = """
+create table if not exists users (
+    user_id integer primary key,
+    state text default 'chat',
+    mode text default 'Помощник',
+    credits integer not null default 0,
+    model text,
+    referral_code text unique,
+    invited_by integer,
+    created_at text,
+    voice_enabled integer not null default 0,
+    selected_voice text,
+    voice_language text,
+    voice_messages_sent integer not null default 0,
+    voice_messages_received integer not null default 0,
+    interface_language text default 'en',
+    streaming_enabled integer not null default 1
+);
+
+create table if not exists messages (
+    id integer primary key autoincrement,
+    user_id integer not null,
+    role text not null,
+    content text not null,
+    token_count integer,
+    created_at text not null
+);
+
+create table if not exists conversation_summaries (
+    user_id integer primary key,
+    summary text not null,
+    token_count integer not null default 0,
+    updated_at text not null
+);
+
+create table if not exists response_cache (
+    cache_key text primary key,
+    response text not null,
+    created_at text not null
+);
+
+create index if not exists messages_user_id_created_at_idx on messages (user_id, created_at);
+create index if not exists users_invited_by_idx on users (invited_by);
+"""
+
+# Колонки, добавленные после первой версии схемы (для уже созданных файлов БД)
+ADDED_COLUMNS = {
+    "messages": {"token_count": "integer"},
+}
+
+# Колонки, которые в Postgres имеют тип boolean (SQLite хранит их как 0/1)
+BOOLEAN_COLUMNS = {"voice_enabled", "streaming_enabled"}
+
+# Таблицы, в которых created_at заполняется при вставке (в Postgres это делает default now())
+TIMESTAMPED_TABLES = {"users", "messages", "response_cache"}
+
+IDENTIFIER_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+def now_iso():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def quote_identifier(name: str) -> str:
+    """Проверяет имя колонки/таблицы (они приходят только из кода, но SQL собирается строкой)."""
+    name = name.strip()
+    if not IDENTIFIER_RE.match(name):
+        raise ValueError(f"Недопустимый идентификатор: {name!r}")
+    return f'"{name}"'
+
+
+def row_to_dict(row):
+    data = dict(row)
+    for column in BOOLEAN_COLUMNS:
+        if column in data and data[column] is not None:
+            data[column] = bool(data[column])
+    return data
+
+
+class SQLiteResponse:
+    """Ответ в формате postgrest: data и (для select с count='exact') count."""
+
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+
+class SQLiteQuery:
+    """Построитель запросов с тем же подмножеством API, что и у supabase.table(...)."""
+
+    def __init__(self, client, table: str):
+        self.client = client
+        self.table = quote_identifier(table)
+        self.table_name = table
+        self.action = None
+        self.replace = False
+        self.columns = "*"
+        self.count_mode = None
+        self.payload = None
+        self.filters = []
+        self.order_by = []
+        self.limit_value = None
+
+    def select(self, columns: str = "*", count=None):
+        self.action = "select"
+        self.columns = columns
+        self.count_mode = count
+        return self
+
+    def insert(self, payload):
+        self.action = "insert"
+        self.payload = payload
+        return self
+
+    def upsert(self, payload):
+        # Конфликт по первичному ключу - заменяем строку, как upsert в postgrest
+        self.action = "insert"
+        self.payload = payload
+        self.replace = True
+        return self
+
+    def update(self, payload: dict):
+        self.action = "update"
+        self.payload = payload
+        return self
+
+    def delete(self):
+        self.action = "delete"
+        return self
+
+    def eq(self, column: str, value):
+        self.filters.append((quote_identifier(column), "=", value))
+        return self
+
+    def gt(self, column: str, value):
+        self.filters.append((quote_identifier(column), ">", value))
+        return self
+
+    def order(self, column: str, desc: bool = False):
+        self.order_by.append(f"{quote_identifier(column)} {'desc' if desc else 'asc'}")
+        return self
+
+    def limit(self, size: int):
+        self.limit_value = int(size)
+        return self
+
+    def where_clause(self):
+        if not self.filters:
+            return "", []
+        conditions = " and ".join(f"{column} {operator} ?" for column, operator, _ in self.filters)
+        return f" where {conditions}", [value for _, _, value in self.filters]
+
+    async def execute(self):
+        return await self.client.run(self.execute_locked)
+
+    async def execute_locked(self, connection):
+        where_sql, params = self.where_clause()
+
+        if self.action == "select":
+            if self.columns.strip() == "*":
+                columns_sql = "*"
+            else:
+                columns_sql = ", ".join(quote_identifier(column) for column in self.columns.split(","))
+            sql = f"select {columns_sql} from {self.table}{where_sql}"
+            if self.order_by:
+                sql += " order by " + ", ".join(self.order_by)
+            if self.limit_value is not None:
+                sql += f" limit {self.limit_value}"
+            cursor = await connection.execute(sql, params)
+            rows = [row_to_dict(row) for row in await cursor.fetchall()]
+
+            count = None
+            if self.count_mode == "exact":
+                cursor = await connection.execute(f"select count(*) from {self.table}{where_sql}", params)
+                count = (await cursor.fetchone())[0]
+            return SQLiteResponse(rows, count)
+
+        if self.action == "insert":
+            rows = self.payload if isinstance(self.payload, list) else [self.payload]
+            inserted = []
+            for row in rows:
+                row = dict(row)
+                if self.table_name in TIMESTAMPED_TABLES:
+                    row.setdefault("created_at", now_iso())
+                columns_sql = ", ".join(quote_identifier(column) for column in row)
+                placeholders = ", ".join("?" for _ in row)
+                verb = "insert or replace" if self.replace else "insert"
+                await connection.execute(
+                    f"{verb} into {self.table} ({columns_sql}) values ({placeholders})",
+                    list(row.values())
+                )
+                inserted.append(row)
+            await connection.commit()
+            return SQLiteResponse(inserted)
+
+        if self.action == "update":
+            assignments = ", ".join(f"{quote_identifier(column)} = ?" for column in self.payload)
+            await connection.execute(
+                f"update {self.table} set {assignments}{where_sql}",
+                list(self.payload.values()) + params
+            )
+            await connection.commit()
+            return SQLiteResponse([])
+
+        if self.action == "delete":
+            await connection.execute(f"delete from {self.table}{where_sql}", params)
+            await connection.commit()
+            return SQLiteResponse([])
+
+        raise ValueError(f"Не указано действие для запроса к {self.table_name}")
+
+
+class SQLiteRPC:
+    """Вызов серверной функции; SQLite-реализации живут в SQLiteClient.rpc_<имя>."""
+
+    def __init__(self, client, name: str, params: dict):
+        self.client = client
+        self.name = name
+        self.params = params or {}
+
+    async def execute(self):
+        handler = getattr(self.client, f"rpc_{self.name}", None)
+        if handler is None:
+            raise ValueError(f"Функция {self.name} не реализована в SQLite-хранилище")
+
+        async def call(connection):
+            data = await handler(connection, **self.params)
+            await connection.commit()
+            return SQLiteResponse(data)
+
+        return await self.client.run(call)
+
+
+class SQLiteClient:
+    """
+    Локальное хранилище на aiosqlite с тем же интерфейсом, что database/db.py использует
+    у клиента Supabase: table(...) с select/insert/upsert/update/delete/eq/gt/order/limit и rpc(...)
+    с SQLite-версиями функций из database/migrations.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        # Один коннект и одна блокировка: каждая операция и каждая rpc выполняются целиком
+        self.lock = asyncio.Lock()
+
+    @classmethod
+    async def connect(cls, path: str):
+        # Необязательная зависимость: нужна только для локального хранилища
+        import aiosqlite
+
+        connection = await aiosqlite.connect(path)
+        connection.row_factory = aiosqlite.Row
+        await connection.execute("pragma journal_mode = wal")
+        await connection.executescript(SCHEMA)
+        await cls.add_missing_columns(connection)
+        await connection.commit()
+        return cls(connection)
+
+    @staticmethod
+    async def add_missing_columns(connection):
+        for table, columns in ADDED_COLUMNS.items():
+            cursor = await connection.execute(f"pragma table_info({quote_identifier(table)})")
+            existing = {row["name"] for row in await cursor.fetchall()}
+            for column, column_type in columns.items():
+                if column not in existing:
+                    await connection.execute(f"alter table {quote_identifier(table)} add column {quote_identifier(column)} {column_type}")
+
+    async def close(self):
+        await self.connection.close()
+
+    async def run(self, operation):
+        async with self.lock:
+            try:
+                return await operation(self.connection)
+            except Exception:
+                await self.connection.rollback()
+                raise
+
+    def table(self, name: str) -> SQLiteQuery:
+        return SQLiteQuery(self, name)
+
+    def rpc(self, name: str, params: dict = None) -> SQLiteRPC:
+        return SQLiteRPC(self, name, params)
+
+    # --- SQLite-версии функций из database/migrations ---
+
+    async def fetch_value(self, connection, sql, params):
+        cursor = await connection.execute(sql, params)
+        row = await cursor.fetchone()
+        return row[0] if row else None
+
+    async def rpc_deduct_user_credits(self, connection, p_user_id, p_amount):
+        await connection.execute(
+            "update users set credits = max(0, credits - ?) where user_id = ?", (p_amount, p_user_id)
+        )
+        return await self.fetch_value(connection, "select credits from users where user_id = ?", (p_user_id,))
+
+    async def rpc_add_user_credits(self, connection, p_user_id, p_amount):
+        await connection.execute(
+            "update users set credits = credits + ? where user_id = ?", (p_amount, p_user_id)
+        )
+        return await self.fetch_value(connection, "select credits from users where user_id = ?", (p_user_id,))
+
+    async def rpc_remove_user_credits(self, connection, p_user_id, p_amount, p_allow_negative=False):
+        cursor = await connection.execute(
+            "update users set credits = credits - ? where user_id = ? and (? or credits >= ?)",
+            (p_amount, p_user_id, bool(p_allow_negative), p_amount)
+        )
+        success = cursor.rowcount > 0
+        credits = await self.fetch_value(connection, "select credits from users where user_id = ?", (p_user_id,))
+        if credits is None:
+            return []
+        return [{"new_balance": credits, "success": success}]
+
+    async def rpc_award_referral_bonuses(self, connection, p_inviter_id, p_new_user_id, p_inviter_bonus, p_new_user_bonus):
+        inviter_credits = await self.rpc_add_user_credits(connection, p_inviter_id, p_inviter_bonus)
+        new_user_credits = await self.rpc_add_user_credits(connection, p_new_user_id, p_new_user_bonus)
+        return [{"inviter_credits": inviter_credits, "new_user_credits": new_user_credits}]
+
+    async def rpc_get_turn_context(self, connection, p_user_id, p_max_messages=50, p_budgets=None, p_default_budget=3000):
+        cursor = await connection.execute(
+            "select state, mode, credits, model, referral_code, invited_by, created_at, "
+            "voice_enabled, selected_voice, voice_language, voice_messages_sent, voice_messages_received, "
+            "interface_language, streaming_enabled from users where user_id = ?",
+            (p_user_id,)
+        )
+        profile = await cursor.fetchone()
+        if profile is None:
+            return None
+
+        profile = row_to_dict(profile)
+        cursor = await connection.execute(
+            "select summary, token_count from conversation_summaries where user_id = ?", (p_user_id,)
+        )
+        summary = await cursor.fetchone()
+        summary = dict(summary) if summary else None
+        budget = (p_budgets or {}).get(profile["model"], p_default_budget) - (summary["token_count"] if summary else 0)
+
+        # Нарастающий итог токенов от самого нового сообщения, как в Postgres-версии
+        cursor = await connection.execute(
+            "select role, content, token_count, created_at from ("
+            "  select role, content, created_at, token_count, sum(token_count) over ("
+            "    order by created_at desc rows between unbounded preceding and current row"
+            "  ) as running_tokens from ("
+            "    select role, content, created_at,"
+            "      coalesce(token_count, (length(content) + 3) / 4) as token_count"
+            "    from messages where user_id = ? order by created_at desc limit ?"
+            "  )"
+            ") where running_tokens <= ? order by created_at",
+            (p_user_id, p_max_messages, budget)
+        )
+        history = [dict(row) for row in await cursor.fetchall()]
+        return {"profile": profile, "summary": summary, "history": history}
+
+    async def rpc_fold_conversation_summary(self, connection, p_user_id, p_summary, p_token_count, p_folded_until):
+        cursor = await connection.execute(
+            "delete from messages where user_id = ? and created_at <= ?", (p_user_id, p_folded_until)
+        )
+        deleted = cursor.rowcount
+        # Нечего удалять - историю очистили, пока готовилось краткое содержание
+        if deleted > 0:
+            await connection.execute(
+                "insert or replace into conversation_summaries (user_id, summary, token_count, updated_at) "
+                "values (?, ?, ?, ?)",
+                (p_user_id, p_summary, p_token_count, now_iso())
+            )
+        return deleted
+
+    async def rpc_get_bot_stats(self, connection):
+        cursor = await connection.execute(
+            "select count(*), coalesce(sum(credits), 0), coalesce(round(avg(credits), 2), 0), "
+            "coalesce(sum(credits < 0), 0), coalesce(sum(voice_enabled = 1), 0) from users"
+        )
+        total_users, total_credits, avg_credits, negative_count, voice_count = await cursor.fetchone()
+        return {
+            "total_users": total_users,
+            "total_credits": total_credits,
+            "avg_credits": avg_credits,
+            "negative_balance_count": negative_count,
+            "voice_enabled_count": voice_count
+        }
+
+    async def rpc_increment_voice_stats(self, connection, p_user_id, p_sent=0, p_received=0):
+        await connection.execute(
+            "update users set voice_messages_sent = coalesce(voice_messages_sent, 0) + ?, "
+            "voice_messages_received = coalesce(voice_messages_received, 0) + ? where user_id = ?",
+            (p_sent, p_received, p_user_id)
+        )
+        cursor = await connection.execute(
+            "select voice_messages_sent, voice_messages_received from users where user_id = ?", (p_user_id,)
+        )
+        row = await cursor.fetchone()
+        return [{"sent": row[0], "received": row[1]}] if row else []
+
+    async def rpc_charge_voice_turn(self, connection, p_user_id, p_amount, p_sent=0, p_received=0):
+        credits = await self.rpc_deduct_user_credits(connection, p_user_id, p_amount)
+        stats = await self.rpc_increment_voice_stats(connection, p_user_id, p_sent, p_received)
+        if credits is None or not stats:
+            return []
+        return [{"new_balance": credits, **stats[0]}]
@@ -0,0 +1,32 @@
+# database/storage.py
+
+import config
+from database.instrumentation import InstrumentedClient
+
+
+async def create_storage_client():
+    """
+    Создает клиент хранилища, выбранного в config.STORAGE_BACKEND.
+
+    Все функции database/db.py принимают этот клиент первым аргументом (параметр 'supabase')
+    и используют только table(...) и rpc(...), поэтому работают с любым из бэкендов:
+      - "supabase": асинхронный клиент Supabase (основной режим);
+      - "sqlite": локальная база aiosqlite (нагрузочные тесты, бенчмарки, небольшие установки).
+
+    Клиент оборачивается в InstrumentedClient, который замеряет каждый запрос.
+    """
+    if config.STORAGE_BACKEND == "sqlite":
+        from database.sqlite_backend import SQLiteClient
+        client = await SQLiteClient.connect(config.SQLITE_PATH)
+    else:
+        from supabase import acreate_client
+        client = await acreate_client(config.SUPABASE_URL, config.SUPABASE_KEY)
+
+    return InstrumentedClient(client)
+
+
+async def close_storage_client(client):
+    """Закрывает соединение с хранилищем, если бэкенд это поддерживает."""
+    close = getattr(client, "close", None)
+    if close is not None:
+        await close()
@@ -0,0 +1,225 @@
+# database/write_behind.py
+
+import asyncio
+import time
+from database import db
+
+
+class WriteBehindQueue:
+    """
+    Фоновая очередь некритичных записей в БД: история сообщений, состояние пользователя
+    и статистика голосовых. Хендлеры только кладут запись в очередь, а воркер копит их,
+    объединяет по пользователям и записывает пачками.
+    """
+
+    def __init__(self, supabase, max_size: int = 1000, batch_size: int = 100, flush_interval: float = 1.0):
+        self.supabase = supabase
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = asyncio.Queue(maxsize=max_size)
+        self._task = None
+        # Строки истории, которые уже приняты в очередь, но еще не записаны в БД
+        self._pending_history = {}
+        # Последнее состояние пользователя, ожидающее записи (записи из очереди сверяются с ним)
+        self._pending_states = {}
+        # Счетчики голосовых, ожидающие записи: user_id -> (sent, received)
+        self._pending_voice_stats = {}
+
+        # Метрики
+        self.enqueued = 0
+        self.rejected = 0
+        self.flushes = 0
+        self.flushed_writes = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self._total_flush_ms = 0.0
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        """Запускает фоновый воркер."""
+        if not self.running:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает воркер, предварительно записав всё, что осталось в очереди."""
+        if not self.running:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+        print(f"💾 Очередь отложенных записей остановлена: {self.stats()}")
+
+    def submit(self, kind: str, user_id, payload) -> bool:
+        """
+        Кладет запись в очередь без ожидания.
+
+        Returns:
+            bool: False если воркер не запущен или очередь переполнена - тогда вызывающий
+                  код должен записать данные сам
+        """
+        if not self.running:
+            return False
+        try:
+            self._queue.put_nowait((kind, user_id, payload))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+
+        if kind == "history":
+            self._pending_history.setdefault(user_id, []).extend(payload)
+        elif kind == "state":
+            self._pending_states[user_id] = payload
+        elif kind == "voice_stats":
+            sent, received = payload
+            pending_sent, pending_received = self._pending_voice_stats.get(user_id, (0, 0))
+            self._pending_voice_stats[user_id] = (pending_sent + sent, pending_received + received)
+        self.enqueued += 1
+        return True
+
+    def pending_history(self, user_id):
+        """
+        Возвращает еще не записанные сообщения пользователя (для чтения своих записей).
+        Сообщения пачки, которая сейчас записывается, остаются здесь до конца записи.
+        """
+        return [
+            {
+                "role": row["role"], "content": row["content"],
+                "token_count": row.get("token_count"), "created_at": row.get("created_at"),
+            }
+            for row in self._pending_history.get(user_id, [])
+        ]
+
+    def pending_profile(self, user_id, profile):
+        """Накладывает на профиль из БД еще не записанные состояние и счетчики голосовых."""
+        profile = dict(profile)
+        if user_id in self._pending_states:
+            profile["state"] = self._pending_states[user_id]
+        if user_id in self._pending_voice_stats:
+            sent, received = self._pending_voice_stats[user_id]
+            profile["voice_messages_sent"] = (profile.get("voice_messages_sent") or 0) + sent
+            profile["voice_messages_received"] = (profile.get("voice_messages_received") or 0) + received
+        return profile
+
+    def discard_history(self, user_id):
+        """Отменяет запись еще не сохраненных сообщений (при очистке истории)."""
+        self._pending_history.pop(user_id, None)
+
+    def discard_state(self, user_id):
+        """Отменяет запись состояния из очереди (перед прямой записью, чтобы ее не затерло старое)."""
+        self._pending_states.pop(user_id, None)
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                stopping = True
+                batch = []
+            else:
+                batch = [item]
+
+            # Копим пачку до batch_size записей или до истечения flush_interval
+            deadline = time.monotonic() + self.flush_interval
+            while not stopping and len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                else:
+                    batch.append(item)
+
+            # При остановке забираем всё, что еще лежит в очереди
+            if stopping:
+                while not self._queue.empty():
+                    item = self._queue.get_nowait()
+                    if item is not None:
+                        batch.append(item)
+
+            if batch:
+                try:
+                    await self._flush(batch)
+                except Exception as e:
+                    print(f"❌ Ошибка при записи пачки отложенных записей: {e}")
+
+    async def _flush(self, batch):
+        started = time.monotonic()
+
+        # Объединяем записи по пользователям
+        states = {}
+        voice_stats = {}
+        history_rows = []
+        written_rows = {}
+        for kind, user_id, payload in batch:
+            if kind == "state":
+                # Важно только последнее состояние; отмененное через discard_state не пишем
+                if user_id in self._pending_states:
+                    states[user_id] = self._pending_states[user_id]
+            elif kind == "voice_stats":
+                # Счетчики суммируем, чтобы обновить оба одним запросом
+                sent, received = payload
+                total_sent, total_received = voice_stats.get(user_id, (0, 0))
+                voice_stats[user_id] = (total_sent + sent, total_received + received)
+            elif kind == "history":
+                # Строки, отмененные через discard_history, не записываем
+                pending_ids = {id(row) for row in self._pending_history.get(user_id, [])}
+                rows = [row for row in payload if id(row) in pending_ids]
+                history_rows.extend(rows)
+                written_rows.setdefault(user_id, set()).update(id(row) for row in rows)
+
+        writes = []
+        if history_rows:
+            # Вся история из пачки - одной вставкой
+            writes.append(db.insert_history_rows(self.supabase, history_rows))
+        for user_id, state in states.items():
+            writes.append(db.write_user_state(self.supabase, user_id, state))
+        for user_id, (sent, received) in voice_stats.items():
+            writes.append(db.write_voice_stats(self.supabase, user_id, sent, received))
+
+        await asyncio.gather(*writes)
+
+        for user_id, state in states.items():
+            # Новое состояние, пришедшее во время записи, остается в очереди
+            if self._pending_states.get(user_id) == state:
+                self._pending_states.pop(user_id, None)
+
+        for user_id, (sent, received) in voice_stats.items():
+            pending_sent, pending_received = self._pending_voice_stats.pop(user_id, (0, 0))
+            if (pending_sent - sent, pending_received - received) != (0, 0):
+                # Счетчики, добавленные во время записи, остаются в очереди
+                self._pending_voice_stats[user_id] = (pending_sent - sent, pending_received - received)
+
+        for user_id, row_ids in written_rows.items():
+            remaining = [row for row in self._pending_history.get(user_id, []) if id(row) not in row_ids]
+            if remaining:
+                self._pending_history[user_id] = remaining
+            else:
+                self._pending_history.pop(user_id, None)
+
+        elapsed_ms = (time.monotonic() - started) * 1000
+        self.flushes += 1
+        self.flushed_writes += len(batch)
+        self.last_flush_ms = elapsed_ms
+        self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+        self._total_flush_ms += elapsed_ms
+
+    def stats(self):
+        """Возвращает метрики очереди: глубину и задержку записи пачек."""
+        return {
+            "depth": self._queue.qsize(),
+            "max_size": self._queue.maxsize,
+            "enqueued": self.enqueued,
+            "rejected": self.rejected,
+            "flushes": self.flushes,
+            "flushed_writes": self.flushed_writes,
+            "last_flush_ms": round(self.last_flush_ms, 1),
+            "avg_flush_ms": round(self._total_flush_ms / self.flushes, 1) if self.flushes else 0.0,
+            "max_flush_ms": round(self.max_flush_ms, 1),
+        }
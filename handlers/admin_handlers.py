@@ -3,10 +3,20 @@
 from telegram import Update
 from telegram.ext import ContextTypes, CommandHandler
 from functools import wraps
-import asyncio
 from config import ADMIN_USER_IDS
 from database import db
+from database.instrumentation import DB_FUNCTION_METRICS, DB_QUERY_METRICS
+from metrics import registry
+from router import ROUTER_METRICS
+from streaming import STREAM_RECOVERY_METRICS, STREAM_TTFT_METRICS, STREAM_HEDGE_METRICS, STREAM_RENDER_METRICS
+from upstream import (
+    UPSTREAM_QUEUE_METRICS, UPSTREAM_CALL_METRICS, UPSTREAM_REJECTED_METRICS, UPSTREAM_RETRY_METRICS,
+    get_upstream_stats, get_breaker_stats
+)
 from translations import get_text
+from telegram_gateway import (
+    LANE_NOTIFICATION, LANE_BROADCAST, GATEWAY_QUEUE_METRICS, GATEWAY_RETRY_AFTER_METRICS, get_gateway_stats
+)
 
 # ИСПРАВЛЕНО: Принимаем supabase
 def register_handlers(application, supabase):
@@ -37,31 +47,28 @@ def register_handlers(application, supabase):
         user_id = update.effective_user.id
         user_language = await db.get_user_language(supabase, user_id)
         
+        async def reply_stats_error(error):
+            if user_language == 'ru':
+                error_msg = f"❌ Ошибка при получении статистики: {error}"
+            elif user_language == 'pl':
+                error_msg = f"❌ Błąd podczas pobierania statystyk: {error}"
+            else:
+                error_msg = f"❌ Error getting statistics: {error}"
+            await update.message.reply_text(error_msg)
+        
         try:
-            # Получаем общую статистику
-            user_count = await db.count_users(supabase)
-            
-            # Получаем дополнительную статистику
-            all_users = await db.get_all_user_ids(supabase)
+            # ОБНОВЛЕНО: Вся статистика считается на стороне Postgres одним запросом
+            bot_stats = await db.get_bot_stats(supabase)
+            if bot_stats is None:
+                await reply_stats_error("get_bot_stats")
+                return
             
-            total_credits = 0
-            voice_enabled_count = 0
-            negative_balance_count = 0
+            user_count = bot_stats['total_users']
+            total_credits = bot_stats['total_credits']
+            avg_credits = bot_stats['avg_credits']
+            voice_enabled_count = bot_stats['voice_enabled_count']
+            negative_balance_count = bot_stats['negative_balance_count']
             
-            for user_id_stat in all_users:
-                user_data = await db.get_user_data(supabase, user_id_stat)
-                if user_data:
-                    credits = user_data.get('credits', 0)
-                    total_credits += credits
-                    
-                    if credits < 0:
-                        negative_balance_count += 1
-                    
-                    if user_data.get('voice_enabled', False):
-                        voice_enabled_count += 1
-            
-            # Вычисляем средний баланс
-            avg_credits = round(total_credits / user_count, 2) if user_count > 0 else 0
             voice_percentage = round(voice_enabled_count/user_count*100, 1) if user_count > 0 else 0
             
             if user_language == 'ru':
@@ -116,13 +123,94 @@ def register_handlers(application, supabase):
             await update.message.reply_text(stats_message, parse_mode='Markdown')
             
         except Exception as e:
-            if user_language == 'ru':
-                error_msg = f"❌ Ошибка при получении статистики: {e}"
-            elif user_language == 'pl':
-                error_msg = f"❌ Błąd podczas pobierania statystyk: {e}"
-            else:
-                error_msg = f"❌ Error getting statistics: {e}"
-            await update.message.reply_text(error_msg)
+            await reply_stats_error(e)
+
+    @admin_only
+    async def metrics_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user_id = update.effective_user.id
+        user_language = await db.get_user_language(supabase, user_id)
+        
+        sections = [
+            get_text(user_language, 'admin_metrics_title'),
+            registry.format_summary(DB_FUNCTION_METRICS),
+            registry.format_summary(DB_QUERY_METRICS),
+            registry.format_summary(UPSTREAM_QUEUE_METRICS),
+            registry.format_summary(UPSTREAM_CALL_METRICS),
+            registry.format_summary(STREAM_TTFT_METRICS),
+            registry.format_summary(STREAM_RENDER_METRICS),
+            registry.format_summary(GATEWAY_QUEUE_METRICS),
+            registry.format_summary(ROUTER_METRICS)
+        ]
+        
+        rejected = registry.counters.get(UPSTREAM_REJECTED_METRICS, {})
+        sections.append("upstream: " + " ".join(
+            f"{name}={stats['active']}/{stats['max_concurrent']} waiting={stats['waiting']}/{stats['max_waiting']} "
+            f"rejected={rejected.get(name, 0)};"
+            for name, stats in get_upstream_stats().items()
+        ))
+        
+        telegram_retry_after = registry.counters.get(GATEWAY_RETRY_AFTER_METRICS, {})
+        sections.append("telegram: " + " ".join(
+            f"{lane} waiting={waiting} retry_after={telegram_retry_after.get(lane, 0)};"
+            for lane, waiting in get_gateway_stats().items()
+        ))
+        
+        retries = registry.counters.get(UPSTREAM_RETRY_METRICS, {})
+        breaker_lines = [
+            f"  {name}: {stats['state']} failures={stats['failures']} opened={stats['times_opened']} retries={retries.get(name, 0)}"
+            for name, stats in get_breaker_stats().items()
+        ]
+        if breaker_lines:
+            sections.append("breakers:\n" + "\n".join(breaker_lines))
+        
+        stream_recovery = registry.counters.get(STREAM_RECOVERY_METRICS)
+        if stream_recovery:
+            sections.append("stream_recovery: " + " ".join(f"{name}={count}" for name, count in stream_recovery.items()))
+        
+        stream_render = registry.counters.get(STREAM_RENDER_METRICS)
+        if stream_render:
+            responses = stream_render.get("responses", 0)
+            edits_per_response = stream_render.get("edits", 0) / responses if responses else 0
+            sections.append(
+                f"stream_render: responses={responses} edits_per_response={edits_per_response:.1f} "
+                f"retry_after={stream_render.get('retry_after', 0)}"
+            )
+        
+        stream_hedge = registry.counters.get(STREAM_HEDGE_METRICS)
+        if stream_hedge:
+            sections.append("stream_hedge: " + " ".join(f"{name}={count}" for name, count in stream_hedge.items()))
+        
+        cache_stats = db.get_profile_cache_stats()
+        sections.append(
+            f"profile_cache: hits={cache_stats['hits']} misses={cache_stats['misses']} "
+            f"hit_ratio={cache_stats['hit_ratio']} size={cache_stats['size']}/{cache_stats['max_size']}"
+        )
+        
+        response_cache_stats = db.get_response_cache_stats()
+        sections.append(
+            f"response_cache: hits={response_cache_stats['hits']} persistent_hits={response_cache_stats['persistent_hits']} "
+            f"misses={response_cache_stats['misses']} hit_ratio={response_cache_stats['hit_ratio']} "
+            f"size={response_cache_stats['size']}/{response_cache_stats['max_size']}"
+        )
+        
+        write_behind_stats = db.get_write_behind_stats()
+        if write_behind_stats:
+            sections.append(
+                f"write_behind: depth={write_behind_stats['depth']}/{write_behind_stats['max_size']} "
+                f"flushes={write_behind_stats['flushes']} avg={write_behind_stats['avg_flush_ms']}ms "
+                f"max={write_behind_stats['max_flush_ms']}ms rejected={write_behind_stats['rejected']}"
+            )
+        
+        summarizer_stats = db.get_summarizer_stats()
+        if summarizer_stats:
+            sections.append(
+                f"summarizer: queued={summarizer_stats['queued']} checks={summarizer_stats['checks']} "
+                f"folds={summarizer_stats['folds']} folded_messages={summarizer_stats['folded_messages']} "
+                f"errors={summarizer_stats['errors']}"
+            )
+        
+        # Без Markdown: в именах функций есть подчеркивания
+        await update.message.reply_text("\n\n".join(sections)[:4000])
 
     @admin_only
     async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -135,20 +223,42 @@ def register_handlers(application, supabase):
             await update.message.reply_text(error_message)
             return
             
-        user_ids = await db.get_all_user_ids(supabase)
-        start_message = get_text(user_language, 'admin_broadcast_start', count=len(user_ids))
+        # ОБНОВЛЕНО: Пользователи читаются постранично, а не одним запросом
+        user_count = await db.count_users(supabase)
+        start_message = get_text(user_language, 'admin_broadcast_start', count=user_count)
         await update.message.reply_text(start_message)
         
+        # ИСПРАВЛЕНО: Рассылка идет фоновой задачей - обработчик сразу освобождается, и рассылка
+        # (минуты при тысячах пользователей) не задерживает обработку других обновлений
+        context.application.create_task(
+            run_broadcast(update, context, message_to_send, user_language), update=update
+        )
+
+    async def run_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, message_to_send, user_language):
+        """Отправляет сообщение всем пользователям и сообщает администратору итог."""
         success_count, fail_count = 0, 0
-        for target_user_id in user_ids:
-            try:
-                await context.bot.send_message(chat_id=target_user_id, text=message_to_send)
-                success_count += 1
-                await asyncio.sleep(0.1)
-            except Exception as e:
-                fail_count += 1
-                print(f"Не удалось отправить сообщение {target_user_id}: {e}")
-                
+        last_user_id = None
+        try:
+            async for user_row in db.iter_users(supabase):
+                target_user_id = user_row['user_id']
+                last_user_id = target_user_id
+                try:
+                    # ОБНОВЛЕНО: Темп рассылки задает шлюз (низший приоритет), а не пауза здесь
+                    await context.bot.send_message(chat_id=target_user_id, text=message_to_send, rate_limit_args=LANE_BROADCAST)
+                    success_count += 1
+                except Exception as e:
+                    fail_count += 1
+                    print(f"Не удалось отправить сообщение {target_user_id}: {e}")
+        except Exception as e:
+            # Список пользователей не удалось дочитать - сообщаем, докуда дошла рассылка
+            print(f"❌ Рассылка прервана после пользователя {last_user_id}: {e}")
+            interrupted_message = get_text(
+                user_language, 'admin_broadcast_interrupted',
+                success=success_count, failed=fail_count, last_user_id=last_user_id
+            )
+            await update.message.reply_text(interrupted_message)
+            return
+
         complete_message = get_text(user_language, 'admin_broadcast_complete', success=success_count, failed=fail_count)
         await update.message.reply_text(complete_message)
 
@@ -205,7 +315,7 @@ def register_handlers(application, supabase):
                     amount=amount, balance=new_balance
                 )
                 
-                await context.bot.send_message(chat_id=target_user_id, text=user_message, parse_mode='Markdown')
+                await context.bot.send_message(chat_id=target_user_id, text=user_message, parse_mode='Markdown', rate_limit_args=LANE_NOTIFICATION)
                 
             except Exception as e:
                 notification_failed = get_text(user_language, 'admin_notification_failed', error=e)
@@ -299,7 +409,7 @@ def register_handlers(application, supabase):
                     if new_balance < 0:
                         user_message += f"\n\n{get_text(target_user_language, 'admin_user_balance_negative')}"
                     
-                    await context.bot.send_message(chat_id=target_user_id, text=user_message, parse_mode='Markdown')
+                    await context.bot.send_message(chat_id=target_user_id, text=user_message, parse_mode='Markdown', rate_limit_args=LANE_NOTIFICATION)
                     
                 except Exception as e:
                     notification_failed = get_text(user_language, 'admin_notification_failed', error=e)
@@ -490,6 +600,7 @@ def register_handlers(application, supabase):
 
     application.add_handler(CommandHandler("admin", admin_command))
     application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("metrics", metrics_command))
     application.add_handler(CommandHandler("broadcast", broadcast_command))
     application.add_handler(CommandHandler("add_credits", add_credits_command))
     application.add_handler(CommandHandler("remove_credits", remove_credits_command))
@@ -5,6 +5,7 @@ from telegram.ext import ContextTypes, CommandHandler
 from database import db
 from config import REFERRAL_BONUS_INVITER, REFERRAL_BONUS_NEW_USER
 from translations import get_text
+from telegram_gateway import LANE_NOTIFICATION
 
 # ИСПРАВЛЕНО: Принимаем клиент supabase
 def register_handlers(application, supabase):
@@ -112,7 +113,8 @@ def register_handlers(application, supabase):
                 
                 await context.bot.send_message(
                     chat_id=inviter_id,
-                    text=notification_message
+                    text=notification_message,
+                    rate_limit_args=LANE_NOTIFICATION
                 )
             except Exception as e:
                 print(f"Не удалось отправить уведомление пригласившему {inviter_id}: {e}")
@@ -1,14 +1,58 @@
 # handlers/message_handlers.py
 
+import asyncio
 from telegram import Update
 from telegram.ext import ContextTypes, MessageHandler, filters
-from openai import OpenAI
-from config import CHAT_MODES, MESSAGE_COST, IMAGE_COST
+from openai import AsyncOpenAI
+from config import CHAT_MODES, MESSAGE_COST, IMAGE_COST, MESSAGE_DEBOUNCE_SECONDS, RESPONSE_CACHE_MODES
 from database import db
 from translations import get_text
+import upstream
+from upstream import UpstreamBusy
+from router import router
+
+# Ключ в context.chat_data для сообщений, ожидающих общего ответа
+PENDING_TURN_KEY = "pending_turn"
+
+class PendingTurn:
+    """Сообщения чата, на которые еще не ответили (при MESSAGE_DEBOUNCE_SECONDS > 0)."""
+    
+    def __init__(self):
+        self.texts = []
+        self.answering = 0  # Сколько первых сообщений из texts вошло в генерируемый ответ
+        self.task = None
+    
+    def mark_answered(self):
+        del self.texts[:self.answering]
+        self.answering = 0
+
+async def save_turn(context: ContextTypes.DEFAULT_TYPE, supabase, chat_id, user_text, ai_response_text):
+    """Списывает кредиты и сохраняет ход в историю. Отмена задачи (новое сообщение) запись не прерывает."""
+    pending = context.chat_data.get(PENDING_TURN_KEY)
+    if pending:
+        pending.mark_answered()
+    
+    async def write():
+        await db.deduct_user_credits(supabase, chat_id, MESSAGE_COST)
+        await db.append_turn(supabase, chat_id, [
+            {"role": "user", "content": user_text},
+            {"role": "assistant", "content": ai_response_text}
+        ])
+    
+    await asyncio.shield(write())
+
+async def save_turn_and_reply(update: Update, context: ContextTypes.DEFAULT_TYPE, supabase, chat_id, user_text, ai_response_text):
+    """Сохраняет ход и отправляет ответ. Отмена задачи во время записи ответ не теряет: он уже оплачен."""
+    async def save_and_reply():
+        await save_turn(context, supabase, chat_id, user_text, ai_response_text)
+        await update.message.reply_text(ai_response_text)
+    
+    # ИСПРАВЛЕНО: Новое сообщение может отменить задачу уже после списания кредитов - тогда
+    # CancelledError поднимается дальше, но ответ все равно отправляется после записи
+    await asyncio.shield(save_and_reply())
 
 # ИСПРАВЛЕНО: Принимаем supabase
-async def generate_image(update: Update, context: ContextTypes.DEFAULT_TYPE, client: OpenAI, supabase):
+async def generate_image(update: Update, context: ContextTypes.DEFAULT_TYPE, client: AsyncOpenAI, supabase):
     chat_id = update.effective_chat.id
     prompt = update.message.text
     
@@ -24,12 +68,16 @@ async def generate_image(update: Update, context: ContextTypes.DEFAULT_TYPE, cli
 
     await context.bot.send_chat_action(chat_id=chat_id, action='upload_photo')
     try:
-        response = client.images.generate(model="dall-e-3", prompt=prompt, size="1024x1024", quality="standard", n=1)
+        response = await upstream.call("image", "dall-e-3", lambda: client.images.generate(
+            model="dall-e-3", prompt=prompt, size="1024x1024", quality="standard", n=1
+        ))
         image_url = response.data[0].url
         await db.deduct_user_credits(supabase, chat_id, IMAGE_COST)
         
         success_message = get_text(user_language, 'image_ready', cost=IMAGE_COST)
         await update.message.reply_photo(photo=image_url, caption=success_message)
+    except UpstreamBusy:
+        await update.message.reply_text(get_text(user_language, 'upstream_busy'))
     except Exception as e:
         print(f"Ошибка DALL-E: {e}")
         error_message = get_text(user_language, 'image_error')
@@ -37,24 +85,39 @@ async def generate_image(update: Update, context: ContextTypes.DEFAULT_TYPE, cli
     finally:
         await db.set_user_state(supabase, chat_id, "chat")
 
-async def chat_with_ai(update: Update, context: ContextTypes.DEFAULT_TYPE, client: OpenAI, supabase):
+async def chat_with_ai(update: Update, context: ContextTypes.DEFAULT_TYPE, client: AsyncOpenAI, supabase, message_text: str = None):
     chat_id = update.effective_chat.id
-    message_text = update.message.text
+    # НОВОЕ: При объединении сообщений текст хода собирается из нескольких сообщений
+    message_text = message_text or update.message.text
     
-    # Получаем язык пользователя
-    user_language = await db.get_user_language(supabase, chat_id)
+    # ОБНОВЛЕНО: Профиль, кредиты и история приходят одним запросом
+    turn = await db.get_turn_context(supabase, chat_id)
+    if not turn:
+        user_language = await db.get_user_language(supabase, chat_id)
+        await update.message.reply_text(get_text(user_language, 'chat_error'))
+        return
     
-    current_credits = await db.get_user_credits(supabase, chat_id)
+    user_language = turn.get('interface_language', 'en')
+    
+    current_credits = turn.get('credits', 0)
     if current_credits < MESSAGE_COST:
         error_message = get_text(user_language, 'insufficient_credits_chat', cost=MESSAGE_COST)
         await update.message.reply_text(error_message)
         return
 
-    user = await db.get_user_data(supabase, chat_id)
-    current_mode_name = user['mode']
-    current_model = user['model']
-    streaming_enabled = user.get('streaming_enabled', True)
-    history = await db.get_user_history(supabase, chat_id)
+    current_mode_name = turn['mode']
+    current_model = turn['model']
+    streaming_enabled = turn.get('streaming_enabled', True)
+    history = turn['history']
+    
+    # НОВОЕ: В режиме «Переводчик» повторный текст отдаем из кэша, без запроса к OpenAI
+    cache_key = None
+    if current_mode_name in RESPONSE_CACHE_MODES:
+        cache_key = db.make_response_cache_key(message_text, current_mode_name, user_language, current_model)
+        cached_response = await db.get_cached_response(supabase, cache_key)
+        if cached_response:
+            await save_turn_and_reply(update, context, supabase, chat_id, message_text, cached_response)
+            return
     
     # ОБНОВЛЕНО: Используем многоязычный системный промпт
     from config import get_system_prompt
@@ -62,15 +125,23 @@ async def chat_with_ai(update: Update, context: ContextTypes.DEFAULT_TYPE, clien
     
     messages_for_api = [{"role": "system", "content": system_prompt}] + history + [{"role": "user", "content": message_text}]
 
+    # НОВОЕ: Для модели «Auto» модель выбирается на каждый ход
+    decision = router.route(messages_for_api, current_mode_name, current_model)
+
     # НОВОЕ: Проверяем, включены ли потоковые ответы
     if streaming_enabled:
-        await chat_with_ai_streaming(update, context, client, supabase, messages_for_api, current_model, user_language, message_text)
+        ai_response_text = await chat_with_ai_streaming(update, context, client, supabase, messages_for_api, decision, user_language, message_text)
     else:
-        await chat_with_ai_regular(update, context, client, supabase, messages_for_api, current_model, user_language, message_text)
+        ai_response_text = await chat_with_ai_regular(update, context, client, supabase, messages_for_api, decision, user_language, message_text)
+    
+    if cache_key and ai_response_text:
+        await db.save_cached_response(supabase, cache_key, ai_response_text)
 
-async def chat_with_ai_streaming(update: Update, context: ContextTypes.DEFAULT_TYPE, client: OpenAI, supabase, messages_for_api, model, user_language, original_message):
-    """Обрабатывает чат с AI в потоковом режиме."""
+async def chat_with_ai_streaming(update: Update, context: ContextTypes.DEFAULT_TYPE, client: AsyncOpenAI, supabase, messages_for_api, decision, user_language, original_message):
+    """Обрабатывает чат с AI в потоковом режиме. Возвращает текст ответа или None при ошибке."""
     chat_id = update.effective_chat.id
+    streaming_handler = None
+    saved = False
     
     try:
         # Инициализируем потоковый ответ
@@ -81,11 +152,15 @@ async def chat_with_ai_streaming(update: Update, context: ContextTypes.DEFAULT_T
         success = await streaming_handler.start_streaming()
         if not success:
             # Fallback на обычный режим
-            await chat_with_ai_regular(update, context, client, supabase, messages_for_api, model, user_language, original_message)
-            return
+            return await chat_with_ai_regular(update, context, client, supabase, messages_for_api, decision, user_language, original_message)
         
-        # Получаем потоковый ответ от OpenAI
-        ai_response_text = await stream_openai_response(client, messages_for_api, model, streaming_handler)
+        # Получаем потоковый ответ от OpenAI (роутер учитывает время только этого запроса)
+        with router.measure(decision):
+            ai_response_text = await stream_openai_response(client, messages_for_api, decision.model, streaming_handler)
+        
+        # Списываем кредиты и сохраняем в историю (с этого момента ответ уже не отменяется)
+        saved = True
+        await save_turn(context, supabase, chat_id, original_message, ai_response_text)
         
         # Завершаем потоковый ответ
         await streaming_handler.finalize_message(
@@ -93,37 +168,61 @@ async def chat_with_ai_streaming(update: Update, context: ContextTypes.DEFAULT_T
             add_credits_info=True,
             credits_cost=MESSAGE_COST
         )
+        return ai_response_text
         
-        # Списываем кредиты и сохраняем в историю
-        await db.deduct_user_credits(supabase, chat_id, MESSAGE_COST)
-        await db.add_message_to_history(supabase, chat_id, "user", original_message)
-        await db.add_message_to_history(supabase, chat_id, "assistant", ai_response_text)
-        
+    except asyncio.CancelledError:
+        # Ответ вытеснен новым сообщением пользователя - убираем недописанное сообщение
+        if streaming_handler:
+            if saved:
+                # ИСПРАВЛЕНО: Ответ уже сохранен и оплачен - дописываем его полностью со строкой
+                # о списании, иначе в чате остается обрезанный текст без информации о кредитах
+                await asyncio.shield(streaming_handler.finalize_message(
+                    final_text=ai_response_text,
+                    add_credits_info=True,
+                    credits_cost=MESSAGE_COST
+                ))
+            else:
+                await streaming_handler.delete()
+        raise
+    except UpstreamBusy:
+        # Очередь к OpenAI заполнена - заменяем «Генерирую ответ...» на просьбу подождать
+        await streaming_handler.finalize_message(final_text=get_text(user_language, 'upstream_busy'), add_credits_info=False)
     except Exception as e:
+        # ОБНОВЛЕНО: Повторы и запасной запрос уже были внутри stream_openai_response -
+        # второй полный запрос не делаем, сообщаем об ошибке (кредиты не списаны)
         print(f"❌ Ошибка в потоковом режиме: {e}")
-        # Fallback на обычный режим
-        await chat_with_ai_regular(update, context, client, supabase, messages_for_api, model, user_language, original_message)
+        if streaming_handler:
+            await streaming_handler.finalize_message(final_text=get_text(user_language, 'chat_error'), add_credits_info=False)
 
-async def chat_with_ai_regular(update: Update, context: ContextTypes.DEFAULT_TYPE, client: OpenAI, supabase, messages_for_api, model, user_language, original_message):
-    """Обрабатывает чат с AI в обычном режиме."""
+async def chat_with_ai_regular(update: Update, context: ContextTypes.DEFAULT_TYPE, client: AsyncOpenAI, supabase, messages_for_api, decision, user_language, original_message):
+    """Обрабатывает чат с AI в обычном режиме. Возвращает текст ответа или None при ошибке."""
     chat_id = update.effective_chat.id
     
     await context.bot.send_chat_action(chat_id=chat_id, action='typing')
     try:
-        response = client.chat.completions.create(model=model, messages=messages_for_api)
+        with router.measure(decision):
+            response = await upstream.call("chat", decision.model, lambda: client.chat.completions.create(model=decision.model, messages=messages_for_api))
         ai_response_text = response.choices[0].message.content
         
-        await db.deduct_user_credits(supabase, chat_id, MESSAGE_COST)
-        await db.add_message_to_history(supabase, chat_id, "user", original_message)
-        await db.add_message_to_history(supabase, chat_id, "assistant", ai_response_text)
-        await update.message.reply_text(ai_response_text)
+        await save_turn_and_reply(update, context, supabase, chat_id, original_message, ai_response_text)
+        return ai_response_text
+    except UpstreamBusy:
+        await update.message.reply_text(get_text(user_language, 'upstream_busy'))
     except Exception as e:
         print(f"Ошибка OpenAI Chat: {e}")
         error_message = get_text(user_language, 'chat_error')
         await update.message.reply_text(error_message)
 
 # ИСПРАВЛЕНО: Принимаем client и supabase
-def register_handlers(application, client: OpenAI, supabase):
+def register_handlers(application, client: AsyncOpenAI, supabase):
+    async def answer_pending_turn(update: Update, context: ContextTypes.DEFAULT_TYPE, pending: PendingTurn):
+        """Ждет паузы в сообщениях и отвечает на все накопленные одним ходом."""
+        await asyncio.sleep(MESSAGE_DEBOUNCE_SECONDS)
+        pending.answering = len(pending.texts)
+        await chat_with_ai(update, context, client, supabase, message_text="\n".join(pending.texts))
+        # Ответ дан (или завершился ошибкой) - эти сообщения больше не ждут ответа
+        pending.mark_answered()
+    
     async def main_message_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         chat_id = update.effective_chat.id
         
@@ -137,6 +236,16 @@ def register_handlers(application, client: OpenAI, supabase):
         state = user.get("state", "chat")
         if state == "awaiting_image_prompt":
             await generate_image(update, context, client, supabase)
+        elif MESSAGE_DEBOUNCE_SECONDS > 0:
+            # НОВОЕ: Копим сообщения, пришедшие подряд, и отвечаем на них одним ходом
+            pending = context.chat_data.setdefault(PENDING_TURN_KEY, PendingTurn())
+            pending.texts.append(update.message.text)
+            if pending.task and not pending.task.done():
+                # Ожидающий или уже генерируемый ответ вытесняется новым, более полным
+                pending.task.cancel()
+            pending.task = context.application.create_task(
+                answer_pending_turn(update, context, pending), update=update
+            )
         else:
             await chat_with_ai(update, context, client, supabase)
             
@@ -4,15 +4,18 @@ import os
 import io
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, MessageHandler, filters, CommandHandler, CallbackQueryHandler
-from openai import OpenAI
+from openai import AsyncOpenAI
 from database import db
 from config import (
     VOICE_TO_TEXT_COST, TEXT_TO_VOICE_COST, MAX_VOICE_DURATION,
     AVAILABLE_VOICES, MESSAGE_COST
 )
 from translations import get_text
+import upstream
+from upstream import UpstreamBusy
+from router import router
 
-def register_handlers(application, openai_client: OpenAI, supabase):
+def register_handlers(application, openai_client: AsyncOpenAI, supabase):
     
     async def voice_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обрабатывает голосовые сообщения - распознавание речи."""
@@ -97,20 +100,22 @@ def register_handlers(application, openai_client: OpenAI, supabase):
             
             print("🤖 Отправляю в OpenAI Whisper...")
             # Распознаем речь через OpenAI Whisper
-            transcript = openai_client.audio.transcriptions.create(
-                model="whisper-1",
-                file=voice_bytes,
-                language=language,
-                response_format="text"
-            )
+            def transcribe():
+                # Файл читается заново при каждой попытке
+                voice_bytes.seek(0)
+                return openai_client.audio.transcriptions.create(
+                    model="whisper-1",
+                    file=voice_bytes,
+                    language=language,
+                    response_format="text"
+                )
             
-            print(f"✅ Распознано: {transcript}")
+            transcript = await upstream.call("whisper", "whisper-1", transcribe)
             
-            # Списываем кредиты за распознавание
-            await db.deduct_user_credits(supabase, user_id, VOICE_TO_TEXT_COST)
+            print(f"✅ Распознано: {transcript}")
             
-            # Обновляем статистику
-            await db.increment_voice_stats(supabase, user_id, "received")
+            # Списываем кредиты за распознавание и обновляем статистику одним запросом
+            await db.charge_voice_turn(supabase, user_id, VOICE_TO_TEXT_COST, received=1)
             
             # Отправляем результат распознавания
             recognition_message = get_text(
@@ -129,6 +134,10 @@ def register_handlers(application, openai_client: OpenAI, supabase):
                 # Обычный текстовый ответ через AI
                 await process_text_for_ai(update, context, openai_client, supabase, transcript, user_language)
                 
+        except UpstreamBusy:
+            # Сюда доходит только занятый Whisper - до списания за распознавание.
+            # После списания ответ генерируется в функциях ниже, и они пишут 'upstream_busy_voice'
+            await update.message.reply_text(get_text(user_language, 'upstream_busy'))
         except Exception as e:
             print(f"❌ ОШИБКА при распознавании речи: {e}")
             import traceback
@@ -137,18 +146,21 @@ def register_handlers(application, openai_client: OpenAI, supabase):
             await update.message.reply_text(error_message)
 
     async def generate_voice_response(update: Update, context: ContextTypes.DEFAULT_TYPE, 
-                                    openai_client: OpenAI, supabase, text: str, user_language: str):
+                                    openai_client: AsyncOpenAI, supabase, text: str, user_language: str):
         """Генерирует голосовой ответ на текст."""
         user_id = update.effective_user.id
         
         try:
-            # Получаем текстовый ответ от AI
-            user_data = await db.get_user_data(supabase, user_id)
+            # ОБНОВЛЕНО: Профиль и история приходят одним запросом
+            turn = await db.get_turn_context(supabase, user_id)
+            if not turn:
+                await update.message.reply_text(get_text(user_language, 'voice_generation_error'))
+                return
             
             # ОБНОВЛЕНО: Используем многоязычный системный промпт
             from config import get_system_prompt
-            system_prompt = get_system_prompt(user_data['mode'], user_language)
-            history = await db.get_user_history(supabase, user_id)
+            system_prompt = get_system_prompt(turn['mode'], user_language)
+            history = turn['history']
             
             messages_for_api = [
                 {"role": "system", "content": system_prompt}
@@ -158,46 +170,46 @@ def register_handlers(application, openai_client: OpenAI, supabase):
             
             print(f"🤖 Используем системный промпт на языке {user_language}: {system_prompt[:50]}...")
             
-            # Получаем ответ от AI
-            response = openai_client.chat.completions.create(
-                model=user_data['model'],
-                messages=messages_for_api,
-                max_tokens=500  # Ограничиваем для голосового ответа
-            )
+            # Получаем ответ от AI (для модели «Auto» модель выбирает роутер)
+            decision = router.route(messages_for_api, turn['mode'], turn['model'])
+            with router.measure(decision):
+                response = await upstream.call("chat", decision.model, lambda: openai_client.chat.completions.create(
+                    model=decision.model,
+                    messages=messages_for_api,
+                    max_tokens=500  # Ограничиваем для голосового ответа
+                ))
             
             ai_response = response.choices[0].message.content
             print(f"🤖 AI ответ: {ai_response[:50]}...")
             
             # Генерируем голосовой ответ
-            voice_settings = await db.get_user_voice_settings(supabase, user_id)
-            selected_voice = voice_settings.get('selected_voice', 'alloy')
+            selected_voice = turn.get('selected_voice') or 'alloy'
             
             generating_message = get_text(user_language, 'generating_voice_response')
             await update.message.reply_text(generating_message)
             
             # Создаем TTS через OpenAI
-            tts_response = openai_client.audio.speech.create(
+            tts_response = await upstream.call("tts", "tts-1", lambda: openai_client.audio.speech.create(
                 model="tts-1",
                 voice=selected_voice,
                 input=ai_response,
                 response_format="mp3"
-            )
+            ))
             
             # Конвертируем в BytesIO для отправки
             audio_data = io.BytesIO(tts_response.content)
             audio_data.name = "voice_response.mp3"
             audio_data.seek(0)
             
-            # Списываем кредиты за TTS и AI ответ
+            # Списываем кредиты за TTS и AI ответ и обновляем статистику одним запросом
             total_cost = TEXT_TO_VOICE_COST + MESSAGE_COST
-            await db.deduct_user_credits(supabase, user_id, total_cost)
+            await db.charge_voice_turn(supabase, user_id, total_cost, sent=1)
             
             # Сохраняем в историю
-            await db.add_message_to_history(supabase, user_id, "user", text)
-            await db.add_message_to_history(supabase, user_id, "assistant", ai_response)
-            
-            # Обновляем статистику
-            await db.increment_voice_stats(supabase, user_id, "sent")
+            await db.append_turn(supabase, user_id, [
+                {"role": "user", "content": text},
+                {"role": "assistant", "content": ai_response}
+            ])
             
             # Отправляем голосовое сообщение
             caption = get_text(user_language, 'voice_response_caption', cost=total_cost)
@@ -206,20 +218,25 @@ def register_handlers(application, openai_client: OpenAI, supabase):
                 caption=caption
             )
             
+        except UpstreamBusy:
+            await update.message.reply_text(get_text(user_language, 'upstream_busy_voice'))
         except Exception as e:
             print(f"Ошибка при генерации голосового ответа: {e}")
             error_message = get_text(user_language, 'voice_generation_error')
             await update.message.reply_text(error_message)
 
     async def process_text_for_ai(update: Update, context: ContextTypes.DEFAULT_TYPE,
-                                openai_client: OpenAI, supabase, text: str, user_language: str):
+                                openai_client: AsyncOpenAI, supabase, text: str, user_language: str):
         """Обрабатывает текст через AI (текстовый ответ на голосовое сообщение)."""
         user_id = update.effective_user.id
         
         try:
-            # Получаем настройки пользователя
-            user_data = await db.get_user_data(supabase, user_id)
-            current_credits = await db.get_user_credits(supabase, user_id)
+            # ОБНОВЛЕНО: Профиль, кредиты и история приходят одним запросом
+            turn = await db.get_turn_context(supabase, user_id)
+            if not turn:
+                await update.message.reply_text(get_text(user_language, 'text_response_error'))
+                return
+            current_credits = turn['credits']
             
             # Проверяем баланс для текстового ответа
             if current_credits < MESSAGE_COST:
@@ -234,10 +251,10 @@ def register_handlers(application, openai_client: OpenAI, supabase):
             
             # ОБНОВЛЕНО: Используем многоязычный системный промпт
             from config import get_system_prompt
-            current_mode_name = user_data['mode']
-            current_model = user_data['model']
-            streaming_enabled = user_data.get('streaming_enabled', True)
-            history = await db.get_user_history(supabase, user_id)
+            current_mode_name = turn['mode']
+            current_model = turn['model']
+            streaming_enabled = turn.get('streaming_enabled', True)
+            history = turn['history']
             system_prompt = get_system_prompt(current_mode_name, user_language)
             
             print(f"🤖 Используем системный промпт на языке {user_language}: {system_prompt[:50]}...")
@@ -245,12 +262,17 @@ def register_handlers(application, openai_client: OpenAI, supabase):
             # Формируем сообщения для API
             messages_for_api = [{"role": "system", "content": system_prompt}] + history + [{"role": "user", "content": text}]
 
+            # НОВОЕ: Для модели «Auto» модель выбирается на каждый ход
+            decision = router.route(messages_for_api, current_mode_name, current_model)
+            
             # НОВОЕ: Проверяем, включены ли потоковые ответы
             if streaming_enabled:
-                await process_text_streaming(update, context, openai_client, supabase, messages_for_api, current_model, user_language, text, user_id)
+                await process_text_streaming(update, context, openai_client, supabase, messages_for_api, decision, user_language, text, user_id)
             else:
-                await process_text_regular(update, context, openai_client, supabase, messages_for_api, current_model, user_language, text, user_id)
+                await process_text_regular(update, context, openai_client, supabase, messages_for_api, decision, user_language, text, user_id)
                 
+        except UpstreamBusy:
+            await update.message.reply_text(get_text(user_language, 'upstream_busy_voice'))
         except Exception as e:
             print(f"❌ ОШИБКА при генерации текстового ответа: {e}")
             import traceback
@@ -258,8 +280,9 @@ def register_handlers(application, openai_client: OpenAI, supabase):
             error_message = get_text(user_language, 'text_response_error')
             await update.message.reply_text(error_message)
 
-    async def process_text_streaming(update: Update, context: ContextTypes.DEFAULT_TYPE, openai_client: OpenAI, supabase, messages_for_api, model, user_language, original_text, user_id):
+    async def process_text_streaming(update: Update, context: ContextTypes.DEFAULT_TYPE, openai_client: AsyncOpenAI, supabase, messages_for_api, decision, user_language, original_text, user_id):
         """Обрабатывает текстовый ответ в потоковом режиме."""
+        streaming_handler = None
         try:
             # Инициализируем потоковый ответ
             from streaming import StreamingResponse, stream_openai_response
@@ -269,11 +292,12 @@ def register_handlers(application, openai_client: OpenAI, supabase):
             success = await streaming_handler.start_streaming()
             if not success:
                 # Fallback на обычный режим
-                await process_text_regular(update, context, openai_client, supabase, messages_for_api, model, user_language, original_text, user_id)
+                await process_text_regular(update, context, openai_client, supabase, messages_for_api, decision, user_language, original_text, user_id)
                 return
             
             # Получаем потоковый ответ от OpenAI
-            ai_response_text = await stream_openai_response(openai_client, messages_for_api, model, streaming_handler)
+            with router.measure(decision):
+                ai_response_text = await stream_openai_response(openai_client, messages_for_api, decision.model, streaming_handler)
             
             # Завершаем потоковый ответ
             await streaming_handler.finalize_message(
@@ -284,31 +308,43 @@ def register_handlers(application, openai_client: OpenAI, supabase):
             
             # Списываем кредиты и сохраняем в историю
             await db.deduct_user_credits(supabase, user_id, MESSAGE_COST)
-            await db.add_message_to_history(supabase, user_id, "user", original_text)
-            await db.add_message_to_history(supabase, user_id, "assistant", ai_response_text)
+            await db.append_turn(supabase, user_id, [
+                {"role": "user", "content": original_text},
+                {"role": "assistant", "content": ai_response_text}
+            ])
             
+        except UpstreamBusy:
+            await streaming_handler.finalize_message(final_text=get_text(user_language, 'upstream_busy_voice'), add_credits_info=False)
         except Exception as e:
+            # ОБНОВЛЕНО: Повторы уже были внутри stream_openai_response - второй полный запрос не делаем
             print(f"❌ Ошибка в потоковом режиме (голосовой): {e}")
-            # Fallback на обычный режим
-            await process_text_regular(update, context, openai_client, supabase, messages_for_api, model, user_language, original_text, user_id)
+            if streaming_handler:
+                await streaming_handler.finalize_message(final_text=get_text(user_language, 'text_response_error'), add_credits_info=False)
+        finally:
+            # ИСПРАВЛЕНО: При отмене хода (и любом другом выходе) фоновые правки не остаются висеть
+            if streaming_handler:
+                await streaming_handler.close()
 
-    async def process_text_regular(update: Update, context: ContextTypes.DEFAULT_TYPE, openai_client: OpenAI, supabase, messages_for_api, model, user_language, original_text, user_id):
+    async def process_text_regular(update: Update, context: ContextTypes.DEFAULT_TYPE, openai_client: AsyncOpenAI, supabase, messages_for_api, decision, user_language, original_text, user_id):
         """Обрабатывает текстовый ответ в обычном режиме."""
         await context.bot.send_chat_action(chat_id=user_id, action='typing')
         
         # Получаем ответ от AI
-        response = openai_client.chat.completions.create(
-            model=model, 
-            messages=messages_for_api
-        )
+        with router.measure(decision):
+            response = await upstream.call("chat", decision.model, lambda: openai_client.chat.completions.create(
+                model=decision.model, 
+                messages=messages_for_api
+            ))
         ai_response_text = response.choices[0].message.content
         
         print(f"🤖 AI ответ: {ai_response_text[:50]}...")
         
         # Списываем кредиты и сохраняем в историю
         await db.deduct_user_credits(supabase, user_id, MESSAGE_COST)
-        await db.add_message_to_history(supabase, user_id, "user", original_text)
-        await db.add_message_to_history(supabase, user_id, "assistant", ai_response_text)
+        await db.append_turn(supabase, user_id, [
+            {"role": "user", "content": original_text},
+            {"role": "assistant", "content": ai_response_text}
+        ])
         
         # Отправляем ответ
         response_message = f"{ai_response_text}\n\n💰 {get_text(user_language, 'recognized_text', text='', cost=MESSAGE_COST).split('💰')[1].strip()}"
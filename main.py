@@ -1,15 +1,21 @@
 # main.py
 
-from openai import OpenAI
+from openai import AsyncOpenAI
 from telegram.ext import Application
 from telegram import BotCommandScopeAllPrivateChats
 import asyncio
 import logging
 
 import config
+import metrics
 from database import db
-# ПРАВИЛЬНЫЙ ОФИЦИАЛЬНЫЙ ИМПОРТ
-from supabase import acreate_client, AsyncClient
+from database.write_behind import WriteBehindQueue
+from summarizer import ConversationSummarizer
+from database.storage import create_storage_client, close_storage_client
+from database.instrumentation import DB_FUNCTION_METRICS, DB_QUERY_METRICS
+from upstream import UPSTREAM_QUEUE_METRICS, UPSTREAM_CALL_METRICS
+from telegram_gateway import gateway, GATEWAY_QUEUE_METRICS
+from update_processor import PerChatUpdateProcessor
 from handlers import common_handlers, message_handlers, menu_handler, admin_handlers, profile_handler, voice_handler
 
 logging.basicConfig(
@@ -84,14 +90,47 @@ async def setup_bot_commands(application):
 async def main() -> None:
     """Основная функция, которая настраивает и запускает бота."""
     
-    # Создаем асинхронный клиент Supabase ПРАВИЛЬНЫМ СПОСОБОМ
-    supabase_client: AsyncClient = await acreate_client(config.SUPABASE_URL, config.SUPABASE_KEY)
-    logger.info("Подключение к Supabase (async) успешно установлено.")
+    # ОБНОВЛЕНО: Клиент хранилища (Supabase или локальный SQLite, см. STORAGE_BACKEND)
+    supabase_client = await create_storage_client()
+    logger.info(f"Подключение к хранилищу ({config.STORAGE_BACKEND}) успешно установлено.")
     
-    # Создаем клиент OpenAI
-    openai_client = OpenAI(api_key=config.OPENAI_API_KEY)
+    # НОВОЕ: Очередь отложенных записей - некритичные записи уходят в БД в фоне
+    write_behind = WriteBehindQueue(
+        supabase_client,
+        max_size=config.WRITE_BEHIND_QUEUE_SIZE,
+        batch_size=config.WRITE_BEHIND_BATCH_SIZE,
+        flush_interval=config.WRITE_BEHIND_FLUSH_INTERVAL
+    )
+    db.set_write_behind(write_behind)
     
-    application = Application.builder().token(config.TELEGRAM_TOKEN).build()
+    # Создаем клиент OpenAI. Повторы, дедлайны и автоматы защиты - в upstream.py, поэтому
+    # встроенные повторы SDK выключены, чтобы не умножать попытки
+    openai_client = AsyncOpenAI(api_key=config.OPENAI_API_KEY, max_retries=0)
+    
+    # НОВОЕ: Фоновое сжатие длинной истории в краткое содержание
+    summarizer = ConversationSummarizer(
+        supabase_client,
+        openai_client,
+        threshold=config.SUMMARY_THRESHOLD_MESSAGES,
+        keep_recent=config.SUMMARY_KEEP_RECENT,
+        batch_size=config.SUMMARY_BATCH_MESSAGES,
+        model=config.SUMMARY_MODEL,
+        max_tokens=config.SUMMARY_MAX_TOKENS,
+        check_interval=config.SUMMARY_CHECK_INTERVAL
+    )
+    if config.SUMMARY_ENABLED:
+        db.set_summarizer(summarizer)
+    
+    # НОВОЕ: Все исходящие запросы к Telegram идут через общий шлюз с приоритетами.
+    # Обновления разных чатов обрабатываются параллельно: без этого PTB обрабатывает их по одному,
+    # и пользователь, ждущий DALL-E или ответ модели, задерживает всех остальных
+    application = (
+        Application.builder()
+        .token(config.TELEGRAM_TOKEN)
+        .rate_limiter(gateway)
+        .concurrent_updates(PerChatUpdateProcessor(config.CONCURRENT_UPDATES))
+        .build()
+    )
 
     # Регистрируем все обработчики, передавая им нужные клиенты
     common_handlers.register_handlers(application, supabase_client)
@@ -101,9 +140,17 @@ async def main() -> None:
     profile_handler.register_handlers(application, supabase_client)
     voice_handler.register_handlers(application, openai_client, supabase_client)
 
+    # НОВОЕ: Периодическая сводка метрик запросов к БД и OpenAI в лог
+    metrics_task = asyncio.create_task(
+        metrics.registry.log_periodically(config.METRICS_LOG_INTERVAL, [DB_FUNCTION_METRICS, DB_QUERY_METRICS, UPSTREAM_QUEUE_METRICS, UPSTREAM_CALL_METRICS, GATEWAY_QUEUE_METRICS])
+    )
+
     try:
         logger.info("Запуск бота...")
         await application.initialize()
+        write_behind.start()
+        if config.SUMMARY_ENABLED:
+            summarizer.start()
         
         # НОВОЕ: Настраиваем многоязычное меню команд
         await setup_bot_commands(application)
@@ -118,9 +165,18 @@ async def main() -> None:
     except (KeyboardInterrupt, SystemExit):
         logger.info("Остановка бота...")
     finally:
+        metrics_task.cancel()
+        try:
+            await metrics_task
+        except asyncio.CancelledError:
+            pass
         await application.updater.stop()
         await application.stop()
         await application.shutdown()
+        await summarizer.stop()
+        # Записываем в БД всё, что осталось в очереди
+        await write_behind.stop()
+        await close_storage_client(supabase_client)
         logger.info("Бот успешно остановлен.")
 
 
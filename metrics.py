@@ -0,0 +1,113 @@
+# metrics.py
+
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограммы задержек (миллисекунды)
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+
+class LatencyStats:
+    """Счетчики вызовов, ошибок и гистограмма задержек для одной операции."""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def observe(self, elapsed_ms: float, error: bool = False):
+        self.count += 1
+        if error:
+            self.errors += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        for index, bound in enumerate(LATENCY_BUCKETS_MS):
+            if elapsed_ms <= bound:
+                self.buckets[index] += 1
+                return
+        self.buckets[-1] += 1
+
+    def percentile(self, q: float) -> float:
+        """Оценка перцентиля по гистограмме (верхняя граница корзины)."""
+        if not self.count:
+            return 0.0
+        threshold = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if seen >= threshold:
+                return float(LATENCY_BUCKETS_MS[index]) if index < len(LATENCY_BUCKETS_MS) else self.max_ms
+        return self.max_ms
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "total_ms": round(self.total_ms, 1),
+            "avg_ms": round(self.total_ms / self.count, 1) if self.count else 0.0,
+            "p50_ms": self.percentile(0.5),
+            "p95_ms": self.percentile(0.95),
+            "max_ms": round(self.max_ms, 1),
+            "buckets": dict(zip([f"le_{bound}" for bound in LATENCY_BUCKETS_MS] + ["inf"], self.buckets)),
+        }
+
+
+class MetricsRegistry:
+    """Реестр метрик процесса: задержки по группам операций и простые счетчики."""
+
+    def __init__(self):
+        self.latencies = {}  # group -> {name: LatencyStats}
+        self.counters = {}   # group -> {name: int}
+        self.started_at = time.time()
+
+    def observe(self, group: str, name: str, elapsed_ms: float, error: bool = False):
+        stats = self.latencies.setdefault(group, {}).get(name)
+        if stats is None:
+            stats = self.latencies[group][name] = LatencyStats()
+        stats.observe(elapsed_ms, error)
+
+    def increment(self, group: str, name: str, amount: int = 1):
+        group_counters = self.counters.setdefault(group, {})
+        group_counters[name] = group_counters.get(name, 0) + amount
+
+    def snapshot(self):
+        """Все метрики в виде словаря (для экспорта)."""
+        return {
+            "uptime_s": round(time.time() - self.started_at),
+            "latencies": {
+                group: {name: stats.snapshot() for name, stats in entries.items()}
+                for group, entries in self.latencies.items()
+            },
+            "counters": {group: dict(entries) for group, entries in self.counters.items()},
+        }
+
+    def format_summary(self, group: str, top: int = 10) -> str:
+        """Текстовая сводка по группе: самые тяжелые операции по суммарному времени."""
+        entries = self.latencies.get(group, {})
+        if not entries:
+            return f"{group}: нет данных"
+
+        lines = [f"{group}:"]
+        ranked = sorted(entries.items(), key=lambda item: item[1].total_ms, reverse=True)
+        for name, stats in ranked[:top]:
+            lines.append(
+                f"  {name}: n={stats.count} err={stats.errors} "
+                f"avg={stats.total_ms / stats.count:.0f}ms p95≤{stats.percentile(0.95):.0f}ms "
+                f"max={stats.max_ms:.0f}ms total={stats.total_ms / 1000:.1f}s"
+            )
+        return "\n".join(lines)
+
+    async def log_periodically(self, interval: float, groups):
+        """Периодически пишет сводку метрик в лог (запускается из main.main())."""
+        while True:
+            await asyncio.sleep(interval)
+            for group in groups:
+                logger.info("📈 Метрики\n" + self.format_summary(group))
+
+
+registry = MetricsRegistry()
@@ -0,0 +1,100 @@
+# router.py
+
+import logging
+import time
+from contextlib import contextmanager
+from config import (
+    ROUTER_MODEL_ID, ROUTER_SMALL_MODEL, ROUTER_LARGE_MODEL, ROUTER_MODE_MODELS,
+    ROUTER_SHORT_MESSAGE_TOKENS, ROUTER_LONG_PROMPT_TOKENS, ROUTER_LATENCY_LIMIT_MS, ROUTER_LATENCY_ALPHA
+)
+from metrics import registry
+from tokens import count_tokens, estimate_tokens
+
+# Отдельный логгер: по строкам решений с фактической задержкой настраиваются пороги
+logger = logging.getLogger("router")
+
+# Группа метрик: задержка ответа по паре «модель причина»
+ROUTER_METRICS = "router"
+
+
+class RouteDecision:
+    """Выбранная модель и причина выбора для одного хода."""
+
+    def __init__(self, model: str, reason: str, mode: str, prompt_tokens: int, message_tokens: int):
+        self.model = model
+        self.reason = reason
+        self.mode = mode
+        self.prompt_tokens = prompt_tokens
+        self.message_tokens = message_tokens
+
+
+class ModelRouter:
+    """
+    Выбор модели на каждый ход для пользователей с моделью «auto». Правила по порядку:
+    режим с закрепленной моделью, короткое сообщение - маленькая модель, длинный промпт -
+    большая, иначе большая, если ее средняя задержка (EWMA) не вышла за предел.
+    """
+
+    # При выборе по задержке каждый PROBE_EVERY-й ход все равно идет в большую модель,
+    # иначе ее EWMA перестанет обновляться и маленькая модель закрепится навсегда
+    PROBE_EVERY = 20
+
+    def __init__(self):
+        self.latency_ewma = {}  # model -> мс
+        self.latency_skips = 0
+
+    def route(self, messages_for_api, mode: str, requested_model: str) -> RouteDecision:
+        message_tokens = count_tokens(messages_for_api[-1]["content"]) if messages_for_api else 0
+        prompt_tokens = sum(estimate_tokens(message["content"]) for message in messages_for_api)
+
+        if requested_model != ROUTER_MODEL_ID:
+            # Пользователь выбрал модель сам - не спорим
+            return RouteDecision(requested_model, "user_choice", mode, prompt_tokens, message_tokens)
+
+        if mode in ROUTER_MODE_MODELS:
+            model, reason = ROUTER_MODE_MODELS[mode], "mode"
+        elif message_tokens <= ROUTER_SHORT_MESSAGE_TOKENS:
+            model, reason = ROUTER_SMALL_MODEL, "short_message"
+        elif prompt_tokens >= ROUTER_LONG_PROMPT_TOKENS:
+            model, reason = ROUTER_LARGE_MODEL, "long_prompt"
+        elif self.latency_ewma.get(ROUTER_LARGE_MODEL, 0) > ROUTER_LATENCY_LIMIT_MS:
+            self.latency_skips += 1
+            if self.latency_skips % self.PROBE_EVERY == 0:
+                model, reason = ROUTER_LARGE_MODEL, "probe"
+            else:
+                model, reason = ROUTER_SMALL_MODEL, "latency"
+        else:
+            model, reason = ROUTER_LARGE_MODEL, "default"
+        return RouteDecision(model, reason, mode, prompt_tokens, message_tokens)
+
+    def record(self, decision: RouteDecision, latency_ms: float, success: bool = True):
+        """Запоминает фактическую задержку ответа и пишет решение в лог."""
+        if success:
+            previous = self.latency_ewma.get(decision.model)
+            self.latency_ewma[decision.model] = latency_ms if previous is None else (
+                ROUTER_LATENCY_ALPHA * latency_ms + (1 - ROUTER_LATENCY_ALPHA) * previous
+            )
+        registry.observe(ROUTER_METRICS, f"{decision.model} {decision.reason}", latency_ms, not success)
+        logger.info(
+            "route mode=%s model=%s reason=%s prompt_tokens=%d message_tokens=%d latency_ms=%.0f success=%s",
+            decision.mode, decision.model, decision.reason, decision.prompt_tokens,
+            decision.message_tokens, latency_ms, success
+        )
+
+    @contextmanager
+    def measure(self, decision: RouteDecision):
+        """
+        Замеряет запрос к модели и передает задержку в record: with router.measure(decision): ...
+        Оборачивать нужно только вызов OpenAI - правки в Telegram, запись в БД и TTS сюда
+        не входят, иначе EWMA сравнивает модели по времени всего хода.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.record(decision, (time.perf_counter() - started) * 1000, False)
+            raise
+        self.record(decision, (time.perf_counter() - started) * 1000, True)
+
+
+router = ModelRouter()
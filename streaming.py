@@ -2,23 +2,126 @@
 
 import asyncio
 import time
+from collections import deque
 from telegram import Update
 from telegram.ext import ContextTypes
 from telegram.error import RetryAfter, BadRequest
 from translations import get_text
+from config import (
+    STREAM_IDLE_TIMEOUT, HEDGE_ENABLED, HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES, HEDGE_MIN_DELAY,
+    HEDGE_MAX_RATE, HEDGE_RATE_WINDOW, STREAM_EDIT_MIN_INTERVAL, STREAM_EDIT_MAX_INTERVAL, STREAM_EDIT_LENGTH_STEP
+)
+from metrics import registry
+from tokens import count_tokens
+from text_accumulator import TextAccumulator
+import upstream
+
+# Ограничение длины потокового ответа (токены)
+STREAM_MAX_TOKENS = 1000
+
+# Длина одного сообщения ответа (лимит Telegram 4096, запас для эмодзи и кредитов);
+# длинный ответ продолжается в следующем сообщении
+STREAM_MESSAGE_LIMIT = 4000
+
+# Просьба продолжить ответ, оборвавшийся на середине
+STREAM_CONTINUE_PROMPT = (
+    "Your previous reply was cut off. Continue it from exactly where it stopped: "
+    "do not repeat anything already written and do not add any preface."
+)
+
+# Счетчики восстановления оборвавшихся потоков: continued, continue_failed, regenerated
+STREAM_RECOVERY_METRICS = "stream.recovery"
+# Время до первого токена по моделям и счетчики хеджирования: hedged, primary_won, hedge_won, both_failed
+STREAM_TTFT_METRICS = "stream.ttft"
+STREAM_HEDGE_METRICS = "stream.hedge"
+# Правки сообщений: время до первого видимого текста и счетчики responses, edits, retry_after
+STREAM_RENDER_METRICS = "stream.render"
+
+class ChatEditBucket:
+    """
+    Ведро токенов правок одного чата (общее для всех потоковых ответов в этом чате).
+    В среднем одна правка за interval секунд; RetryAfter от Telegram блокирует правки
+    на указанное время и удваивает interval, успешные правки постепенно его уменьшают.
+    """
+    
+    def __init__(self):
+        self.interval = STREAM_EDIT_MIN_INTERVAL
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+    
+    def wait_time(self, text_length: int) -> float:
+        """Сколько секунд ждать до следующей правки сообщения длиной text_length."""
+        now = time.monotonic()
+        interval = self.interval * (1 + text_length / STREAM_EDIT_LENGTH_STEP)
+        self.tokens = min(1.0, self.tokens + (now - self.updated) / interval)
+        self.updated = now
+        return max(self.blocked_until - now, (1 - self.tokens) * interval, 0.0)
+    
+    async def acquire(self, text_length: int):
+        """Ждет, пока в ведре появится токен, и забирает его."""
+        while True:
+            delay = self.wait_time(text_length)
+            if delay <= 0:
+                self.tokens -= 1
+                return
+            await asyncio.sleep(delay)
+    
+    def on_success(self):
+        self.interval = max(STREAM_EDIT_MIN_INTERVAL, self.interval * 0.9)
+    
+    def on_retry_after(self, retry_after: float):
+        self.blocked_until = time.monotonic() + retry_after
+        self.interval = min(STREAM_EDIT_MAX_INTERVAL, self.interval * 2)
+        self.tokens = 0.0
+
+edit_buckets = {}  # chat_id -> ChatEditBucket
+
+def get_edit_bucket(chat_id) -> ChatEditBucket:
+    bucket = edit_buckets.get(chat_id)
+    if bucket is None:
+        # Не даем словарю расти бесконечно: ведра чатов, где давно не было правок, не нужны
+        if len(edit_buckets) > 10000:
+            now = time.monotonic()
+            for key in [key for key, old in edit_buckets.items() if now - old.updated > STREAM_EDIT_MAX_INTERVAL]:
+                del edit_buckets[key]
+        bucket = edit_buckets[chat_id] = ChatEditBucket()
+    return bucket
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
 
 class StreamingResponse:
-    """Класс для управления потоковыми ответами от AI."""
+    """
+    Класс для управления потоковыми ответами от AI.
+    
+    ОБНОВЛЕНО: update_message не ждет Telegram - он только дописывает буфер, а правки
+    отправляет отдельная задача, как только ведро правок чата позволяет (всегда последний текст).
+    
+    НОВОЕ: Ответ длиннее STREAM_MESSAGE_LIMIT продолжается в новом сообщении; правится только
+    последнее сообщение (текст буфера с offset), поэтому размер правки не растет с длиной ответа.
+    
+    ОБНОВЛЕНО: Буфер - TextAccumulator: кусок дописывается без копирования всего текста,
+    а границы слов и предложений для правок и переноса известны без повторного просмотра.
+    """
     
     def __init__(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user_language: str):
         self.update = update
         self.context = context
         self.user_language = user_language
         self.current_message = None
-        self.buffer = ""
-        self.last_update_time = 0
-        self.update_interval = 1.5  # Минимальный интервал между обновлениями (секунды)
+        self.messages = []  # Все сообщения ответа; последнее - current_message
+        self.offset = 0     # С какого символа буфера начинается текст current_message
+        self.buffer = TextAccumulator()
         self.final_message = ""
+        self.bucket = get_edit_bucket(update.effective_chat.id)
+        self.dirty = asyncio.Event()  # В буфере есть текст, которого еще нет в сообщении
+        self.flusher = None
+        self.shown_text = ""
+        self.started_at = time.perf_counter()
+        self.first_visible_at = None
+        self.edits = 0
         
     async def start_streaming(self, initial_text: str = None):
         """Инициализирует потоковый ответ."""
@@ -27,7 +130,7 @@ class StreamingResponse:
                 initial_text = get_text(self.user_language, 'streaming_thinking', default="🤖 Генерирую ответ...")
             
             self.current_message = await self.update.message.reply_text(initial_text)
-            self.last_update_time = time.time()
+            self.messages.append(self.current_message)
             print(f"🎬 Начат streaming для пользователя {self.update.effective_user.id}")
             return True
         except Exception as e:
@@ -35,24 +138,119 @@ class StreamingResponse:
             return False
     
     async def update_message(self, new_chunk: str, force_update: bool = False):
-        """Обновляет сообщение новым куском текста."""
+        """
+        Дописывает кусок текста; сообщение обновит фоновая задача. force_update оставлен
+        для совместимости: последний текст и так уходит, как только освободится правка.
+        """
         if not self.current_message:
             return False
             
-        self.buffer += new_chunk
-        current_time = time.time()
+        self.buffer.append(new_chunk)
+        self.dirty.set()
+        if self.flusher is None:
+            self.flusher = asyncio.create_task(self._flush_loop())
+        return True
+    
+    async def _flush_loop(self):
+        """Отправляет правки с последним текстом буфера, пока ответ не завершен."""
+        while True:
+            await self.dirty.wait()
+            await self.bucket.acquire(min(len(self.buffer) - self.offset, STREAM_MESSAGE_LIMIT))
+            self.dirty.clear()
+            if len(self.buffer) - self.offset > STREAM_MESSAGE_LIMIT:
+                await self._roll_over(self.buffer)
+                continue
+            # Показываем только целые слова: недописанное слово появится в следующей правке
+            text = self.buffer.text(self.offset, max(self.buffer.word_end, self.offset))
+            if not text.strip() or text == self.shown_text:
+                continue
+            result = await self._safe_update_message(text)
+            if result:
+                self._record_edit(text)
+            elif result is None:
+                # Telegram попросил подождать - текст отправим, когда ведро снова позволит
+                self.dirty.set()
+    
+    async def _roll_over(self, full_text: TextAccumulator) -> bool:
+        """Дописывает текущее сообщение до безопасной границы и начинает следующее."""
+        split = full_text.split_point(self.offset, STREAM_MESSAGE_LIMIT)
+        head = full_text.text(self.offset, split)
+        result = await self._safe_update_message(head)
+        if result is None:
+            # Telegram попросил подождать - перенесем, когда ведро снова позволит
+            self.dirty.set()
+            return False
+        if result:
+            self._record_edit(head)
         
-        # Обновляем только если прошло достаточно времени или принудительно
-        if force_update or (current_time - self.last_update_time) >= self.update_interval:
-            await self._safe_update_message(self.buffer)
-            self.last_update_time = current_time
+        tail = full_text.text(split, split + STREAM_MESSAGE_LIMIT)
+        try:
+            await self.bucket.acquire(len(tail))
+            message = await self.update.effective_chat.send_message(tail if tail.strip() else "…")
+        except Exception as e:
+            print(f"❌ Не удалось начать следующее сообщение ответа: {e}")
+            return False
+        self.messages.append(message)
+        self.current_message = message
+        self.offset = split
+        self.shown_text = tail
+        self.dirty.set()
+        return True
+    
+    async def delete(self):
+        """Удаляет все сообщения ответа (ответ вытеснен и не сохранен)."""
+        await self.close()
+        for message in self.messages:
+            try:
+                await message.delete()
+            except Exception as e:
+                print(f"❌ Не удалось удалить вытесненный ответ: {e}")
+        self.messages = []
+        self.current_message = None
+    
+    async def _reset_to_first_message(self):
+        """Финальный текст не продолжает показанный - удаляем продолжения и пишем заново с первого сообщения."""
+        for message in self.messages[1:]:
+            try:
+                await message.delete()
+            except Exception as e:
+                print(f"❌ Не удалось удалить продолжение ответа: {e}")
+        self.messages = self.messages[:1]
+        self.current_message = self.messages[0]
+        self.offset = 0
+        self.shown_text = ""
+    
+    async def close(self):
+        """Останавливает фоновые правки (после этого сообщение меняет только finalize_message)."""
+        if self.flusher is None:
+            return
+        self.flusher.cancel()
+        try:
+            await self.flusher
+        except asyncio.CancelledError:
+            pass
+        self.flusher = None
+    
+    def _record_edit(self, text: str):
+        self.shown_text = text
+        self.edits += 1
+        registry.increment(STREAM_RENDER_METRICS, "edits")
+        if self.first_visible_at is None:
+            self.first_visible_at = time.perf_counter()
+            registry.observe(STREAM_RENDER_METRICS, "first_visible_text", (self.first_visible_at - self.started_at) * 1000)
             
     async def finalize_message(self, final_text: str = None, add_credits_info: bool = True, credits_cost: int = 1):
         """Завершает потоковый ответ финальным сообщением."""
+        await self.close()
+        
         if final_text:
             self.final_message = final_text
         else:
-            self.final_message = self.buffer
+            self.final_message = self.buffer.text()
+        
+        if self.offset and not self.final_message.startswith(self.buffer.text(0, self.offset)):
+            # Ошибка или ответ, полученный заново, - заменяем им весь показанный текст
+            await self._reset_to_first_message()
             
         # Добавляем информацию о кредитах
         if add_credits_info and credits_cost > 0:
@@ -63,33 +261,46 @@ class StreamingResponse:
             )
             self.final_message += credits_text
             
-        # Финальное обновление
-        await self._safe_update_message(self.final_message)
-        print(f"✅ Streaming завершен для пользователя {self.update.effective_user.id}")
+        # Финальное обновление: оно должно дойти, поэтому после RetryAfter повторяем (не больше 3 раз);
+        # не поместившийся в текущее сообщение текст уходит в следующие
+        final_text = TextAccumulator(self.final_message)
+        failures = 0
+        result = False
+        while self.current_message and failures < 3:
+            tail = final_text.text(self.offset)
+            if len(tail) > STREAM_MESSAGE_LIMIT:
+                if not await self._roll_over(final_text):
+                    failures += 1
+                continue
+            await self.bucket.acquire(len(tail))
+            result = await self._safe_update_message(tail)
+            if result is not None:
+                break
+            failures += 1
+        if result:
+            self._record_edit(tail)
+        registry.increment(STREAM_RENDER_METRICS, "responses")
+        print(f"✅ Streaming завершен для пользователя {self.update.effective_user.id} ({self.edits} правок)")
         
     async def _safe_update_message(self, text: str):
-        """Безопасно обновляет сообщение с обработкой ошибок."""
+        """
+        Безопасно обновляет сообщение с обработкой ошибок. Возвращает True при успехе,
+        None - если Telegram попросил подождать (RetryAfter), False - при другой ошибке.
+        """
         if not self.current_message or not text.strip():
             return False
             
         try:
-            # Обрезаем текст до лимита Telegram (4096 символов)
-            if len(text) > 4000:  # Оставляем запас для эмодзи и кредитов
-                text = text[:4000] + "..."
-                
             await self.current_message.edit_text(text)
+            self.bucket.on_success()
             return True
             
         except RetryAfter as e:
-            # Telegram просит подождать
-            print(f"⏳ RetryAfter: ждем {e.retry_after} секунд")
-            await asyncio.sleep(e.retry_after + 0.1)
-            try:
-                await self.current_message.edit_text(text)
-                return True
-            except Exception as retry_error:
-                print(f"❌ Ошибка после RetryAfter: {retry_error}")
-                return False
+            # ОБНОВЛЕНО: Не ждем здесь - ведро правок чата само отложит следующую попытку
+            print(f"⏳ RetryAfter: правки чата {self.update.effective_chat.id} отложены на {e.retry_after} секунд")
+            self.bucket.on_retry_after(retry_after_seconds(e))
+            registry.increment(STREAM_RENDER_METRICS, "retry_after")
+            return None
                 
         except BadRequest as e:
             # Сообщение не изменилось или другая ошибка
@@ -114,54 +325,227 @@ async def stream_openai_response(openai_client, messages, model, streaming_handl
     
     Returns:
         str: Полный ответ от AI
+    
+    Raises:
+        UpstreamBusy: если очередь запросов к чату заполнена или автомат защиты разомкнут
+        Exception: ошибка OpenAI, если ответ не удалось получить и после повторов
+    """
+    # Место в очереди занято на весь поток, включая запасной обычный запрос
+    async with upstream.slot("chat"):
+        return await _stream_openai_response(openai_client, messages, model, streaming_handler)
+
+async def iterate_with_idle_timeout(stream, idle_timeout: float):
+    """Перебирает куски потока; если следующий кусок не пришел за idle_timeout - asyncio.TimeoutError."""
+    iterator = stream.__aiter__()
+    while True:
+        try:
+            chunk = await asyncio.wait_for(iterator.__anext__(), idle_timeout)
+        except StopAsyncIteration:
+            return
+        yield chunk
+
+async def _open_stream(openai_client, messages, model, max_tokens: int):
+    # Дедлайн до начала потока и повторы - в upstream.call_in_slot
+    return await upstream.call_in_slot("chat", model, lambda: openai_client.chat.completions.create(
+        model=model,
+        messages=messages,
+        stream=True,
+        max_tokens=max_tokens
+    ))
+
+async def _close_stream(stream):
+    close = getattr(stream, "close", None)
+    if close:
+        try:
+            await close()
+        except Exception as e:
+            print(f"❌ Ошибка при закрытии потока: {e}")
+
+class StartedStream:
+    """Открытый поток, из которого уже прочитан первый кусок текста."""
+    
+    def __init__(self, stream, chunks, first_text: str):
+        self.stream = stream
+        self.chunks = chunks
+        self.first_text = first_text
+
+async def _start_stream(openai_client, messages, model, max_tokens: int) -> StartedStream:
+    """Открывает поток и ждет первый кусок текста; время до него пишется в метрики."""
+    started = time.perf_counter()
+    stream = await _open_stream(openai_client, messages, model, max_tokens)
+    chunks = iterate_with_idle_timeout(stream, STREAM_IDLE_TIMEOUT)
+    first_text = ""
+    try:
+        async for chunk in chunks:
+            if chunk.choices and chunk.choices[0].delta.content:
+                first_text = chunk.choices[0].delta.content
+                break
+    except BaseException as e:
+        # Поток открылся, но завис до первого токена - call_in_slot этот сбой уже не видит
+        if isinstance(e, upstream.RETRYABLE_ERRORS):
+            upstream.breaker("chat", model).record_failure()
+        await _close_stream(stream)
+        raise
+    registry.observe(STREAM_TTFT_METRICS, model, (time.perf_counter() - started) * 1000)
+    return StartedStream(stream, chunks, first_text)
+
+async def _relay_stream(started: StartedStream, streaming_handler: StreamingResponse, parts: list):
+    """
+    Передает куски потока в streaming_handler. Полученный текст копится в parts,
+    поэтому при обрыве потока уже показанная часть ответа не теряется.
+    
+    ОБНОВЛЕНО: Поток читается без пауз - update_message только дописывает буфер, а правки
+    сообщения отправляет своя задача StreamingResponse в своем темпе. Поэтому время генерации
+    равно времени ответа OpenAI, а не сумме его и времени правок в Telegram.
     """
     try:
-        print("🔄 Запрашиваю потоковый ответ от OpenAI...")
-        
-        # Создаем потоковый запрос
-        stream = openai_client.chat.completions.create(
-            model=model,
-            messages=messages,
-            stream=True,
-            max_tokens=1000  # Ограничиваем для потокового ответа
-        )
-        
-        full_response = ""
-        word_buffer = ""
-        
-        for chunk in stream:
+        if started.first_text:
+            parts.append(started.first_text)
+            await streaming_handler.update_message(started.first_text)
+        async for chunk in started.chunks:
             # Получаем кусок текста
-            if chunk.choices[0].delta.content is not None:
-                chunk_text = chunk.choices[0].delta.content
-                full_response += chunk_text
-                word_buffer += chunk_text
-                
-                # Обновляем каждые несколько слов для плавности
-                if len(word_buffer.split()) >= 3 or chunk_text in ['.', '!', '?', '\n']:
-                    await streaming_handler.update_message(word_buffer)
-                    word_buffer = ""
-                    
-                    # Небольшая задержка для читаемости
-                    await asyncio.sleep(0.1)
-        
-        # Обновляем остатки
-        if word_buffer:
-            await streaming_handler.update_message(word_buffer, force_update=True)
-            
-        print(f"✅ Получен полный ответ ({len(full_response)} символов)")
-        return full_response
+            chunk_text = chunk.choices[0].delta.content if chunk.choices else None
+            if chunk_text:
+                parts.append(chunk_text)
+                await streaming_handler.update_message(chunk_text)
+    except BaseException:
+        await _close_stream(started.stream)
+        raise
+
+class HedgePolicy:
+    """
+    НОВОЕ: Когда отправлять второй (страхующий) запрос. Задержка - перцентиль HEDGE_PERCENTILE
+    времени до первого токена модели; доля хеджированных запросов среди последних
+    HEDGE_RATE_WINDOW не превышает HEDGE_MAX_RATE, чтобы не удваивать нагрузку при общей деградации.
+    """
+    
+    def __init__(self):
+        self.recent = deque(maxlen=HEDGE_RATE_WINDOW)  # True - запрос хеджировали
+    
+    def delay(self, model):
+        """Через сколько секунд без первого токена отправлять второй запрос (None - не хеджировать)."""
+        stats = registry.latencies.get(STREAM_TTFT_METRICS, {}).get(model)
+        if stats is None or stats.count < HEDGE_MIN_SAMPLES:
+            return None
+        return max(stats.percentile(HEDGE_PERCENTILE) / 1000, HEDGE_MIN_DELAY)
+    
+    def allow(self):
+        return sum(self.recent) < HEDGE_MAX_RATE * max(len(self.recent), 1)
+    
+    def record(self, hedged: bool):
+        self.recent.append(hedged)
+
+hedge_policy = HedgePolicy()
+
+async def _discard_start(task):
+    """Отменяет проигравший запрос; если его поток уже открылся - закрывает."""
+    task.cancel()
+    try:
+        started = await task
+    except BaseException:
+        return
+    await _close_stream(started.stream)
+
+async def _start_hedged_stream(openai_client, messages, model, max_tokens: int) -> StartedStream:
+    """
+    Как _start_stream, но если первый токен не пришел за hedge_policy.delay(model),
+    отправляет второй такой же запрос. Побеждает поток, первым давший текст; второй отменяется.
+    Оба запроса идут в одном месте очереди «chat», занятом stream_openai_response.
+    """
+    delay = hedge_policy.delay(model)
+    primary = asyncio.create_task(_start_stream(openai_client, messages, model, max_tokens))
+    if delay is None:
+        hedge_policy.record(False)
+        return await primary
+    
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done or not hedge_policy.allow():
+            hedge_policy.record(False)
+            return await primary
         
-    except Exception as e:
-        print(f"❌ Ошибка при получении потокового ответа: {e}")
-        # В случае ошибки делаем обычный запрос
+        print(f"🪁 Нет первого токена от {model} за {delay:.1f}с - отправляем второй запрос")
+        hedge_policy.record(True)
+        registry.increment(STREAM_HEDGE_METRICS, "hedged")
+        hedge = asyncio.create_task(_start_stream(openai_client, messages, model, max_tokens))
+    except BaseException:
+        await _discard_start(primary)
+        raise
+    
+    pending = {primary, hedge}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    registry.increment(STREAM_HEDGE_METRICS, "hedge_won" if task is hedge else "primary_won")
+                    return task.result()
+        # Оба запроса упали - отдаем ошибку основного
+        registry.increment(STREAM_HEDGE_METRICS, "both_failed")
+        return primary.result()
+    finally:
+        for task in pending:
+            await _discard_start(task)
+
+async def _stream_openai_response(openai_client, messages, model, streaming_handler: StreamingResponse):
+    print("🔄 Запрашиваю потоковый ответ от OpenAI...")
+    # НОВОЕ: При HEDGE_ENABLED медленный первый токен страхуется вторым запросом
+    start_stream = _start_hedged_stream if HEDGE_ENABLED else _start_stream
+    
+    # ИСПРАВЛЕНО: Ошибки открытия потока call_in_slot уже повторил и учел в автомате защиты -
+    # они уходят вызывающему коду без повторного учета и без еще одного полного запроса
+    started = await start_stream(openai_client, messages, model, STREAM_MAX_TOKENS)
+    
+    parts = []
+    try:
+        await _relay_stream(started, streaming_handler, parts)
+    except upstream.RETRYABLE_ERRORS as e:
+        # Открытый поток оборвался или завис - это сбой сервиса, учитываем его в автомате защиты
+        print(f"❌ Потоковый ответ прервался: {type(e).__name__} {e}")
+        upstream.breaker("chat", model).record_failure()
+        return await _recover_stream(openai_client, messages, model, streaming_handler, "".join(parts))
+    
+    full_response = "".join(parts)
+    print(f"✅ Получен полный ответ ({len(full_response)} символов)")
+    return full_response
+
+async def _recover_stream(openai_client, messages, model, streaming_handler: StreamingResponse, partial: str):
+    """
+    НОВОЕ: Восстановление оборвавшегося потока. Если часть ответа уже показана, просим модель
+    продолжить с места обрыва и дописываем продолжение в то же сообщение; полный ответ
+    заново запрашиваем только если продолжить не удалось.
+    """
+    if partial.strip():
+        continuation_messages = messages + [
+            {"role": "assistant", "content": partial},
+            {"role": "user", "content": STREAM_CONTINUE_PROMPT}
+        ]
+        max_tokens = max(STREAM_MAX_TOKENS - count_tokens(partial), 100)
+        continuation_parts = []
         try:
-            print("🔄 Переключаемся на обычный режим...")
-            response = openai_client.chat.completions.create(
-                model=model,
-                messages=messages,
-                max_tokens=1000
-            )
-            return response.choices[0].message.content
-        except Exception as fallback_error:
-            print(f"❌ Ошибка в fallback режиме: {fallback_error}")
-            return "Извините, произошла ошибка при генерации ответа."
\ No newline at end of file
+            print(f"🔄 Продолжаем ответ с места обрыва ({len(partial)} символов уже получено)...")
+            started = await _start_stream(openai_client, continuation_messages, model, max_tokens)
+            try:
+                await _relay_stream(started, streaming_handler, continuation_parts)
+            except upstream.RETRYABLE_ERRORS:
+                # Сбои открытия учтены в call_in_slot и _start_stream, здесь - только обрыв потока
+                upstream.breaker("chat", model).record_failure()
+                raise
+            registry.increment(STREAM_RECOVERY_METRICS, "continued")
+            return partial + "".join(continuation_parts)
+        except upstream.UpstreamBusy:
+            raise
+        except Exception as e:
+            print(f"❌ Не удалось продолжить ответ: {type(e).__name__} {e}")
+            registry.increment(STREAM_RECOVERY_METRICS, "continue_failed")
+    
+    # Один обычный запрос с теми же дедлайнами и повторами; если автомат разомкнулся - сразу ошибка.
+    # Показанный текст заменит finalize_message
+    print("🔄 Переключаемся на обычный режим...")
+    response = await upstream.call_in_slot("chat", model, lambda: openai_client.chat.completions.create(
+        model=model,
+        messages=messages,
+        max_tokens=STREAM_MAX_TOKENS
+    ))
+    registry.increment(STREAM_RECOVERY_METRICS, "regenerated")
+    return response.choices[0].message.content
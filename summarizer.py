@@ -0,0 +1,157 @@
+# summarizer.py
+
+import asyncio
+import time
+from openai import AsyncOpenAI
+from database import db
+import upstream
+from upstream import UpstreamBusy
+
+SUMMARY_SYSTEM_PROMPT = (
+    "You maintain a running summary of a conversation between a user and an AI assistant. "
+    "Update the current summary with the new messages. Keep facts about the user, names, numbers, "
+    "decisions, preferences and open questions; drop greetings and small talk. "
+    "Write in the language of the conversation. Reply with the updated summary only, "
+    "no longer than {max_words} words."
+)
+
+
+class ConversationSummarizer:
+    """
+    Фоновое сжатие длинных диалогов. Когда у пользователя в messages больше threshold
+    сообщений, самые старые (всё, кроме keep_recent последних, не больше batch_size за раз)
+    сворачиваются в краткое содержание: модель получает прошлое краткое содержание и новые
+    сообщения и дополняет его, а не пересказывает весь диалог заново.
+    """
+
+    def __init__(self, supabase, openai_client: AsyncOpenAI, threshold: int = 40, keep_recent: int = 20,
+                 batch_size: int = 40, model: str = "gpt-3.5-turbo", max_tokens: int = 500,
+                 check_interval: float = 60.0):
+        self.supabase = supabase
+        self.openai_client = openai_client
+        self.threshold = threshold
+        self.keep_recent = keep_recent
+        self.batch_size = batch_size
+        self.model = model
+        self.max_tokens = max_tokens
+        self.check_interval = check_interval
+        self._queue = asyncio.Queue()
+        self._task = None
+        self._scheduled = set()
+        self._last_checked = {}  # user_id -> время последней проверки (monotonic)
+
+        # Метрики
+        self.checks = 0
+        self.folds = 0
+        self.folded_messages = 0
+        self.errors = 0
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        """Запускает фоновый воркер."""
+        if not self.running:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает воркер; несвернутые диалоги будут свернуты после следующего запуска."""
+        if not self.running:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        print(f"📝 Сжатие истории остановлено: {self.stats()}")
+
+    def schedule(self, user_id):
+        """Ставит пользователя в очередь на проверку (не чаще раза в check_interval секунд)."""
+        if not self.running or user_id in self._scheduled:
+            return
+        now = time.monotonic()
+        last_checked = self._last_checked.get(user_id)
+        if last_checked is not None and now - last_checked < self.check_interval:
+            return
+        self._scheduled.add(user_id)
+        self._queue.put_nowait(user_id)
+
+    async def _run(self):
+        while True:
+            user_id = await self._queue.get()
+            self._scheduled.discard(user_id)
+            self._remember_check(user_id)
+            try:
+                await self.summarize(user_id)
+            except UpstreamBusy:
+                # OpenAI занят интерактивными запросами - свернем при следующей проверке
+                pass
+            except Exception as e:
+                self.errors += 1
+                print(f"❌ Ошибка при сжатии истории для {user_id}: {e}")
+
+    def _remember_check(self, user_id):
+        now = time.monotonic()
+        self._last_checked[user_id] = now
+        # Не даем словарю расти бесконечно: давние проверки больше не нужны
+        if len(self._last_checked) > 10000:
+            self._last_checked = {
+                key: checked_at for key, checked_at in self._last_checked.items()
+                if now - checked_at < self.check_interval
+            }
+
+    async def summarize(self, user_id):
+        """Сворачивает самые старые сообщения пользователя, если их больше threshold."""
+        self.checks += 1
+        message_count = await db.count_user_messages(self.supabase, user_id)
+        if message_count <= self.threshold:
+            return
+
+        messages = await db.get_oldest_messages(
+            self.supabase, user_id, min(message_count - self.keep_recent, self.batch_size)
+        )
+        if not messages:
+            return
+
+        current_summary = await db.get_conversation_summary(self.supabase, user_id)
+        new_summary = await self.fold(current_summary, messages)
+        if not new_summary:
+            return
+
+        deleted = await db.fold_conversation_summary(self.supabase, user_id, new_summary, messages[-1]["created_at"])
+        if deleted == 0:
+            # ИСПРАВЛЕНО: Историю очистили, пока готовилось краткое содержание - БД его не сохранила
+            print(f"📝 История {user_id} очищена во время сжатия, краткое содержание отброшено")
+        elif deleted is not None:
+            self.folds += 1
+            self.folded_messages += deleted
+            print(f"📝 История {user_id}: {deleted} сообщений свернуто в краткое содержание")
+
+    async def fold(self, current_summary, messages):
+        """Дополняет краткое содержание новыми сообщениями."""
+        transcript = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+        prompt = (
+            f"Current summary:\n{current_summary or '(empty)'}\n\n"
+            f"New messages:\n{transcript}"
+        )
+        response = await upstream.call("summary", self.model, lambda: self.openai_client.chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": SUMMARY_SYSTEM_PROMPT.format(max_words=self.max_tokens // 2)},
+                {"role": "user", "content": prompt}
+            ],
+            max_tokens=self.max_tokens
+        ))
+        return (response.choices[0].message.content or "").strip()
+
+    def stats(self):
+        """Возвращает метрики сжатия истории."""
+        return {
+            "queued": self._queue.qsize(),
+            "checks": self.checks,
+            "folds": self.folds,
+            "folded_messages": self.folded_messages,
+            "errors": self.errors,
+        }
@@ -0,0 +1,196 @@
+# telegram_gateway.py
+
+import asyncio
+import time
+from collections import deque
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+from config import (
+    GATEWAY_GLOBAL_RATE, GATEWAY_RESERVED_TOKENS, GATEWAY_CHAT_RATE, GATEWAY_CHAT_BURST,
+    GATEWAY_GROUP_RATE, GATEWAY_GROUP_BURST, GATEWAY_MAX_RETRIES
+)
+from metrics import registry
+
+# Очереди исходящих запросов к Telegram по убыванию приоритета.
+# Очередь задается через rate_limit_args (context.bot.send_message(..., rate_limit_args=LANE_BROADCAST)),
+# без него - по методу API: правки сообщений - LANE_EDIT, остальное - LANE_INTERACTIVE
+LANE_INTERACTIVE = "interactive"
+LANE_EDIT = "edit"
+LANE_NOTIFICATION = "notification"
+LANE_BROADCAST = "broadcast"
+LANES = (LANE_INTERACTIVE, LANE_EDIT, LANE_NOTIFICATION, LANE_BROADCAST)
+
+# Очереди, которым запас GATEWAY_RESERVED_TOKENS недоступен: фоновые отправки не отнимают
+# у живых чатов возможность ответить сразу
+BACKGROUND_LANES = (LANE_NOTIFICATION, LANE_BROADCAST)
+
+EDIT_ENDPOINTS = ("editMessageText", "editMessageCaption", "editMessageReplyMarkup", "editMessageMedia")
+
+# Группы метрик: ожидание в очереди по приоритетам и RetryAfter от Telegram
+GATEWAY_QUEUE_METRICS = "telegram.queue"
+GATEWAY_RETRY_AFTER_METRICS = "telegram.retry_after"
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity; RetryAfter блокирует его целиком."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float, reserve: float = 0.0) -> float:
+        """Через сколько секунд в ведре будет токен сверх reserve."""
+        missing = 1 + reserve - self.tokens
+        return max(self.blocked_until - now, missing / self.rate if missing > 0 else 0.0)
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class PendingRequest:
+    def __init__(self, lane: str, chat_id, future):
+        self.lane = lane
+        self.chat_id = chat_id
+        self.future = future
+        self.queued_at = time.perf_counter()
+
+
+class TelegramGateway(BaseRateLimiter):
+    """
+    Единая точка выхода к Bot API (Application.builder().rate_limiter(...)): все запросы бота,
+    включая правки потоковых ответов, проходят через нее. Общий лимит GATEWAY_GLOBAL_RATE
+    сообщений в секунду и лимит на чат; запросы ждут в очередях по приоритету, и фоновые
+    очереди (уведомления, рассылка) не трогают последние GATEWAY_RESERVED_TOKENS токенов.
+    """
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(GATEWAY_GLOBAL_RATE, GATEWAY_GLOBAL_RATE)
+        self.chat_buckets = {}  # chat_id -> TokenBucket
+        self.lanes = {lane: deque() for lane in LANES}
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    async def initialize(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        lane = rate_limit_args if rate_limit_args in LANES else (
+            LANE_EDIT if endpoint in EDIT_ENDPOINTS else LANE_INTERACTIVE
+        )
+        chat_id = data.get("chat_id")
+        attempt = 0
+        while True:
+            await self._acquire(lane, chat_id)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                retry_after = retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+                registry.increment(GATEWAY_RETRY_AFTER_METRICS, lane)
+                # RetryAfter без чата - общий лимит бота; с чатом - ждет только этот чат
+                (self.chat_bucket(chat_id) if chat_id is not None else self.global_bucket).block(retry_after)
+                # Правку потокового ответа не повторяем: StreamingResponse сам отправит более свежий текст
+                if lane == LANE_EDIT or attempt >= GATEWAY_MAX_RETRIES:
+                    raise
+                attempt += 1
+                print(f"⏳ Telegram RetryAfter {retry_after}с ({endpoint}, {lane}), повтор {attempt}/{GATEWAY_MAX_RETRIES}")
+
+    def chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            # Не даем словарю расти бесконечно: полные ведра давно молчащих чатов не нужны
+            if len(self.chat_buckets) > 10000:
+                now = time.monotonic()
+                for old_bucket in self.chat_buckets.values():
+                    old_bucket.refill(now)
+                self.chat_buckets = {
+                    key: old_bucket for key, old_bucket in self.chat_buckets.items()
+                    if old_bucket.tokens < old_bucket.capacity or old_bucket.blocked_until > now
+                }
+            # Отрицательный chat_id - группа: у Telegram там лимит строже
+            group = isinstance(chat_id, int) and chat_id < 0
+            bucket = self.chat_buckets[chat_id] = TokenBucket(
+                GATEWAY_GROUP_RATE if group else GATEWAY_CHAT_RATE,
+                GATEWAY_GROUP_BURST if group else GATEWAY_CHAT_BURST
+            )
+        return bucket
+
+    async def _acquire(self, lane: str, chat_id):
+        """Ждет, пока диспетчер разрешит запрос."""
+        await self.initialize()
+        request = PendingRequest(lane, chat_id, asyncio.get_running_loop().create_future())
+        self.lanes[lane].append(request)
+        self._wakeup.set()
+        try:
+            await request.future
+        finally:
+            registry.observe(GATEWAY_QUEUE_METRICS, lane, (time.perf_counter() - request.queued_at) * 1000)
+
+    def _wait_time(self, request: PendingRequest, now: float) -> float:
+        reserve = GATEWAY_RESERVED_TOKENS if request.lane in BACKGROUND_LANES else 0.0
+        wait = self.global_bucket.wait_time(now, reserve)
+        if request.chat_id is not None:
+            bucket = self.chat_bucket(request.chat_id)
+            bucket.refill(now)
+            wait = max(wait, bucket.wait_time(now))
+        return wait
+
+    def _grant(self, request: PendingRequest):
+        self.global_bucket.tokens -= 1
+        if request.chat_id is not None:
+            self.chat_bucket(request.chat_id).tokens -= 1
+        request.future.set_result(None)
+
+    async def _dispatch(self):
+        """Раздает разрешения: сначала старшие очереди, внутри очереди - по порядку, с учетом лимитов чатов."""
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            self.global_bucket.refill(now)
+            next_wait = None
+            for lane in LANES:
+                queue = self.lanes[lane]
+                for request in list(queue):
+                    if request.future.done():
+                        # Запрос отменен, пока ждал
+                        queue.remove(request)
+                        continue
+                    wait = self._wait_time(request, now)
+                    if wait <= 0:
+                        queue.remove(request)
+                        self._grant(request)
+                    elif next_wait is None or wait < next_wait:
+                        next_wait = wait
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), next_wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self):
+        return {lane: len(queue) for lane, queue in self.lanes.items()}
+
+
+gateway = TelegramGateway()
+
+
+def get_gateway_stats():
+    """Сколько запросов ждет в каждой очереди (для /metrics)."""
+    return gateway.stats()
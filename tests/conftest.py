@@ -0,0 +1,70 @@
+# tests/conftest.py
+
+import asyncio
+import contextlib
+import inspect
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# config.py проверяет обязательные переменные при импорте
+for name, value in {
+    "TELEGRAM_TOKEN": "test",
+    "OPENAI_API_KEY": "test",
+    "BOT_USERNAME": "test_bot",
+    "SUPABASE_URL": "http://localhost:54321",
+    "SUPABASE_KEY": "test",
+}.items():
+    os.environ.setdefault(name, value)
+
+from database import db  # noqa: E402
+from database.instrumentation import InstrumentedClient  # noqa: E402
+from database.sqlite_backend import SQLiteClient  # noqa: E402
+from database.storage import close_storage_client  # noqa: E402
+from supabase_fake import SupabaseFake  # noqa: E402
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_pyfunc_call(pyfuncitem):
+    """Запускает async-тесты в своем цикле событий (без pytest-asyncio)."""
+    if not inspect.iscoroutinefunction(pyfuncitem.obj):
+        return None
+    arguments = {name: pyfuncitem.funcargs[name] for name in pyfuncitem._fixtureinfo.argnames}
+    asyncio.run(pyfuncitem.obj(**arguments))
+    return True
+
+
+@pytest.fixture(autouse=True)
+def clean_db_state(monkeypatch):
+    """Каждый тест начинает с пустых кэшей и без очереди отложенных записей и сжатия истории."""
+    db.profile_cache.clear()
+    db.response_cache.clear()
+    monkeypatch.setattr(db, "write_behind", None)
+    monkeypatch.setattr(db, "summarizer", None)
+    yield
+    db.profile_cache.clear()
+    db.response_cache.clear()
+
+
+@pytest.fixture(params=["sqlite", "supabase"])
+def storage(request, tmp_path):
+    """
+    Открывает клиент хранилища (SQLite в файле или Supabase в памяти), обернутый как в
+    database/storage.py. Клиент создается внутри цикла событий теста:
+        async with storage() as supabase: ...
+    """
+    @contextlib.asynccontextmanager
+    async def open_storage():
+        if request.param == "sqlite":
+            client = await SQLiteClient.connect(str(tmp_path / "bot.db"))
+        else:
+            client = SupabaseFake()
+        try:
+            yield InstrumentedClient(client)
+        finally:
+            await close_storage_client(client)
+
+    return open_storage
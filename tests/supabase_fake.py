@@ -0,0 +1,306 @@
+# tests/supabase_fake.py
+#
+# Клиент Supabase в памяти для тестов: то же подмножество API postgrest, что использует
+# database/db.py (table(...) с select/insert/upsert/update/delete/eq/gt/order/limit и rpc(...)),
+# и те же формы ответов. RPC повторяют функции из database/migrations.
+
+import math
+from datetime import datetime, timezone
+
+# Первичные ключи таблиц (messages получает id по порядку вставки)
+PRIMARY_KEYS = {
+    "users": "user_id",
+    "conversation_summaries": "user_id",
+    "response_cache": "cache_key",
+    "messages": "id",
+}
+
+# Значения по умолчанию из схемы Postgres
+DEFAULTS = {
+    "users": {
+        "state": "chat",
+        "mode": "Помощник",
+        "credits": 0,
+        "model": None,
+        "referral_code": None,
+        "invited_by": None,
+        "voice_enabled": False,
+        "selected_voice": None,
+        "voice_language": None,
+        "voice_messages_sent": 0,
+        "voice_messages_received": 0,
+        "interface_language": "en",
+        "streaming_enabled": True,
+    },
+    "messages": {"token_count": None},
+    "conversation_summaries": {"token_count": 0},
+}
+
+TIMESTAMPED_TABLES = {"users", "messages", "response_cache"}
+
+PROFILE_COLUMNS = (
+    "state", "mode", "credits", "model", "referral_code", "invited_by", "created_at",
+    "voice_enabled", "selected_voice", "voice_language", "voice_messages_sent",
+    "voice_messages_received", "interface_language", "streaming_enabled",
+)
+
+
+def now_iso():
+    return datetime.now(timezone.utc).isoformat()
+
+
+class FakeResponse:
+    """Как APIResponse из postgrest: data и (для select с count='exact') count."""
+
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+
+class FakeQuery:
+    def __init__(self, client, table: str):
+        self.client = client
+        self.table = table
+        self.action = None
+        self.columns = "*"
+        self.count_mode = None
+        self.payload = None
+        self.replace = False
+        self.filters = []
+        self.order_by = []
+        self.limit_value = None
+
+    def select(self, columns: str = "*", count=None):
+        self.action = "select"
+        self.columns = columns
+        self.count_mode = count
+        return self
+
+    def insert(self, payload):
+        self.action = "insert"
+        self.payload = payload
+        return self
+
+    def upsert(self, payload):
+        self.action = "insert"
+        self.payload = payload
+        self.replace = True
+        return self
+
+    def update(self, payload: dict):
+        self.action = "update"
+        self.payload = payload
+        return self
+
+    def delete(self):
+        self.action = "delete"
+        return self
+
+    def eq(self, column: str, value):
+        self.filters.append(lambda row: row.get(column) == value)
+        return self
+
+    def gt(self, column: str, value):
+        self.filters.append(lambda row: row.get(column) is not None and row[column] > value)
+        return self
+
+    def order(self, column: str, desc: bool = False):
+        self.order_by.append((column, desc))
+        return self
+
+    def limit(self, size: int):
+        self.limit_value = int(size)
+        return self
+
+    def matching_rows(self):
+        return [row for row in self.client.rows(self.table) if all(check(row) for check in self.filters)]
+
+    async def execute(self):
+        self.client.requests += 1
+        if self.action == "select":
+            rows = self.matching_rows()
+            count = len(rows) if self.count_mode == "exact" else None
+            for column, desc in reversed(self.order_by):
+                rows = sorted(rows, key=lambda row: row[column], reverse=desc)
+            if self.limit_value is not None:
+                rows = rows[:self.limit_value]
+            if self.columns.strip() != "*":
+                columns = [column.strip() for column in self.columns.split(",")]
+                rows = [{column: row.get(column) for column in columns} for row in rows]
+            return FakeResponse([dict(row) for row in rows], count)
+
+        if self.action == "insert":
+            rows = self.payload if isinstance(self.payload, list) else [self.payload]
+            return FakeResponse([self.client.insert_row(self.table, row, self.replace) for row in rows])
+
+        if self.action == "update":
+            rows = self.matching_rows()
+            for row in rows:
+                row.update(self.payload)
+            return FakeResponse([dict(row) for row in rows])
+
+        if self.action == "delete":
+            rows = self.matching_rows()
+            self.client.delete_rows(self.table, rows)
+            return FakeResponse([dict(row) for row in rows])
+
+        raise ValueError(f"Не указано действие для запроса к {self.table}")
+
+
+class FakeRPC:
+    def __init__(self, client, name: str, params: dict):
+        self.client = client
+        self.name = name
+        self.params = params or {}
+
+    async def execute(self):
+        self.client.requests += 1
+        handler = getattr(self.client, f"rpc_{self.name}", None)
+        if handler is None:
+            raise ValueError(f"Could not find the function public.{self.name}")
+        return FakeResponse(handler(**self.params))
+
+
+class SupabaseFake:
+    """Асинхронный клиент Supabase в памяти."""
+
+    def __init__(self):
+        self.tables = {table: {} for table in PRIMARY_KEYS}
+        self.next_message_id = 1
+        self.requests = 0
+
+    def table(self, name: str) -> FakeQuery:
+        return FakeQuery(self, name)
+
+    def rpc(self, name: str, params: dict = None) -> FakeRPC:
+        return FakeRPC(self, name, params)
+
+    def rows(self, table: str):
+        return list(self.tables[table].values())
+
+    def insert_row(self, table: str, payload: dict, replace: bool = False):
+        row = dict(DEFAULTS.get(table, {}))
+        row.update(payload)
+        if table in TIMESTAMPED_TABLES:
+            row.setdefault("created_at", now_iso())
+        if table == "messages" and "id" not in row:
+            row["id"] = self.next_message_id
+            self.next_message_id += 1
+        key = row[PRIMARY_KEYS[table]]
+        if key in self.tables[table] and not replace:
+            raise ValueError(f'duplicate key value violates unique constraint "{table}_pkey"')
+        self.tables[table][key] = row
+        return dict(row)
+
+    def delete_rows(self, table: str, rows):
+        for row in rows:
+            self.tables[table].pop(row[PRIMARY_KEYS[table]], None)
+
+    def user(self, user_id):
+        return self.tables["users"].get(user_id)
+
+    # --- Функции из database/migrations ---
+
+    def rpc_deduct_user_credits(self, p_user_id, p_amount):
+        user = self.user(p_user_id)
+        if user is None:
+            return None
+        user["credits"] = max(0, user["credits"] - p_amount)
+        return user["credits"]
+
+    def rpc_add_user_credits(self, p_user_id, p_amount):
+        user = self.user(p_user_id)
+        if user is None:
+            return None
+        user["credits"] += p_amount
+        return user["credits"]
+
+    def rpc_remove_user_credits(self, p_user_id, p_amount, p_allow_negative=False):
+        user = self.user(p_user_id)
+        if user is None:
+            return []
+        if p_allow_negative or user["credits"] >= p_amount:
+            user["credits"] -= p_amount
+            return [{"new_balance": user["credits"], "success": True}]
+        return [{"new_balance": user["credits"], "success": False}]
+
+    def rpc_award_referral_bonuses(self, p_inviter_id, p_new_user_id, p_inviter_bonus, p_new_user_bonus):
+        return [{
+            "inviter_credits": self.rpc_add_user_credits(p_inviter_id, p_inviter_bonus),
+            "new_user_credits": self.rpc_add_user_credits(p_new_user_id, p_new_user_bonus),
+        }]
+
+    def rpc_get_turn_context(self, p_user_id, p_max_messages=50, p_budgets=None, p_default_budget=3000):
+        user = self.user(p_user_id)
+        if user is None:
+            return None
+
+        summary = self.tables["conversation_summaries"].get(p_user_id)
+        summary = {"summary": summary["summary"], "token_count": summary["token_count"]} if summary else None
+        budget = (p_budgets or {}).get(user["model"], p_default_budget) - (summary["token_count"] if summary else 0)
+
+        recent = sorted(
+            (row for row in self.rows("messages") if row["user_id"] == p_user_id),
+            key=lambda row: row["created_at"], reverse=True
+        )[:p_max_messages]
+        history = []
+        running_tokens = 0
+        for row in recent:
+            token_count = row["token_count"]
+            if token_count is None:
+                token_count = math.ceil(len(row["content"]) / 4)
+            running_tokens += token_count
+            if running_tokens <= budget:
+                history.append({
+                    "role": row["role"], "content": row["content"],
+                    "token_count": token_count, "created_at": row["created_at"],
+                })
+        history.reverse()
+
+        return {
+            "profile": {column: user.get(column) for column in PROFILE_COLUMNS},
+            "summary": summary,
+            "history": history,
+        }
+
+    def rpc_fold_conversation_summary(self, p_user_id, p_summary, p_token_count, p_folded_until):
+        folded = [
+            row for row in self.rows("messages")
+            if row["user_id"] == p_user_id and row["created_at"] <= p_folded_until
+        ]
+        self.delete_rows("messages", folded)
+        if folded:
+            self.tables["conversation_summaries"][p_user_id] = {
+                "user_id": p_user_id,
+                "summary": p_summary,
+                "token_count": p_token_count,
+                "updated_at": now_iso(),
+            }
+        return len(folded)
+
+    def rpc_get_bot_stats(self):
+        users = self.rows("users")
+        credits = [user["credits"] for user in users]
+        return {
+            "total_users": len(users),
+            "total_credits": sum(credits),
+            "avg_credits": round(sum(credits) / len(credits), 2) if credits else 0,
+            "negative_balance_count": sum(1 for value in credits if value < 0),
+            "voice_enabled_count": sum(1 for user in users if user["voice_enabled"]),
+        }
+
+    def rpc_increment_voice_stats(self, p_user_id, p_sent=0, p_received=0):
+        user = self.user(p_user_id)
+        if user is None:
+            return []
+        user["voice_messages_sent"] = (user["voice_messages_sent"] or 0) + p_sent
+        user["voice_messages_received"] = (user["voice_messages_received"] or 0) + p_received
+        return [{"sent": user["voice_messages_sent"], "received": user["voice_messages_received"]}]
+
+    def rpc_charge_voice_turn(self, p_user_id, p_amount, p_sent=0, p_received=0):
+        user = self.user(p_user_id)
+        if user is None:
+            return []
+        credits = self.rpc_deduct_user_credits(p_user_id, p_amount)
+        stats = self.rpc_increment_voice_stats(p_user_id, p_sent, p_received)[0]
+        return [{"new_balance": credits, **stats}]
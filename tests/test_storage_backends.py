@@ -0,0 +1,297 @@
+# tests/test_storage_backends.py
+#
+# Один и тот же набор проверок API database/db.py для обоих бэкендов хранилища:
+# SQLite (database/sqlite_backend.py) и Supabase (клиент в памяти из supabase_fake.py).
+
+from config import INITIAL_CREDITS
+from database import db
+
+USER_ID = 1001
+
+
+async def create_user(supabase, user_id=USER_ID, credits=None):
+    user = await db.add_or_update_user(supabase, user_id, language_code="ru")
+    assert user is not None
+    if credits is not None:
+        await db.add_user_credits(supabase, user_id, credits - user["credits"])
+    return user
+
+
+async def read_profile(supabase, user_id=USER_ID):
+    """Профиль прямо из хранилища, мимо кэша профилей."""
+    db.profile_cache.clear()
+    return await db.get_user_data(supabase, user_id)
+
+
+async def test_new_user_profile(storage):
+    async with storage() as supabase:
+        assert await db.get_user_data(supabase, USER_ID) is None
+
+        await create_user(supabase)
+        profile = await read_profile(supabase)
+
+        assert profile["credits"] == INITIAL_CREDITS
+        assert profile["state"] == "chat"
+        assert profile["model"] == db.DEFAULT_MODEL
+        assert profile["interface_language"] == "ru"
+        assert profile["voice_language"] == "ru"
+        assert profile["voice_enabled"] is False
+        assert profile["streaming_enabled"] is True
+        assert profile["referral_code"].startswith(f"ref{USER_ID}_")
+
+        # Повторный вызов не создает пользователя заново
+        assert (await db.add_or_update_user(supabase, USER_ID))["referral_code"] == profile["referral_code"]
+        assert await db.count_users(supabase) == 1
+
+
+async def test_profile_setters_persist(storage):
+    async with storage() as supabase:
+        await create_user(supabase)
+
+        await db.set_user_state(supabase, USER_ID, "awaiting_input")
+        assert await db.set_user_language_with_voice_sync(supabase, USER_ID, "pl")
+        assert await db.set_voice_enabled(supabase, USER_ID, True)
+        assert await db.set_user_streaming(supabase, USER_ID, False)
+        model = list(db.AVAILABLE_MODELS.values())[-1]
+        await db.set_user_model(supabase, USER_ID, model)
+
+        cached = await db.get_user_data(supabase, USER_ID)
+        stored = await read_profile(supabase)
+        assert stored == cached
+        assert stored["state"] == "awaiting_input"
+        assert stored["interface_language"] == "pl"
+        assert stored["voice_language"] == "pl"
+        assert stored["voice_enabled"] is True
+        assert stored["streaming_enabled"] is False
+        assert stored["model"] == model
+
+
+async def test_set_user_mode_resets_state_and_history(storage):
+    async with storage() as supabase:
+        await create_user(supabase)
+        await db.set_user_state(supabase, USER_ID, "awaiting_input")
+        await db.append_turn(supabase, USER_ID, [{"role": "user", "content": "привет"}])
+
+        await db.set_user_mode(supabase, USER_ID, "Шутник")
+
+        stored = await read_profile(supabase)
+        assert stored["mode"] == "Шутник"
+        assert stored["state"] == "chat"
+        assert await db.count_user_messages(supabase, USER_ID) == 0
+
+
+async def test_credit_rpcs(storage):
+    async with storage() as supabase:
+        await create_user(supabase, credits=10)
+
+        assert await db.add_user_credits(supabase, USER_ID, 5) == 15
+        assert await db.deduct_user_credits(supabase, USER_ID, 4) == 11
+        # Списание не уводит баланс в минус
+        assert await db.deduct_user_credits(supabase, USER_ID, 100) == 0
+
+        await db.add_user_credits(supabase, USER_ID, 3)
+        assert await db.remove_user_credits(supabase, USER_ID, 5) == (3, False)
+        assert await db.remove_user_credits(supabase, USER_ID, 2) == (1, True)
+        assert await db.remove_user_credits(supabase, USER_ID, 5, allow_negative=True) == (-4, True)
+
+        assert await db.get_user_credits(supabase, USER_ID) == -4
+        assert (await read_profile(supabase))["credits"] == -4
+
+        # Пользователя нет - баланс 0 и операция не удалась
+        assert await db.remove_user_credits(supabase, 9999, 1) == (0, False)
+
+
+async def test_referral_bonuses(storage):
+    async with storage() as supabase:
+        await create_user(supabase, USER_ID, credits=0)
+        await create_user(supabase, USER_ID + 1, credits=0)
+
+        assert await db.award_referral_bonuses(supabase, USER_ID, USER_ID + 1, 3, 2)
+
+        assert await db.get_user_credits(supabase, USER_ID) == 3
+        assert await db.get_user_credits(supabase, USER_ID + 1) == 2
+        assert (await read_profile(supabase, USER_ID))["credits"] == 3
+        assert (await read_profile(supabase, USER_ID + 1))["credits"] == 2
+
+
+async def test_append_turn_and_turn_context(storage):
+    async with storage() as supabase:
+        await create_user(supabase)
+        assert await db.get_turn_context(supabase, 9999) is None
+
+        await db.append_turn(supabase, USER_ID, [
+            {"role": "user", "content": "первый вопрос"},
+            {"role": "assistant", "content": "первый ответ"},
+        ])
+        await db.append_turn(supabase, USER_ID, [
+            {"role": "user", "content": "второй вопрос"},
+            {"role": "assistant", "content": "второй ответ"},
+        ])
+
+        turn = await db.get_turn_context(supabase, USER_ID)
+        assert turn["credits"] == INITIAL_CREDITS
+        assert turn["mode"] == "Помощник"
+        assert [message["content"] for message in turn["history"]] == [
+            "первый вопрос", "первый ответ", "второй вопрос", "второй ответ"
+        ]
+        assert turn["history"][0]["role"] == "user"
+        assert await db.count_user_messages(supabase, USER_ID) == 4
+        assert await db.get_user_history(supabase, USER_ID, limit=2) == [
+            {"role": "user", "content": "второй вопрос"},
+            {"role": "assistant", "content": "второй ответ"},
+        ]
+
+
+async def test_turn_context_token_budget(storage, monkeypatch):
+    async with storage() as supabase:
+        await create_user(supabase)
+        old_message = "старое " * 40
+        await db.append_turn(supabase, USER_ID, [{"role": "user", "content": old_message}])
+        await db.append_turn(supabase, USER_ID, [{"role": "user", "content": "новое"}])
+
+        budget = db.count_tokens("новое") + db.count_tokens(old_message) - 1
+        monkeypatch.setattr(db, "HISTORY_TOKEN_BUDGETS", {})
+        monkeypatch.setattr(db, "DEFAULT_HISTORY_TOKEN_BUDGET", budget)
+
+        turn = await db.get_turn_context(supabase, USER_ID)
+        assert [message["content"] for message in turn["history"]] == ["новое"]
+
+
+class SummarizerStub:
+    """Включенное сжатие истории без фоновой задачи."""
+
+    def schedule(self, user_id):
+        pass
+
+
+async def test_conversation_summary_fold(storage, monkeypatch):
+    monkeypatch.setattr(db, "summarizer", SummarizerStub())
+    async with storage() as supabase:
+        await create_user(supabase)
+        await db.append_turn(supabase, USER_ID, [
+            {"role": "user", "content": "давний вопрос"},
+            {"role": "assistant", "content": "давний ответ"},
+        ])
+        await db.append_turn(supabase, USER_ID, [{"role": "user", "content": "свежий вопрос"}])
+
+        oldest = await db.get_oldest_messages(supabase, USER_ID, 2)
+        assert [message["content"] for message in oldest] == ["давний вопрос", "давний ответ"]
+
+        assert await db.fold_conversation_summary(supabase, USER_ID, "краткое", oldest[-1]["created_at"]) == 2
+        assert await db.get_conversation_summary(supabase, USER_ID) == "краткое"
+
+        turn = await db.get_turn_context(supabase, USER_ID)
+        assert turn["history"] == [
+            {"role": "system", "content": db.SUMMARY_MESSAGE_PREFIX + "краткое"},
+            {"role": "user", "content": "свежий вопрос"},
+        ]
+
+        await db.clear_user_history(supabase, USER_ID)
+        assert await db.count_user_messages(supabase, USER_ID) == 0
+        assert await db.get_conversation_summary(supabase, USER_ID) is None
+
+
+async def test_fold_after_clear_drops_summary(storage, monkeypatch):
+    monkeypatch.setattr(db, "summarizer", SummarizerStub())
+    async with storage() as supabase:
+        await create_user(supabase)
+        await db.append_turn(supabase, USER_ID, [{"role": "user", "content": "секрет"}])
+        oldest = await db.get_oldest_messages(supabase, USER_ID, 1)
+
+        # Пользователь очистил историю, пока summarizer готовил краткое содержание
+        await db.clear_user_history(supabase, USER_ID)
+        await db.append_turn(supabase, USER_ID, [{"role": "user", "content": "с чистого листа"}])
+
+        assert await db.fold_conversation_summary(supabase, USER_ID, "про секрет", oldest[-1]["created_at"]) == 0
+        assert await db.get_conversation_summary(supabase, USER_ID) is None
+        turn = await db.get_turn_context(supabase, USER_ID)
+        assert turn["history"] == [{"role": "user", "content": "с чистого листа"}]
+
+
+async def test_clear_drops_summary_with_summarizer_disabled(storage, monkeypatch):
+    monkeypatch.setattr(db, "summarizer", SummarizerStub())
+    async with storage() as supabase:
+        await create_user(supabase)
+        await db.append_turn(supabase, USER_ID, [{"role": "user", "content": "давний вопрос"}])
+        oldest = await db.get_oldest_messages(supabase, USER_ID, 1)
+        assert await db.fold_conversation_summary(supabase, USER_ID, "краткое", oldest[-1]["created_at"]) == 1
+
+        # Сжатие истории выключили, а краткое содержание осталось - очистка удаляет и его
+        monkeypatch.setattr(db, "summarizer", None)
+        await db.clear_user_history(supabase, USER_ID)
+        assert await db.get_conversation_summary(supabase, USER_ID) is None
+
+
+async def test_response_cache_upsert(storage, monkeypatch):
+    monkeypatch.setattr(db, "RESPONSE_CACHE_PERSISTENT", True)
+    async with storage() as supabase:
+        cache_key = db.make_response_cache_key("Hello  world", "Переводчик", "ru", db.DEFAULT_MODEL)
+        assert cache_key == db.make_response_cache_key("Hello world", "Переводчик", "ru", db.DEFAULT_MODEL)
+        assert await db.get_cached_response(supabase, cache_key) is None
+
+        await db.save_cached_response(supabase, cache_key, "Привет мир")
+        await db.save_cached_response(supabase, cache_key, "Привет, мир")
+
+        # Память очищена (перезапуск бота) - ответ читается из таблицы response_cache
+        db.response_cache.clear()
+        persistent_hits = db.response_cache_persistent_hits
+        assert await db.get_cached_response(supabase, cache_key) == "Привет, мир"
+        assert db.response_cache_persistent_hits == persistent_hits + 1
+
+        response = await supabase.table("response_cache").select("cache_key").execute()
+        assert len(response.data) == 1
+
+
+async def test_voice_stats(storage):
+    async with storage() as supabase:
+        await create_user(supabase, credits=10)
+
+        await db.increment_voice_stats(supabase, USER_ID, sent=1)
+        await db.increment_voice_stats(supabase, USER_ID, received=2)
+        assert await db.get_voice_stats(supabase, USER_ID) == {"sent": 1, "received": 2}
+
+        assert await db.charge_voice_turn(supabase, USER_ID, 3, sent=1, received=1) == 7
+        assert await db.get_voice_stats(supabase, USER_ID) == {"sent": 2, "received": 3}
+
+        db.profile_cache.clear()
+        assert await db.get_voice_stats(supabase, USER_ID) == {"sent": 2, "received": 3}
+        assert await db.get_user_credits(supabase, USER_ID) == 7
+
+        # Списание за голосовой ход тоже не уводит баланс в минус
+        assert await db.charge_voice_turn(supabase, USER_ID, 100, sent=1) == 0
+
+
+async def test_bot_stats(storage):
+    async with storage() as supabase:
+        await create_user(supabase, USER_ID, credits=10)
+        await create_user(supabase, USER_ID + 1, credits=0)
+        await db.remove_user_credits(supabase, USER_ID + 1, 2, allow_negative=True)
+        await db.set_voice_enabled(supabase, USER_ID, True)
+
+        stats = await db.get_bot_stats(supabase)
+        assert stats["total_users"] == 2
+        assert stats["total_credits"] == 8
+        assert float(stats["avg_credits"]) == 4.0
+        assert stats["negative_balance_count"] == 1
+        assert stats["voice_enabled_count"] == 1
+
+
+async def collect_users(supabase, **kwargs):
+    return [row async for row in db.iter_users(supabase, **kwargs)]
+
+
+async def test_iter_users_pagination(storage):
+    async with storage() as supabase:
+        assert await collect_users(supabase, page_size=3) == []
+
+        user_ids = [5, 1, 9, 3, 7, 2, 8]
+        for user_id in user_ids:
+            await create_user(supabase, user_id)
+
+        rows = await collect_users(supabase, columns="interface_language", page_size=3)
+        assert [row["user_id"] for row in rows] == sorted(user_ids)
+        assert all(row["interface_language"] == "ru" for row in rows)
+
+        # Последняя страница ровно полная - перебор завершается пустой страницей
+        rows = await collect_users(supabase, page_size=7)
+        assert [row["user_id"] for row in rows] == sorted(user_ids)
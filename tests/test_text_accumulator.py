@@ -0,0 +1,30 @@
+# tests/test_text_accumulator.py
+
+from text_accumulator import TextAccumulator
+
+
+def test_leading_space_is_not_a_sentence_end():
+    buffer = TextAccumulator(" Привет мир")
+    assert buffer.word_ends == [1, 8]
+    assert buffer.sentence_ends == []
+
+
+def test_boundaries_across_chunks():
+    buffer = TextAccumulator()
+    for chunk in ["Первое.", " Второе", "\n", "\n", "Третье"]:
+        buffer.append(chunk)
+    assert buffer.text() == "Первое. Второе\n\nТретье"
+    assert buffer.sentence_ends == [8, 15]
+    assert buffer.paragraph_ends == [16]
+    assert buffer.word_end == 16
+
+
+def test_split_point_prefers_paragraph_then_sentence_then_word():
+    buffer = TextAccumulator("aaaa bbbb.\n\ncccc. dddd eeee")
+    assert buffer.split_point(0, 100) == len(buffer)
+    assert buffer.split_point(0, 20) == 12
+    buffer = TextAccumulator("aaaa bbbb. cccc dddd eeee")
+    assert buffer.split_point(0, 16) == 11
+    buffer = TextAccumulator("aaaa bbbb cccc dddd")
+    assert buffer.split_point(0, 12) == 10
+    assert TextAccumulator("a" * 30).split_point(0, 10) == 10
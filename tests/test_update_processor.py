@@ -0,0 +1,56 @@
+# tests/test_update_processor.py
+
+import asyncio
+from types import SimpleNamespace
+
+from update_processor import PerChatUpdateProcessor
+
+
+def make_update(chat_id):
+    return SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id))
+
+
+async def handle(log, name, delay):
+    log.append(f"start {name}")
+    await asyncio.sleep(delay)
+    log.append(f"end {name}")
+
+
+async def test_chats_run_concurrently_and_each_chat_in_order():
+    processor = PerChatUpdateProcessor(10)
+    log = []
+    await asyncio.gather(
+        processor.process_update(make_update(1), handle(log, "1a", 0.05)),
+        processor.process_update(make_update(1), handle(log, "1b", 0.0)),
+        processor.process_update(make_update(2), handle(log, "2a", 0.0)),
+    )
+    # Чат 2 не ждет чат 1, а второе обновление чата 1 - только после первого
+    assert log.index("end 2a") < log.index("end 1a")
+    assert log.index("end 1a") < log.index("start 1b")
+    assert processor._chats == {}
+
+
+async def test_updates_without_chat_are_not_serialized():
+    processor = PerChatUpdateProcessor(10)
+    log = []
+    await asyncio.gather(
+        processor.process_update(SimpleNamespace(), handle(log, "a", 0.05)),
+        processor.process_update(SimpleNamespace(), handle(log, "b", 0.0)),
+    )
+    assert log.index("end b") < log.index("end a")
+
+
+async def test_failed_update_releases_chat():
+    processor = PerChatUpdateProcessor(10)
+
+    async def fail():
+        raise ValueError("boom")
+
+    try:
+        await processor.process_update(make_update(1), fail())
+    except ValueError:
+        pass
+    log = []
+    await asyncio.wait_for(processor.process_update(make_update(1), handle(log, "next", 0.0)), 1)
+    assert log == ["start next", "end next"]
+    assert processor._chats == {}
@@ -0,0 +1,120 @@
+# tests/test_upstream.py
+#
+# Защиты вызовов OpenAI из upstream.py: отдельные очереди сервисов, повторы и автомат защиты.
+
+import asyncio
+
+import httpx
+import openai
+import pytest
+
+import upstream
+from config import UPSTREAM_LIMITS, UPSTREAM_MAX_RETRIES, BREAKER_FAILURE_THRESHOLD
+
+MODEL = "gpt-4o-mini"
+
+
+@pytest.fixture(autouse=True)
+def fresh_upstream(monkeypatch):
+    """Очереди и автоматы защиты создаются заново для цикла событий каждого теста, повторы - без пауз."""
+    monkeypatch.setattr(upstream, "bulkheads", {
+        name: upstream.Bulkhead(name, **limits) for name, limits in UPSTREAM_LIMITS.items()
+    })
+    monkeypatch.setattr(upstream, "breakers", {})
+    monkeypatch.setattr(upstream, "retry_delay", lambda attempt: 0)
+
+
+def timeout_error():
+    return openai.APITimeoutError(request=httpx.Request("POST", "https://api.openai.com/v1/chat/completions"))
+
+
+class FlakyRequest:
+    """Запрос, который первые failures раз падает с error, а затем отвечает result."""
+
+    def __init__(self, failures, error=timeout_error, result="ok"):
+        self.failures = failures
+        self.error = error
+        self.result = result
+        self.attempts = 0
+
+    async def __call__(self):
+        self.attempts += 1
+        if self.attempts <= self.failures:
+            raise self.error()
+        return self.result
+
+
+async def test_image_queue_full_does_not_block_chat():
+    release = asyncio.Event()
+
+    async def slow_image():
+        await release.wait()
+        return "image"
+
+    limits = UPSTREAM_LIMITS["image"]
+    images = [
+        asyncio.create_task(upstream.call("image", "dall-e-3", slow_image))
+        for _ in range(limits["max_concurrent"] + limits["max_waiting"])
+    ]
+    for _ in range(10):
+        await asyncio.sleep(0)
+    assert upstream.bulkheads["image"].stats()["active"] == limits["max_concurrent"]
+    assert upstream.bulkheads["image"].stats()["waiting"] == limits["max_waiting"]
+
+    # Очередь к DALL-E заполнена: новая картинка сразу получает отказ...
+    with pytest.raises(upstream.UpstreamBusy):
+        await asyncio.wait_for(upstream.call("image", "dall-e-3", slow_image), 1)
+
+    # ...а чат по-прежнему получает место без ожидания
+    assert await asyncio.wait_for(upstream.call("chat", MODEL, FlakyRequest(0)), 1) == "ok"
+
+    release.set()
+    assert await asyncio.gather(*images) == ["image"] * len(images)
+    assert upstream.bulkheads["image"].stats()["active"] == 0
+
+
+async def test_retryable_error_is_retried():
+    request = FlakyRequest(UPSTREAM_MAX_RETRIES)
+    assert await upstream.call("chat", MODEL, request) == "ok"
+    assert request.attempts == UPSTREAM_MAX_RETRIES + 1
+    assert upstream.breaker("chat", MODEL).stats()["failures"] == 0
+
+
+async def test_non_retryable_error_is_not_retried():
+    request = FlakyRequest(1, error=lambda: ValueError("400"))
+    with pytest.raises(ValueError):
+        await upstream.call("chat", MODEL, request)
+    assert request.attempts == 1
+    assert upstream.breaker("chat", MODEL).state == upstream.CircuitBreaker.CLOSED
+
+
+async def test_breaker_opens_and_rejects_without_calling():
+    request = FlakyRequest(BREAKER_FAILURE_THRESHOLD * 10)
+    while upstream.breaker("chat", MODEL).state != upstream.CircuitBreaker.OPEN:
+        with pytest.raises(openai.APITimeoutError):
+            await upstream.call("chat", MODEL, request)
+    assert request.attempts == BREAKER_FAILURE_THRESHOLD
+
+    with pytest.raises(upstream.CircuitOpen):
+        await upstream.call("chat", MODEL, request)
+    assert request.attempts == BREAKER_FAILURE_THRESHOLD
+
+    # Автомат другой модели не затронут
+    assert await upstream.call("chat", "gpt-4o", FlakyRequest(0)) == "ok"
+
+
+async def test_breaker_probe_closes_after_reset_timeout():
+    circuit = upstream.CircuitBreaker("chat test", failure_threshold=1, reset_timeout=0.05)
+    circuit.record_failure()
+    assert circuit.rejecting()
+    with pytest.raises(upstream.CircuitOpen):
+        circuit.check()
+
+    await asyncio.sleep(0.06)
+    circuit.check()  # пробный запрос пропускается...
+    with pytest.raises(upstream.CircuitOpen):
+        circuit.check()  # ...но только один
+
+    circuit.record_success()
+    assert circuit.state == upstream.CircuitBreaker.CLOSED
+    circuit.check()
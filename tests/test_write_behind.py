@@ -0,0 +1,81 @@
+# tests/test_write_behind.py
+#
+# Чтение своих записей при отложенной записи (database/write_behind.py): то, что еще лежит
+# в очереди, должно быть видно через кэш профилей и историю из database/db.py.
+
+import contextlib
+
+from database import db
+from database.write_behind import WriteBehindQueue
+
+USER_ID = 1001
+
+
+@contextlib.asynccontextmanager
+async def running_queue(supabase, monkeypatch, flush_interval=60.0):
+    """Запущенная очередь, которая не пишет в БД до stop() (или до flush_interval)."""
+    queue = WriteBehindQueue(supabase, flush_interval=flush_interval)
+    monkeypatch.setattr(db, "write_behind", queue)
+    queue.start()
+    try:
+        yield queue
+    finally:
+        await queue.stop()
+
+
+async def test_cache_refill_keeps_queued_state(storage, monkeypatch):
+    async with storage() as supabase:
+        await db.add_or_update_user(supabase, USER_ID, language_code="ru")
+        async with running_queue(supabase, monkeypatch):
+            await db.set_user_state(supabase, USER_ID, "awaiting_image_prompt")
+            await db.increment_voice_stats(supabase, USER_ID, sent=1, received=2)
+
+            # Кэш вытеснен до записи очереди - профиль заново читается из БД
+            db.profile_cache.clear()
+            turn = await db.get_turn_context(supabase, USER_ID)
+            assert turn["state"] == "awaiting_image_prompt"
+            assert (await db.get_user_data(supabase, USER_ID))["state"] == "awaiting_image_prompt"
+
+            # Сброс в 'chat' из очереди тоже не теряется
+            await db.set_user_state(supabase, USER_ID, "chat")
+            db.profile_cache.clear()
+            assert (await db.get_user_data(supabase, USER_ID))["state"] == "chat"
+            assert await db.get_voice_stats(supabase, USER_ID) == {"sent": 1, "received": 2}
+
+        # После записи очереди счетчики не удваиваются
+        db.profile_cache.clear()
+        assert (await db.get_user_data(supabase, USER_ID))["state"] == "chat"
+        assert await db.get_voice_stats(supabase, USER_ID) == {"sent": 1, "received": 2}
+
+
+async def test_read_during_flush_has_no_duplicates(storage, monkeypatch):
+    async with storage() as supabase:
+        await db.add_or_update_user(supabase, USER_ID, language_code="ru")
+        await db.append_turn(supabase, USER_ID, [{"role": "user", "content": "записано раньше"}])
+
+        reads = []
+        insert_history_rows = db.insert_history_rows
+
+        async def insert_and_read(client, rows):
+            # Чтение истории сразу после вставки пачки, пока очередь еще не закончила запись
+            await insert_history_rows(client, rows)
+            turn = await db.get_turn_context(client, USER_ID)
+            reads.append((turn["history"], await db.get_user_history(client, USER_ID)))
+
+        monkeypatch.setattr(db, "insert_history_rows", insert_and_read)
+        async with running_queue(supabase, monkeypatch, flush_interval=0.01):
+            await db.append_turn(supabase, USER_ID, [
+                {"role": "user", "content": "вопрос"},
+                {"role": "assistant", "content": "ответ"},
+            ])
+            # До записи сообщения видны из очереди
+            assert [message["content"] for message in (await db.get_turn_context(supabase, USER_ID))["history"]] == [
+                "записано раньше", "вопрос", "ответ"
+            ]
+
+        expected = [
+            {"role": "user", "content": "записано раньше"},
+            {"role": "user", "content": "вопрос"},
+            {"role": "assistant", "content": "ответ"},
+        ]
+        assert reads == [(expected, expected)]
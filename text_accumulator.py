@@ -0,0 +1,79 @@
+# text_accumulator.py
+
+from bisect import bisect_right
+
+# Символы, после которых пробел или перенос строки завершает предложение
+SENTENCE_END_CHARS = ".!?…"
+
+
+class TextAccumulator:
+    """
+    Текст потокового ответа, который растет по кускам. Куски не склеиваются на каждом
+    токене (склейка - только когда текст нужен, то есть при правке сообщения), а границы
+    слов, предложений и абзацев отмечаются по мере поступления: просматривается только
+    новый кусок, а не весь текст заново.
+
+    Граница - позиция сразу после пробельного символа: text(0, граница) заканчивается
+    целым словом (предложением, абзацем).
+    """
+
+    def __init__(self, text: str = ""):
+        self._text = ""
+        self._pending = []
+        self._length = 0
+        self._last_char = ""
+        self.word_ends = []
+        self.sentence_ends = []
+        self.paragraph_ends = []
+        if text:
+            self.append(text)
+
+    def __len__(self):
+        return self._length
+
+    @property
+    def word_end(self) -> int:
+        """Конец последнего целого слова (0, если пробелов еще не было)."""
+        return self.word_ends[-1] if self.word_ends else 0
+
+    def append(self, chunk: str):
+        position = self._length
+        previous = self._last_char
+        for char in chunk:
+            position += 1
+            if char.isspace():
+                self.word_ends.append(position)
+                if char == "\n" and previous == "\n":
+                    self.paragraph_ends.append(position)
+                # previous пустой у пробела в самом начале текста ("" in str - всегда True)
+                elif char == "\n" or (previous and previous in SENTENCE_END_CHARS):
+                    self.sentence_ends.append(position)
+            previous = char
+        if chunk:
+            self._pending.append(chunk)
+            self._length = position
+            self._last_char = previous
+
+    def text(self, start: int = 0, end: int = None) -> str:
+        if self._pending:
+            self._text += "".join(self._pending)
+            self._pending.clear()
+        return self._text[start:end]
+
+    def split_point(self, start: int, limit: int) -> int:
+        """
+        Где закончить часть текста, начинающуюся со start, чтобы она была не длиннее limit:
+        после конца абзаца, иначе после конца предложения, иначе после слова
+        (в первой половине части режем только по слову), иначе ровно по limit.
+        """
+        end = start + limit
+        if self._length <= end:
+            return self._length
+        for boundaries in (self.paragraph_ends, self.sentence_ends):
+            index = bisect_right(boundaries, end) - 1
+            if index >= 0 and boundaries[index] > start + limit // 2:
+                return boundaries[index]
+        index = bisect_right(self.word_ends, end) - 1
+        if index >= 0 and self.word_ends[index] > start:
+            return self.word_ends[index]
+        return end
@@ -0,0 +1,58 @@
+# tokens.py
+
+# Кодировщик tiktoken создается один раз; None - пакета нет, считаем приблизительно
+_encoding = None
+_encoding_loaded = False
+
+
+def get_encoding():
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        try:
+            # Необязательная зависимость: без нее используется оценка по длине текста
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            print(f"⚠️ tiktoken недоступен ({e}), токены считаются приблизительно")
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    """
+    Считает токены в тексте сообщения. Результат сохраняется вместе с сообщением
+    (messages.token_count), поэтому для каждого сообщения считается один раз.
+    """
+    if not text:
+        return 0
+    encoding = get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return estimate_tokens(text)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Примерно 4 символа на токен (для кириллицы оценка занижена, но стабильна).
+    Та же формула используется в SQL для старых сообщений без token_count.
+    """
+    return (len(text) + 3) // 4 if text else 0
+
+
+def fit_history(history, budget: int):
+    """
+    Оставляет самые новые сообщения, суммарно укладывающиеся в budget токенов.
+    Сообщения в history - словари с role, content и (необязательно) token_count.
+    """
+    selected = []
+    used = 0
+    for message in reversed(history):
+        tokens = message.get("token_count")
+        if tokens is None:
+            tokens = estimate_tokens(message["content"])
+        if used + tokens > budget:
+            break
+        used += tokens
+        selected.append({"role": message["role"], "content": message["content"]})
+    selected.reverse()
+    return selected
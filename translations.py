@@ -98,7 +98,7 @@ TRANSLATIONS = {
         'language_change_interface_error': "❌ Ошибка при смене языка интерфейса.",
 
         # Админские команды
-        'admin_welcome': "👑 **Добро пожаловать в админ-панель!**\n\n📊 **Статистика:**\n/stats - Показать статистику бота\n/user\\_info <user\\_id> - Подробная информация о пользователе\n\n💰 **Управление кредитами:**\n/add\\_credits <user\\_id> <количество> - Начислить кредиты\n/remove\\_credits <user\\_id> <количество> - Снять кредиты\n\n📢 **Рассылка:**\n/broadcast <сообщение> - Отправить всем пользователям\n\nℹ️ Используйте команды для управления ботом.",
+        'admin_welcome': "👑 **Добро пожаловать в админ-панель!**\n\n📊 **Статистика:**\n/stats - Показать статистику бота\n/metrics - Метрики производительности\n/user\\_info <user\\_id> - Подробная информация о пользователе\n\n💰 **Управление кредитами:**\n/add\\_credits <user\\_id> <количество> - Начислить кредиты\n/remove\\_credits <user\\_id> <количество> - Снять кредиты\n\n📢 **Рассылка:**\n/broadcast <сообщение> - Отправить всем пользователям\n\nℹ️ Используйте команды для управления ботом.",
         'admin_command_format_error': "❌ **Неверный формат команды**\n\nИспользуйте: `{command}`\n\n**Пример:** `{example}`",
         'admin_credits_positive': "❌ Количество кредитов должно быть положительным числом.",
         'admin_user_not_found': "❌ Пользователь с ID {user_id} не найден в базе данных.",
@@ -112,7 +112,9 @@ TRANSLATIONS = {
         'admin_notification_failed': "⚠️ Кредиты начислены, но не удалось уведомить пользователя: {error}",
         'admin_broadcast_start': "Начинаю рассылку для {count} пользователей...",
         'admin_broadcast_complete': "Рассылка завершена! Успешно: {success}, Ошибок: {failed}",
+        'admin_broadcast_interrupted': "⚠️ Рассылка прервана: не удалось получить список пользователей. Успешно: {success}, Ошибок: {failed}. Последний обработанный user_id: {last_user_id}",
         'admin_broadcast_no_message': "Укажите сообщение. Пример: /broadcast Привет!",
+        'admin_metrics_title': "📈 Метрики производительности",
         
         # Языки
         'lang_russian': "🇷🇺 Русский",
@@ -122,6 +124,8 @@ TRANSLATIONS = {
         # AI чат
         'insufficient_credits_chat': "У вас закончились кредиты. Для ответа нужно: {cost}.",
         'chat_error': "Извините, произошла ошибка. Кредиты не списаны.",
+        'upstream_busy': "⏳ Сейчас слишком много запросов. Попробуйте через минуту — кредиты не списаны.",
+        'upstream_busy_voice': "⏳ Сейчас слишком много запросов. Попробуйте через минуту — списано только распознавание, за ответ кредиты не списаны.",
         
         # Ошибки
         'user_not_found': "❌ Пользователь с ID {user_id} не найден в базе данных.",
@@ -247,7 +251,7 @@ TRANSLATIONS = {
         'lang_polish': "🇵🇱 Polski",
 
          # Админские команды
-        'admin_welcome': "👑 **Welcome to admin panel!**\n\n📊 **Statistics:**\n/stats - Show bot statistics\n/user\\_info <user\\_id> - Detailed user information\n\n💰 **Credit management:**\n/add\\_credits <user\\_id> <amount> - Add credits\n/remove\\_credits <user\\_id> <amount> - Remove credits\n\n📢 **Broadcast:**\n/broadcast <message> - Send to all users\n\nℹ️ Use commands to manage the bot.",
+        'admin_welcome': "👑 **Welcome to admin panel!**\n\n📊 **Statistics:**\n/stats - Show bot statistics\n/metrics - Performance metrics\n/user\\_info <user\\_id> - Detailed user information\n\n💰 **Credit management:**\n/add\\_credits <user\\_id> <amount> - Add credits\n/remove\\_credits <user\\_id> <amount> - Remove credits\n\n📢 **Broadcast:**\n/broadcast <message> - Send to all users\n\nℹ️ Use commands to manage the bot.",
         'admin_command_format_error': "❌ **Invalid command format**\n\nUse: `{command}`\n\n**Example:** `{example}`",
         'admin_credits_positive': "❌ Credit amount must be a positive number.",
         'admin_user_not_found': "❌ User with ID {user_id} not found in database.",
@@ -261,11 +265,15 @@ TRANSLATIONS = {
         'admin_notification_failed': "⚠️ Credits added, but failed to notify user: {error}",
         'admin_broadcast_start': "Starting broadcast for {count} users...",
         'admin_broadcast_complete': "Broadcast completed! Success: {success}, Errors: {failed}",
+        'admin_broadcast_interrupted': "⚠️ Broadcast interrupted: could not load the user list. Success: {success}, Errors: {failed}. Last processed user_id: {last_user_id}",
         'admin_broadcast_no_message': "Specify message. Example: /broadcast Hello!",
+        'admin_metrics_title': "📈 Performance metrics",
         
         # AI чат
         'insufficient_credits_chat': "You've run out of credits. Need for response: {cost}.",
         'chat_error': "Sorry, an error occurred. Credits were not deducted.",
+        'upstream_busy': "⏳ Too many requests right now. Please try again in a minute — credits were not deducted.",
+        'upstream_busy_voice': "⏳ Too many requests right now. Please try again in a minute — only speech recognition was charged, no credits were deducted for the response.",
         
         # Ошибки
         'user_not_found': "❌ User with ID {user_id} not found in database.",
@@ -394,7 +402,7 @@ TRANSLATIONS = {
         'lang_polish': "🇵🇱 Polski",
 
         # Админские команды
-        'admin_welcome': "👑 **Witamy w panelu administratora!**\n\n📊 **Statystyki:**\n/stats - Pokaż statystyki bota\n/user\\_info <user\\_id> - Szczegółowe informacje o użytkowniku\n\n💰 **Zarządzanie kredytami:**\n/add\\_credits <user\\_id> <ilość> - Dodaj kredyty\n/remove\\_credits <user\\_id> <ilość> - Usuń kredyty\n\n📢 **Rozsyłanie:**\n/broadcast <wiadomość> - Wyślij do wszystkich użytkowników\n\nℹ️ Używaj komend do zarządzania botem.",
+        'admin_welcome': "👑 **Witamy w panelu administratora!**\n\n📊 **Statystyki:**\n/stats - Pokaż statystyki bota\n/metrics - Metryki wydajności\n/user\\_info <user\\_id> - Szczegółowe informacje o użytkowniku\n\n💰 **Zarządzanie kredytami:**\n/add\\_credits <user\\_id> <ilość> - Dodaj kredyty\n/remove\\_credits <user\\_id> <ilość> - Usuń kredyty\n\n📢 **Rozsyłanie:**\n/broadcast <wiadomość> - Wyślij do wszystkich użytkowników\n\nℹ️ Używaj komend do zarządzania botem.",
         'admin_command_format_error': "❌ **Nieprawidłowy format komendy**\n\nUżyj: `{command}`\n\n**Przykład:** `{example}`",
         'admin_credits_positive': "❌ Ilość kredytów musi być liczbą dodatnią.",
         'admin_user_not_found': "❌ Użytkownik o ID {user_id} nie został znaleziony w bazie danych.",
@@ -408,11 +416,15 @@ TRANSLATIONS = {
         'admin_notification_failed': "⚠️ Kredyty dodane, ale nie udało się powiadomić użytkownika: {error}",
         'admin_broadcast_start': "Rozpoczynam rozsyłanie dla {count} użytkowników...",
         'admin_broadcast_complete': "Rozsyłanie zakończone! Sukces: {success}, Błędy: {failed}",
+        'admin_broadcast_interrupted': "⚠️ Rozsyłanie przerwane: nie udało się pobrać listy użytkowników. Sukces: {success}, Błędy: {failed}. Ostatni przetworzony user_id: {last_user_id}",
         'admin_broadcast_no_message': "Podaj wiadomość. Przykład: /broadcast Cześć!",
+        'admin_metrics_title': "📈 Metryki wydajności",
         
         # Chat AI
         'insufficient_credits_chat': "Skończyły ci się kredyty. Potrzebujesz na odpowiedź: {cost}.",
         'chat_error': "Przepraszamy, wystąpił błąd. Kredyty nie zostały pobrane.",
+        'upstream_busy': "⏳ Zbyt wiele zapytań w tej chwili. Spróbuj ponownie za minutę — kredyty nie zostały pobrane.",
+        'upstream_busy_voice': "⏳ Zbyt wiele zapytań w tej chwili. Spróbuj ponownie za minutę — pobrano tylko opłatę za rozpoznanie mowy, za odpowiedź kredyty nie zostały pobrane.",
         
         # Błędy
         'user_not_found': "❌ Użytkownik o ID {user_id} nie został znaleziony w bazie danych.",
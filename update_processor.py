@@ -0,0 +1,45 @@
+# update_processor.py
+
+import asyncio
+from telegram.ext import BaseUpdateProcessor
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Обработка обновлений Telegram (Application.builder().concurrent_updates(...)):
+    обновления разных чатов обрабатываются параллельно (не больше max_concurrent_updates),
+    а обновления одного чата - строго по порядку. Пока один пользователь ждет DALL-E или
+    ответ модели, остальные чаты не стоят, а сообщения одного пользователя не обгоняют
+    друг друга (например, промпт картинки не опередит нажатие «Сгенерировать изображение»).
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._chats = {}  # chat_id -> [asyncio.Lock, сколько обновлений чата в обработке или ждут]
+
+    async def do_process_update(self, update, coroutine):
+        chat = getattr(update, "effective_chat", None)
+        if chat is None:
+            # Обновления без чата (inline-запросы и т.п.) порядок не требуют
+            await coroutine
+            return
+
+        entry = self._chats.setdefault(chat.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            # Замок больше никому не нужен - не держим его для давно молчащих чатов
+            if entry[1] == 0:
+                del self._chats[chat.id]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def stats(self):
+        return {"chats": len(self._chats), "updates": self.current_concurrent_updates}
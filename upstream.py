@@ -0,0 +1,246 @@
+# upstream.py
+
+import asyncio
+import random
+import time
+from contextlib import asynccontextmanager
+import openai
+from config import (
+    UPSTREAM_LIMITS, UPSTREAM_TIMEOUTS, UPSTREAM_MAX_RETRIES, UPSTREAM_RETRY_BASE_DELAY,
+    UPSTREAM_RETRY_MAX_DELAY, BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT
+)
+from metrics import registry
+
+# Группы метрик: ожидание места в очереди, длительность вызова и отказы
+UPSTREAM_QUEUE_METRICS = "upstream.queue"
+UPSTREAM_CALL_METRICS = "upstream.call"
+UPSTREAM_REJECTED_METRICS = "upstream.rejected"
+# Повторы запросов и переходы автоматов защиты по паре «сервис модель»
+UPSTREAM_RETRY_METRICS = "upstream.retries"
+UPSTREAM_BREAKER_METRICS = "upstream.breaker"
+
+# Ошибки, после которых запрос имеет смысл повторить (сеть, таймаут, 429, 5xx)
+RETRYABLE_ERRORS = (
+    asyncio.TimeoutError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
+
+class UpstreamBusy(Exception):
+    """Очередь к внешнему сервису заполнена - пользователю нужно ответить «попробуйте позже»."""
+
+    def __init__(self, upstream: str):
+        super().__init__(f"Сервис {upstream} перегружен")
+        self.upstream = upstream
+
+
+class CircuitOpen(UpstreamBusy):
+    """Автомат защиты разомкнут: сервис недавно падал подряд, запрос отклоняется сразу."""
+
+
+class CircuitBreaker:
+    """
+    Автомат защиты для пары (сервис, модель). После failure_threshold повторяемых ошибок
+    подряд размыкается и reset_timeout секунд сразу отклоняет запросы; затем пропускает
+    один пробный запрос: успех замыкает автомат, ошибка снова размыкает.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_started_at = None
+        self.times_opened = 0
+
+    def check(self):
+        """Пропускает запрос или бросает CircuitOpen."""
+        if self.state == self.CLOSED:
+            return
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            if now - self.opened_at < self.reset_timeout:
+                raise CircuitOpen(self.name)
+            self._set_state(self.HALF_OPEN)
+        # Полуоткрыт: один пробный запрос (зависший пробный не блокирует дольше reset_timeout)
+        if self.probe_started_at is not None and now - self.probe_started_at < self.reset_timeout:
+            raise CircuitOpen(self.name)
+        self.probe_started_at = now
+
+    def rejecting(self) -> bool:
+        """Отклонит ли check() запрос прямо сейчас (без смены состояния)."""
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            return now - self.opened_at < self.reset_timeout
+        if self.state == self.HALF_OPEN:
+            return self.probe_started_at is not None and now - self.probe_started_at < self.reset_timeout
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.probe_started_at = None
+        if self.state != self.CLOSED:
+            self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        self.failures += 1
+        self.probe_started_at = None
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            if self.state != self.OPEN:
+                self.times_opened += 1
+                self._set_state(self.OPEN)
+
+    def _set_state(self, state: str):
+        print(f"⚡ Автомат защиты {self.name}: {self.state} -> {state}")
+        self.state = state
+        registry.increment(UPSTREAM_BREAKER_METRICS, f"{self.name} {state}")
+
+    def stats(self):
+        return {"state": self.state, "failures": self.failures, "times_opened": self.times_opened}
+
+
+class Bulkhead:
+    """
+    Ограничение параллельных вызовов одного внешнего сервиса (chat, whisper, tts, image).
+    Не больше max_concurrent вызовов одновременно и не больше max_waiting ожидающих;
+    сверх этого, или если место не освободилось за max_wait секунд, - UpstreamBusy.
+    """
+
+    def __init__(self, name: str, max_concurrent: int, max_waiting: int, max_wait: float):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self.active = 0
+        self.waiting = 0
+
+    def reject(self):
+        registry.increment(UPSTREAM_REJECTED_METRICS, self.name)
+        raise UpstreamBusy(self.name)
+
+    @asynccontextmanager
+    async def slot(self):
+        """Занимает место на время вызова сервиса."""
+        if self._semaphore.locked() and self.waiting >= self.max_waiting:
+            self.reject()
+
+        self.waiting += 1
+        queued_at = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.max_wait)
+        except asyncio.TimeoutError:
+            self.reject()
+        finally:
+            self.waiting -= 1
+            registry.observe(UPSTREAM_QUEUE_METRICS, self.name, (time.perf_counter() - queued_at) * 1000)
+
+        self.active += 1
+        started = time.perf_counter()
+        failed = False
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self.active -= 1
+            self._semaphore.release()
+            registry.observe(UPSTREAM_CALL_METRICS, self.name, (time.perf_counter() - started) * 1000, failed)
+
+    def stats(self):
+        return {
+            "active": self.active,
+            "max_concurrent": self.max_concurrent,
+            "waiting": self.waiting,
+            "max_waiting": self.max_waiting,
+        }
+
+
+bulkheads = {name: Bulkhead(name, **limits) for name, limits in UPSTREAM_LIMITS.items()}
+breakers = {}  # "сервис модель" -> CircuitBreaker
+
+
+def slot(upstream: str):
+    """Место в очереди к сервису: async with upstream.slot("chat"): ..."""
+    return bulkheads[upstream].slot()
+
+
+def breaker(upstream: str, model: str) -> CircuitBreaker:
+    """Автомат защиты для пары (сервис, модель)."""
+    name = f"{upstream} {model}"
+    if name not in breakers:
+        breakers[name] = CircuitBreaker(name, BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+    return breakers[name]
+
+
+def retry_delay(attempt: int) -> float:
+    """Экспоненциальная задержка перед повтором с полным джиттером."""
+    return random.uniform(0, min(UPSTREAM_RETRY_MAX_DELAY, UPSTREAM_RETRY_BASE_DELAY * 2 ** attempt))
+
+
+async def call(upstream: str, model: str, request, timeout: float = None):
+    """
+    Вызов сервиса OpenAI со всеми защитами: автомат защиты, место в очереди, дедлайн
+    на попытку и ограниченные повторы с джиттером для повторяемых ошибок.
+    
+    Args:
+        request: функция без аргументов, возвращающая корутину запроса (вызывается на каждую попытку)
+        timeout: дедлайн попытки в секундах (по умолчанию UPSTREAM_TIMEOUTS[upstream])
+    
+    Raises:
+        UpstreamBusy / CircuitOpen: если запрос отклонен без обращения к сервису
+    """
+    # Разомкнутый автомат отклоняет запрос сразу, не занимая места в очереди
+    if breaker(upstream, model).rejecting():
+        registry.increment(UPSTREAM_REJECTED_METRICS, f"{upstream} {model} breaker")
+        raise CircuitOpen(f"{upstream} {model}")
+    async with slot(upstream):
+        return await call_in_slot(upstream, model, request, timeout)
+
+
+async def call_in_slot(upstream: str, model: str, request, timeout: float = None):
+    """То же, что call(), для кода, который уже занял место в очереди (потоковые ответы)."""
+    circuit = breaker(upstream, model)
+    timeout = timeout or UPSTREAM_TIMEOUTS[upstream]
+    attempt = 0
+    while True:
+        circuit.check()
+        try:
+            result = await asyncio.wait_for(request(), timeout)
+        except RETRYABLE_ERRORS as e:
+            circuit.record_failure()
+            if attempt >= UPSTREAM_MAX_RETRIES or circuit.state == CircuitBreaker.OPEN:
+                raise
+            delay = retry_delay(attempt)
+            attempt += 1
+            registry.increment(UPSTREAM_RETRY_METRICS, circuit.name)
+            print(f"🔁 {circuit.name}: {type(e).__name__}, повтор {attempt}/{UPSTREAM_MAX_RETRIES} через {delay:.1f}с")
+            await asyncio.sleep(delay)
+            continue
+        except Exception:
+            # Сервис ответил, но запрос неверный (400 и т.п.) - это не сбой сервиса
+            circuit.record_success()
+            raise
+        circuit.record_success()
+        return result
+
+
+def get_upstream_stats():
+    """Текущая загрузка всех сервисов (для /metrics)."""
+    return {name: bulkhead.stats() for name, bulkhead in bulkheads.items()}
+
+
+def get_breaker_stats():
+    """Состояние автоматов защиты (для /metrics)."""
+    return {name: circuit.stats() for name, circuit in breakers.items()}